@@ -0,0 +1,144 @@
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import math
+import numpy as np
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Load the add-on folder as the io_scene_kcl package, which runs without Blender.
+_SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src")
+_spec = importlib.util.spec_from_file_location("io_scene_kcl", os.path.join(_SOURCE_DIR, "__init__.py"),
+                                               submodule_search_locations=[_SOURCE_DIR])
+io_scene_kcl = importlib.util.module_from_spec(_spec)
+sys.modules["io_scene_kcl"] = io_scene_kcl
+_spec.loader.exec_module(io_scene_kcl)
+
+from io_scene_kcl.kcl_collision import CollisionWorld
+from io_scene_kcl.kcl_file import KclFile, KclModel
+from io_scene_kcl.kcl_octree import build_octree, write_octree
+from io_scene_kcl.kcl_writer import KclWriter
+from terrain import create_terrain
+
+SIZES = (1000, 10000, 100000, 500000)
+# Number of triangles of the first model reconstructed one by one, as doing it for all of them takes too long.
+SINGLE_TRIANGLES = 2000
+# Number of rays cast down onto the terrain at once.
+RAYS = 1000
+
+def create_phases(triangle_count, seed):
+    # Return the phases to measure for a mesh of the given size, each preparing its input once outside of the timing.
+    vertices, normals = create_terrain(triangle_count, seed)
+    triangles = KclModel.OctreeTriangles(vertices, normals)
+    base = vertices.reshape(-1, 3).min(axis=0)
+    size = (vertices.reshape(-1, 3).max(axis=0) - base).max()
+    cube_size = 2 ** max(0, int(math.ceil(math.log(max(size, 1), 2))) - 1)
+    octree_args = (triangles, base, cube_size, (2, 2, 2), 32, 256)
+    octree = build_octree(*octree_args, engine="binned")
+    with tempfile.TemporaryDirectory() as directory:
+        filepath = os.path.join(directory, "benchmark.kcl")
+        with contextlib.redirect_stdout(io.StringIO()):
+            KclWriter(octree_engine="binned").write(filepath, vertices, normals, np.zeros(len(vertices)))
+        with open(filepath, "rb") as raw:
+            data = raw.read()
+    models = KclFile(data).models[:]
+    indices = np.arange(len(triangles))
+    center = base + np.float32(cube_size / 2)
+    world = CollisionWorld(KclFile(data))
+    rng = np.random.default_rng(seed)
+    ray_origins = rng.uniform(base, vertices.reshape(-1, 3).max(axis=0), (RAYS, 3))
+    ray_directions = np.tile((0, -1, 0), (RAYS, 1)) + rng.normal(0, 0.2, (RAYS, 3))
+
+    def write():
+        with contextlib.redirect_stdout(io.StringIO()):
+            KclWriter(octree_engine="binned").write(io.BytesIO(), vertices, normals, np.zeros(len(vertices)))
+
+    def parse():
+        kcl_file = KclFile(data)
+        return kcl_file.models[:]
+
+    def reconstruct_single():
+        kcl_model = models[0]
+        for triangle in kcl_model.triangles[:SINGLE_TRIANGLES]:
+            kcl_model.get_triangle_vertices(triangle)
+
+    return {
+        "parse": parse,
+        "reconstruct": lambda: [kcl_model.all_triangle_vertices() for kcl_model in models],
+        "reconstruct_single": reconstruct_single,
+        "tricube_overlap": lambda: KclModel.OctreeNode.tricube_overlap(triangles, indices, center, cube_size / 2),
+        "octree_recursive": lambda: build_octree(*octree_args, engine="recursive"),
+        "octree_binned": lambda: build_octree(*octree_args, engine="binned"),
+        "write_octree": lambda: write_octree(octree),
+        "cast_rays": lambda: world.cast_rays(ray_origins, ray_directions),
+        "write": write
+    }
+
+def measure(phase, repeat):
+    # Take the best time of several runs, and the peak memory of a separate run as tracing slows down the phase.
+    seconds = []
+    for i in range(0, repeat):
+        start = time.perf_counter()
+        phase()
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        phase()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"seconds": min(seconds), "peak_bytes": peak}
+
+def compare(results, baseline, tolerance, min_difference):
+    # Return the measurements which took longer than the baseline allows, ignoring differences within timer noise.
+    regressions = []
+    for key, result in sorted(results.items()):
+        expected = baseline.get(key)
+        if expected and result["seconds"] > max(expected["seconds"] * (1 + tolerance),
+                                                expected["seconds"] + min_difference):
+            regressions.append("{}: {:.4f}s instead of {:.4f}s".format(key, result["seconds"], expected["seconds"]))
+    return regressions
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Measure the phases of reading and writing KCL files.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="The triangle counts of the meshes.")
+    parser.add_argument("--phases", nargs="+", help="The phases to measure, or all if omitted.")
+    parser.add_argument("--repeat", type=int, default=3, help="The number of timed runs of each phase.")
+    parser.add_argument("--seed", type=int, default=0, help="The seed of the noise added to the meshes.")
+    parser.add_argument("--output", help="The JSON file to write the results to.")
+    parser.add_argument("--baseline", help="The JSON file of earlier results to compare with.")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="The fraction by which a phase may be slower than its baseline.")
+    parser.add_argument("--min-difference", type=float, default=0.002,
+                        help="The number of seconds by which a phase may always be slower than its baseline.")
+    args = parser.parse_args(args)
+    results = {}
+    for size in args.sizes:
+        phases = create_phases(size, args.seed)
+        for name in args.phases or phases:
+            result = measure(phases[name], args.repeat)
+            results["{}/{}".format(name, size)] = result
+            print("{:<20} {:>8} {:>10.4f}s {:>10.1f} MiB".format(name, size, result["seconds"],
+                                                                  result["peak_bytes"] / 2 ** 20), flush=True)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine(),
+                       "results": results}, file, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file)["results"], args.tolerance,
+                                  args.min_difference)
+        for regression in regressions:
+            print("Regression in " + regression)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
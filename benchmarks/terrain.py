@@ -0,0 +1,18 @@
+import math
+import numpy as np
+
+def create_terrain(triangle_count, seed=0, relief=1.0):
+    # Create a height field of rolling hills with some noise, split into the given number of triangles. The relief scales
+    # the heights, e.g. to get flat courses.
+    rng = np.random.default_rng(seed)
+    cells = int(math.ceil(math.sqrt(triangle_count / 2)))
+    x, z = np.meshgrid(np.arange(0, cells + 1, dtype=np.float64), np.arange(0, cells + 1, dtype=np.float64))
+    y = 400 * np.sin(x / 23) * np.cos(z / 31) + 150 * np.sin((x + z) / 7) + rng.normal(0, 10, x.shape)
+    points = np.stack((x * 40, y * relief, z * 40), axis=-1).reshape(-1, 3)
+    corner = (np.arange(0, cells)[:, np.newaxis] * (cells + 1) + np.arange(0, cells)).reshape(-1)
+    quads = np.stack((corner, corner + 1, corner + cells + 2, corner + cells + 1), axis=1)
+    faces = np.concatenate((quads[:, (0, 2, 1)], quads[:, (0, 3, 2)]))[:triangle_count]
+    vertices = points[faces].astype(np.float32)
+    normals = np.cross(vertices[:, 1] - vertices[:, 0], vertices[:, 2] - vertices[:, 0])
+    normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+    return vertices, normals.astype(np.float32)
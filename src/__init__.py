@@ -15,21 +15,30 @@ bl_info = {
 # Reload the classes when reloading add-ons in Blender with F8.
 if "bpy" in locals():
     import importlib
-    if "log"       in locals(): importlib.reload(log)
-    if "binary_io" in locals(): importlib.reload(binary_io)
-    if "kcl_file"  in locals(): importlib.reload(kcl_file)
-    if "importing" in locals(): importlib.reload(importing)
-    if "editing"   in locals(): importlib.reload(editing)
-    if "exporting" in locals(): importlib.reload(exporting)
+    if "log"        in locals(): importlib.reload(log)
+    if "binary_io"  in locals(): importlib.reload(binary_io)
+    if "kcl_file"   in locals(): importlib.reload(kcl_file)
+    if "kcl_octree" in locals(): importlib.reload(kcl_octree)
+    if "kcl_writer" in locals(): importlib.reload(kcl_writer)
+    if "obj_file"   in locals(): importlib.reload(obj_file)
+    if "szs_file"   in locals(): importlib.reload(szs_file)
+    if "kcl_cache"  in locals(): importlib.reload(kcl_cache)
+    if "kcl_batch"  in locals(): importlib.reload(kcl_batch)
+    if "importing"  in locals(): importlib.reload(importing)
+    if "editing"    in locals(): importlib.reload(editing)
+    if "exporting"  in locals(): importlib.reload(exporting)
 
-import bpy
-from . import log
-from . import binary_io
-from . import importing
-from . import editing
-from . import exporting
+# The core modules do not depend on Blender, so that the package can also be used as a command line tool.
+try:
+    import bpy
+except ImportError:
+    bpy = None
 
 def register():
+    # Only import the user interface when Blender registers the add-on.
+    from . import importing
+    from . import editing
+    from . import exporting
     bpy.utils.register_module(__name__)
     # Importing
     bpy.types.INFO_MT_file_import.append(importing.ImportOperator.menu_func_import)
@@ -52,6 +61,9 @@ def register():
     bpy.types.INFO_MT_file_export.append(exporting.ExportOperator.menu_func_export)
 
 def unregister():
+    from . import importing
+    from . import editing
+    from . import exporting
     bpy.utils.unregister_module(__name__)
     # Importing
     bpy.types.INFO_MT_file_import.remove(importing.ImportOperator.menu_func_import)
@@ -0,0 +1,210 @@
+import argparse
+import io
+import json
+import os
+import struct
+import sys
+import numpy as np
+from .kcl_analysis import analyze_file, format_report
+from .kcl_batch import ACTIONS, find_files, run_batch
+from .kcl_cache import ParseCache
+from .kcl_file import KclFile
+from .kcl_octree import OctreeCache
+from .kcl_writer import KclWriter
+from .log import Profiler
+from .obj_file import read_obj, write_obj
+from .szs_file import SarcFile, SarcWriter, find_kcl, open_kcl, split_archive_path
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="io_scene_kcl", description="Convert and edit Nintendo KCL files.")
+    parser.add_argument("--profile", action="store_true", help="Log the time spent in each step of the command.")
+    parser.add_argument("--trace", help="Write the profiled steps to this file in the Chrome trace format.")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    # info
+    command = commands.add_parser("info", help="Print the header and model sections of a KCL file.")
+    command.add_argument("kcl")
+    command.set_defaults(func=_info)
+    # list
+    command = commands.add_parser("list", help="List the files in a SARC or Yaz0 compressed SZS archive.")
+    command.add_argument("archive")
+    command.set_defaults(func=_list)
+    # analyze
+    command = commands.add_parser("analyze", help="Report the octree quality and section sizes of a KCL file.")
+    command.add_argument("kcl")
+    command.add_argument("other", nargs="?", help="Another KCL file to compare with side by side.")
+    command.add_argument("--json", action="store_true", help="Print the statistics as JSON instead of a table.")
+    command.set_defaults(func=_analyze)
+    # to-obj
+    command = commands.add_parser("to-obj", help="Convert a KCL file into a Wavefront OBJ file.")
+    command.add_argument("kcl")
+    command.add_argument("obj")
+    command.add_argument("--cache", action="store_true",
+                         help="Keep the reconstructed triangles in a cache to convert the file faster again.")
+    command.set_defaults(func=_to_obj)
+    # from-obj
+    command = commands.add_parser("from-obj", help="Create a new KCL file from a Wavefront OBJ file.")
+    command.add_argument("obj")
+    command.add_argument("kcl")
+    command.add_argument("--max-cube-triangles", type=int, default=32,
+                         help="The maximum amount of triangles in a spatial cube before it is attempted to split it.")
+    command.add_argument("--min-cube-size", type=int, default=256,
+                         help="The minimum size of a spatial cube into which triangles will be sorted.")
+    command.add_argument("--octree-engine", choices=("recursive", "binned"), default="recursive",
+                         help="The algorithm sorting the triangles into the octree cubes.")
+    command.add_argument("--processes", type=int, default=1,
+                         help="The number of processes building the octree recursively in parallel, or 0 to use all "
+                              "cores.")
+    command.add_argument("--auto-tune", action="store_true",
+                         help="Choose the cube triangles and size giving the fastest lookups with an octree within the "
+                              "budget.")
+    command.add_argument("--octree-budget", type=float, default=8.0,
+                         help="The maximum size of an auto tuned octree in bytes per triangle.")
+    command.add_argument("--incremental", action="store_true",
+                         help="Only rebuild the octree cubes whose triangles changed since the last conversion, keeping "
+                              "the octree in a file next to the KCL file.")
+    command.add_argument("--pool-tolerance", type=float, default=0.0,
+                         help="Store positions and normals whose coordinates round to the same multiples of this "
+                              "tolerance only once, or only equal ones with 0.")
+    command.add_argument("--compression-level", type=int, default=6,
+                         help="The Yaz0 compression level from 0 (fastest, no compression) to 9 (smallest) when writing "
+                              "into an archive like course.szs:course.kcl. Levels up to 6 compress about 2 MB/s, level 9 "
+                              "half as fast.")
+    command.set_defaults(func=_from_obj)
+    # set-flags
+    command = commands.add_parser("set-flags", help="Change the collision flags of triangles in place.")
+    command.add_argument("kcl")
+    command.add_argument("flags", type=lambda value: int(value, 0))
+    command.add_argument("--model", type=int, help="The index of the model to change, or all models if omitted.")
+    command.add_argument("--triangles", type=int, nargs="+",
+                         help="The indices of the triangles in the model to change, or all triangles if omitted.")
+    command.add_argument("--where", type=lambda value: int(value, 0),
+                         help="Only change triangles which currently have these collision flags.")
+    command.set_defaults(func=_set_flags)
+    # batch
+    command = commands.add_parser("batch", help="Process many KCL files in parallel, printing a JSON line per file.")
+    command.add_argument("action", choices=ACTIONS)
+    command.add_argument("files", nargs="+", help="The KCL files, directories or glob patterns to process.")
+    command.add_argument("--output-dir", help="The directory to write converted files to instead of next to them.")
+    command.add_argument("--processes", type=int, default=0,
+                         help="The number of files processed in parallel, or 0 to use all cores.")
+    command.add_argument("--octree-engine", choices=("recursive", "binned"), default="recursive",
+                         help="The algorithm sorting the triangles into the octree cubes of rebuilt files.")
+    command.set_defaults(func=_batch)
+    args = parser.parse_args(args)
+    Profiler.begin(args.profile or args.trace is not None, args.trace)
+    try:
+        args.func(args)
+    except (AssertionError, OSError) as e:
+        parser.exit(1, "error: {}\n".format(e))
+    except (ValueError, struct.error, IndexError) as e:
+        # Raised when reading files which are truncated or not in the expected format.
+        parser.exit(1, "error: The file could not be read: {}\n".format(e))
+    finally:
+        Profiler.end()
+
+def _info(args):
+    with open_kcl(args.kcl) as kcl_file:
+        header = kcl_file.header
+        print("Models: {}".format(header.model_count))
+        print("Minimum coordinate: {}".format(header.min_model_coordinate))
+        print("Maximum coordinate: {}".format(header.max_model_coordinate))
+        print("Coordinate shift: {}".format(header.coordinate_shift))
+        for i, kcl_model in enumerate(kcl_file.models):
+            print("Model {}:".format(str(i).zfill(2)))
+            print("  Triangles: {}".format(len(kcl_model.triangles)))
+            print("  Positions: {}".format(len(kcl_model.positions)))
+            print("  Normals: {}".format(len(kcl_model.normals)))
+            print("  Collision flags: {}".format(", ".join("0x{:04X}".format(flags)
+                                                          for flags in np.unique(kcl_model.triangles.collision_flags))))
+
+def _list(args):
+    # Only the directory of the archive is decompressed to list its files.
+    archive = SarcFile.open(args.archive)
+    for node in archive.nodes:
+        print("{}  {} bytes".format(node.name, node.end - node.start))
+
+def _analyze(args):
+    with open_kcl(args.kcl) as kcl_file:
+        stats = analyze_file(kcl_file)
+    other = None
+    if args.other:
+        with open_kcl(args.other) as kcl_file:
+            other = analyze_file(kcl_file)
+    if args.json:
+        print(json.dumps(stats if other is None else {args.kcl: stats, args.other: other}, indent=2))
+    else:
+        print("\n".join(format_report(stats, other)))
+
+def _to_obj(args):
+    cache = ParseCache() if args.cache else None
+    with open_kcl(args.kcl) as kcl_file, open(args.obj, "w") as file:
+        if cache is not None:
+            cache.load(kcl_file)
+        write_obj(file, kcl_file)
+    if cache is not None:
+        print("Cache: {hits} hits, {misses} misses, {evictions} evictions, {entries} entries of {size} bytes.".format(
+            **cache.stats()))
+
+def _from_obj(args):
+    with open(args.obj) as file:
+        vertices, normals, collision_flags = read_obj(file)
+    if not len(vertices):
+        raise AssertionError("The OBJ file has no faces, so there is nothing to export.")
+    archive_path, name = split_archive_path(args.kcl)
+    cache_path = (archive_path or args.kcl) + OctreeCache.EXTENSION
+    cache = OctreeCache.load(cache_path) if args.incremental else None
+    writer = KclWriter(args.max_cube_triangles, args.min_cube_size, args.processes, args.octree_engine, args.auto_tune,
+                       args.octree_budget, cache, args.pool_tolerance)
+    if archive_path is None:
+        writer.write(args.kcl, vertices, normals, collision_flags)
+    else:
+        # Replace the KCL file in an existing archive, keeping its other files, or create a new archive.
+        raw = io.BytesIO()
+        writer.write(raw, vertices, normals, collision_flags)
+        files = {}
+        if os.path.isfile(archive_path):
+            archive = SarcFile.open(archive_path)
+            files = archive.read_all()
+            name = name or find_kcl(archive)
+        files[name or "course.kcl"] = raw.getvalue()
+        SarcWriter(compression_level=args.compression_level).write(archive_path, files)
+    if cache is not None:
+        cache.save(cache_path)
+
+def _set_flags(args):
+    if not 0 <= args.flags <= 0xFFFF:
+        raise AssertionError("The collision flags must be between 0x0 and 0xFFFF.")
+    with KclFile.open_mmap(args.kcl, writable=True) as kcl_file:
+        if args.model is not None and not 0 <= args.model < len(kcl_file.models):
+            raise AssertionError("The model index must be between 0 and {}.".format(len(kcl_file.models) - 1))
+        model_indices = range(0, len(kcl_file.models)) if args.model is None else [args.model]
+        for model_index in model_indices:
+            collision_flags = kcl_file.models[model_index].triangles.collision_flags
+            mask = np.zeros(len(collision_flags), bool)
+            if args.triangles is None:
+                mask[:] = True
+            else:
+                if not all(0 <= i < len(collision_flags) for i in args.triangles):
+                    raise AssertionError("The triangle indices of model {} must be between 0 and {}.".format(
+                        model_index, len(collision_flags) - 1))
+                mask[args.triangles] = True
+            if args.where is not None:
+                mask &= collision_flags == args.where
+            del collision_flags
+            changed = kcl_file.update_collision_flags(model_index, np.flatnonzero(mask), args.flags)
+            print("Model {}: Changed {} triangles.".format(str(model_index).zfill(2), changed))
+        kcl_file.flush()
+
+def _batch(args):
+    paths = find_files(args.files)
+    failed = 0
+    for result in run_batch(paths, args.action, args.output_dir, args.processes,
+                            {"octree_engine": args.octree_engine}):
+        failed += "error" in result
+        print(json.dumps(result), flush=True)
+    if failed:
+        raise AssertionError("{} of {} files failed.".format(failed, len(paths)))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,105 +1,217 @@
+import contextlib
+import functools
 import io
-import mathutils
+import numpy as np
+import os
 import struct
+import tempfile
+
+# The permissions masked from new files. Reading it requires changing it, which is only done once while importing, as
+# other threads could create files in the meantime.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# Compile each format once, as creating structs costs more than unpacking a few values with them. The cache is bounded,
+# as formats with counts like "12I" differ between files.
+_get_struct = functools.lru_cache(maxsize=256)(struct.Struct)
+
+class Structs:
+    # Structs of the values read and written, compiled once for each endianness.
+    def __init__(self, endianness):
+        self.int32 = _get_struct(endianness + "i")
+        self.sbyte = _get_struct(endianness + "b")
+        self.single = _get_struct(endianness + "f")
+        self.uint16 = _get_struct(endianness + "H")
+        self.uint32 = _get_struct(endianness + "I")
+        self.matrix4x3 = _get_struct(endianness + "12f")
+        self.vector2f = _get_struct(endianness + "2f")
+        self.vector3 = _get_struct(endianness + "3I")
+        self.vector3f = _get_struct(endianness + "3f")
+        self.quaternion = _get_struct(endianness + "4f")
+
+_get_structs = functools.lru_cache(maxsize=None)(Structs)
 
 class BinaryReader:
-    def __init__(self, raw):
-        self.raw = raw
-        self.endianness = "<" # Little-endian
+    # Reads values at a cursor in a bytes-like object (e.g. a memory map) without copying it. Streams are read into
+    # memory first.
+    def __init__(self, raw, endianness="<"):
+        self.buffer = memoryview(raw.read() if isinstance(raw, io.IOBase) else raw)
+        self.position = 0
+        self.endianness = endianness # Little-endian by default
 
     def __enter__(self):
-        self.reader = io.BufferedReader(self.raw)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.reader.close()
+        # Release the view so that the underlying buffer can be closed.
+        self.buffer.release()
+
+    @property
+    def endianness(self):
+        return self._endianness
+
+    @endianness.setter
+    def endianness(self, value):
+        self._endianness = value
+        self.structs = _get_structs(value)
 
     def seek(self, offset, whence=io.SEEK_SET):
-        self.reader.seek(offset, whence)
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.buffer)
+        self.position = offset
+        return self.position
 
     def tell(self):
-        return self.reader.tell()
-
-    def read_0_string(self):
-        text = ""
-        i = self.read_byte()
-        while i != 0:
-            text += chr(i)
-            i = self.read_byte()
+        return self.position
+
+    def read(self, record_struct):
+        # Return the values of one record of the given struct, or a format without endianness.
+        if isinstance(record_struct, str):
+            record_struct = _get_struct(self._endianness + record_struct)
+        values = record_struct.unpack_from(self.buffer, self.position)
+        self.position += record_struct.size
+        return values
+
+    def read_records(self, record_struct, count):
+        # Return the values of consecutive records of the given struct, or a format without endianness, in bulk.
+        return list(self.iter_records(record_struct, count))
+
+    def iter_records(self, record_struct, count):
+        # Iterate over the values of consecutive records, unpacking them only when they are consumed.
+        if isinstance(record_struct, str):
+            record_struct = _get_struct(self._endianness + record_struct)
+        start = self.position
+        end = start + record_struct.size * count
+        if end > len(self.buffer):
+            raise struct.error("Cannot read {} records of {} bytes at offset {}.".format(count, record_struct.size,
+                                                                                          start))
+        self.position = end
+        return record_struct.iter_unpack(self.buffer[start:end])
+
+    def read_0_string(self, encoding="ascii"):
+        # Search the terminator in small chunks, as strings are short compared to the rest of the buffer.
+        end = self.position
+        while True:
+            chunk = bytes(self.buffer[end:end + 64])
+            index = chunk.find(0)
+            if index >= 0:
+                end += index
+                break
+            if len(chunk) < 64:
+                raise struct.error("Unterminated string at offset {}.".format(self.position))
+            end += 64
+        text = bytes(self.buffer[self.position:end]).decode(encoding)
+        self.position = end + 1
         return text
 
     def read_byte(self):
-        return self.reader.read(1)[0]
+        value = self.buffer[self.position]
+        self.position += 1
+        return value
 
     def read_bytes(self, count):
-        return self.reader.read(count)
+        # Return a view on the bytes rather than a copy of them.
+        value = self.buffer[self.position:self.position + count]
+        self.position += len(value)
+        return value
 
     def read_int32(self):
-        return struct.unpack(self.endianness + "i", self.reader.read(4))[0]
+        return self._unpack(self.structs.int32)[0]
 
     def read_sbyte(self):
-        return struct.unpack(self.endianness + "b", self.reader.read(1))[0]
+        return self._unpack(self.structs.sbyte)[0]
 
     def read_single(self):
-        return struct.unpack(self.endianness + "f", self.reader.read(4))[0]
+        return self._unpack(self.structs.single)[0]
 
     def read_uint16(self):
-        return struct.unpack(self.endianness + "H", self.reader.read(2))[0]
+        return self._unpack(self.structs.uint16)[0]
 
     def read_uint16s(self, count):
-        return struct.unpack(self.endianness + str(int(count)) + "H", self.reader.read(int(2 * count)))
+        return self._unpack(_get_struct(self._endianness + str(int(count)) + "H"))
 
     def read_uint32(self):
-        return struct.unpack(self.endianness + "I", self.reader.read(4))[0]
+        return self._unpack(self.structs.uint32)[0]
 
     def read_uint32s(self, count):
-        return struct.unpack(self.endianness + str(int(count)) + "I", self.reader.read(4 * count))
+        return self._unpack(_get_struct(self._endianness + str(int(count)) + "I"))
 
     def read_matrix4x3(self):
+        import mathutils # Only available in Blender, while the rest of the reader is used without it.
+        values = self._unpack(self.structs.matrix4x3)
         matrix = mathutils.Matrix()
-        matrix[0][0] = self.read_single()
-        matrix[0][1] = self.read_single()
-        matrix[0][2] = self.read_single()
-        matrix[1][0] = self.read_single()
-        matrix[1][1] = self.read_single()
-        matrix[1][2] = self.read_single()
-        matrix[2][0] = self.read_single()
-        matrix[2][1] = self.read_single()
-        matrix[2][2] = self.read_single()
-        matrix[3][0] = self.read_single()
-        matrix[3][1] = self.read_single()
-        matrix[3][2] = self.read_single()
+        for i in range(0, 4):
+            matrix[i][0:3] = values[3 * i:3 * i + 3]
         return matrix
 
     def read_raw_string(self, length, encoding="ascii"):
-        return self.reader.read(length).decode(encoding)
+        return bytes(self.read_bytes(length)).decode(encoding)
 
     def read_vector2f(self):
-        return self.read_single(), self.read_single()
+        return self._unpack(self.structs.vector2f)
 
     def read_vector_3d(self):
+        import mathutils
         return mathutils.Vector(self.read_vector3f())
 
     def read_vector3(self):
-        return self.read_uint32(), self.read_uint32(), self.read_uint32()
+        return self._unpack(self.structs.vector3)
 
     def read_vector3f(self):
-        return self.read_single(), self.read_single(), self.read_single()
+        return self._unpack(self.structs.vector3f)
 
     def read_quaternion(self):
-        return mathutils.Quaternion((self.read_single(), self.read_single(), self.read_single(), self.read_single()))
+        import mathutils
+        return mathutils.Quaternion(self._unpack(self.structs.quaternion))
+
+    def _unpack(self, value_struct):
+        values = value_struct.unpack_from(self.buffer, self.position)
+        self.position += value_struct.size
+        return values
 
 class BinaryWriter:
-    def __init__(self, raw):
-        self.raw = raw
-        self.endianness = "<" # Little-endian
+    # Writes values into a buffer in memory, which is written to the stream or file at once when the writer is closed.
+    # Reserved offsets are patched into the buffer in one pass before that, and files are replaced atomically.
+    def __init__(self, raw, endianness="<"):
+        self.raw = raw # A stream, or the path of a file.
+        self.buffer = bytearray()
+        self.size = 0 # Only updated when seeking back, the data ends at the position otherwise.
+        self.position = 0
+        self.offsets = []
+        self.endianness = endianness # Little-endian by default
 
     def __enter__(self):
-        self.writer = io.BufferedWriter(self.raw)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.writer.close()
+        # Nothing is written if an error occurred, keeping existing files intact. Streams are left open for the caller
+        # owning them, e.g. to get the contents of a BytesIO.
+        if exc_type is None:
+            self.flush()
+
+    @property
+    def endianness(self):
+        return self._endianness
+
+    @endianness.setter
+    def endianness(self, value):
+        self._endianness = value
+        self.structs = _get_structs(value)
+
+    def flush(self):
+        # Write the final offsets into the buffer and the buffer into the stream, or a temporary file replacing the
+        # file at the path.
+        for offset in self.offsets:
+            self.structs.uint32.pack_into(self.buffer, offset.position, offset.value)
+        self.size = max(self.size, self.position)
+        with memoryview(self.buffer)[:self.size] as data:
+            if isinstance(self.raw, str):
+                with replace_file(self.raw) as file:
+                    file.write(data)
+            else:
+                self.raw.write(data)
 
     def reserve_offset(self):
         return Offset(self)
@@ -108,63 +220,147 @@ class BinaryWriter:
         offset.satisfy(self, value)
 
     def seek(self, offset, whence=io.SEEK_SET):
-        self.writer.seek(offset, whence)
+        self.size = max(self.size, self.position)
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = offset
+        return self.position
 
     def tell(self):
-        return self.writer.tell()
+        return self.position
+
+    def align(self, alignment):
+        # Pad the data with zeros up to the next multiple of the alignment.
+        self.position += -self.position % alignment
+        if self.position > len(self.buffer):
+            self._grow()
+
+    def write(self, record_struct, *values):
+        # Write the values of one record of the given struct, or a format without endianness.
+        if isinstance(record_struct, str):
+            record_struct = _get_struct(self._endianness + record_struct)
+        self._pack(record_struct, *values)
+
+    def write_array(self, value, dtype):
+        # Write all elements of an array, converting them to the given type in the endianness of the writer at once.
+        self.write_bytes(np.ascontiguousarray(value, np.dtype(dtype).newbyteorder(self._endianness)))
 
     def write_0_string(self, value, encoding):
-        self.write_raw_string(bytearray(value, encoding))
-        self.write_byte(0)
+        self.write_bytes(value.encode(encoding) + b"\0")
 
     def write_byte(self, value):
-        self.writer.write(struct.pack("B", value))
+        if self.position >= len(self.buffer):
+            self._grow(1)
+        self.buffer[self.position] = value
+        self.position += 1
 
     def write_bytes(self, value):
-        self.writer.write(value)
+        # Copy bytes-like objects, e.g. arrays, directly into the buffer.
+        if isinstance(value, np.ndarray):
+            value = value.reshape(-1).view(np.uint8)
+        with memoryview(value).cast("B") as data:
+            position = self.position
+            end = position + len(data)
+            if end > len(self.buffer) and self.size <= position <= len(self.buffer):
+                # Append data not fitting into the buffer directly instead of growing the buffer to copy it into.
+                del self.buffer[position:]
+                self.buffer += data
+            else:
+                if end > len(self.buffer):
+                    self.position = end
+                    self._grow()
+                self.buffer[position:end] = data
+            self.position = end
 
     def write_int32(self, value):
-        self.writer.write(struct.pack(self.endianness + "i", value))
+        position = self.position
+        self.position = position + 4
+        if self.position > len(self.buffer):
+            self._grow()
+        self.structs.int32.pack_into(self.buffer, position, value)
 
     def write_int32s(self, value):
-        self.writer.write(struct.pack(self.endianness + str(len(value)) + "i", *value))
+        self.write(str(len(value)) + "i", *value)
 
     def write_sbyte(self, value):
-        self.writer.write(struct.pack(self.endianness + "b", value))
+        position = self.position
+        self.position = position + 1
+        if self.position > len(self.buffer):
+            self._grow()
+        self.structs.sbyte.pack_into(self.buffer, position, value)
 
     def write_single(self, value):
-        self.writer.write(struct.pack(self.endianness + "f", value))
+        position = self.position
+        self.position = position + 4
+        if self.position > len(self.buffer):
+            self._grow()
+        self.structs.single.pack_into(self.buffer, position, value)
 
     def write_singles(self, value):
-        self.writer.write(struct.pack(self.endianness + str(len(value)) + "f", *value))
+        self.write(str(len(value)) + "f", *value)
 
     def write_uint16(self, value):
-        self.writer.write(struct.pack(self.endianness + "H", value))
+        position = self.position
+        self.position = position + 2
+        if self.position > len(self.buffer):
+            self._grow()
+        self.structs.uint16.pack_into(self.buffer, position, value)
 
     def write_uint16s(self, value):
-        self.writer.write(struct.pack(self.endianness + str(len(value)) + "H", *value))
+        self.write(str(len(value)) + "H", *value)
 
     def write_uint32(self, value):
-        self.writer.write(struct.pack(self.endianness + "I", value))
+        position = self.position
+        self.position = position + 4
+        if self.position > len(self.buffer):
+            self._grow()
+        self.structs.uint32.pack_into(self.buffer, position, value)
 
     def write_uint32s(self, value):
-        self.writer.write(struct.pack(self.endianness + str(len(value)) + "I", *value))
+        self.write(str(len(value)) + "I", *value)
 
     def write_raw_string(self, value, encoding="ascii"):
-        self.writer.write(bytearray(value, encoding))
+        self.write_bytes(value.encode(encoding))
+
+    def _pack(self, value_struct, *values):
+        position = self.position
+        self.position += value_struct.size
+        if self.position > len(self.buffer):
+            self._grow()
+        value_struct.pack_into(self.buffer, position, *values)
+
+    def _grow(self, count=0):
+        # Extend the buffer with zeros up to the position, in large steps to not do so for each value.
+        self.buffer.extend(bytes(max(self.position + count - len(self.buffer), 0x10000)))
 
 class Offset:
     def __init__(self, writer):
-        # Remember the position of the offset to change it later.
+        # Remember the position of the offset to write its final value when the writer is flushed.
         self.position = writer.tell()
-        # Write an empty offset for now.
         self.value = 0
         writer.write_uint32(self.value)
+        writer.offsets.append(self)
 
     def satisfy(self, writer, value):
         self.value = value
-        # Seek back temporarily to the offset position to write the final offset value.
-        current_position = writer.tell()
-        writer.seek(self.position)
-        writer.write_uint32(self.value)
-        writer.seek(current_position)
+
+@contextlib.contextmanager
+def replace_file(path):
+    # Open a uniquely named temporary file next to the file at the path, which replaces it once it is written without
+    # errors, or is removed otherwise. Concurrent writers never clash, and the file at the path is always complete.
+    file = tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp", delete=False)
+    try:
+        with file:
+            yield file
+        # Temporary files are only accessible by the user, so give it the permissions of the replaced or a new file.
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o666 & ~_UMASK
+        os.chmod(file.name, mode)
+        os.replace(file.name, path)
+    except BaseException:
+        os.remove(file.name)
+        raise
@@ -1,9 +1,11 @@
-import bmesh
 import bpy
 import bpy_extras
+import numpy as np
 import os
-from mathutils import Matrix
-from .kcl_file import KclFile
+from .kcl_cache import ParseCache
+from .kcl_file import KclFile, weld_vertices
+from .log import Log, Profiler
+from .szs_file import SarcFile
 
 class ImportOperator(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
     bl_idname = "import_scene.kcl"
@@ -12,12 +14,12 @@ class ImportOperator(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
 
     filename_ext = ".kcl"
     filter_glob = bpy.props.StringProperty(
-        default="*.kcl",
+        default="*.kcl;*.szs",
         options={"HIDDEN"}
     )
     filepath = bpy.props.StringProperty(
         name="File Path",
-        description="Filepath used for importing the KCL file",
+        description="Filepath used for importing the KCL file, or the SZS archive containing it",
         maxlen=1024,
         default=""
     )
@@ -27,6 +29,27 @@ class ImportOperator(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
         description="Merges the separate models into one.",
         default=True
     )
+    weld_vertices = bpy.props.BoolProperty(
+        name="Weld Vertices",
+        description="Merges the corners of triangles lying at the same position into shared vertices.",
+        default=False
+    )
+    weld_distance = bpy.props.FloatProperty(
+        name="Weld Distance",
+        description="The distance up to which corners are merged, also through the corners between them.",
+        min=0.000001,
+        default=0.01
+    )
+    use_cache = bpy.props.BoolProperty(
+        name="Use Cache",
+        description="Keeps the reconstructed triangles of imported files in a cache to import them faster again.",
+        default=False
+    )
+    profile = bpy.props.BoolProperty(
+        name="Profile",
+        description="Logs the time spent in each step of the import.",
+        default=False
+    )
 
     @staticmethod
     def menu_func_import(self, context):
@@ -44,36 +67,46 @@ class Importer:
         self.filename = os.path.basename(self.filepath)
 
     def run(self):
-        # Read in the file data.
-        with open(self.filepath, "rb") as raw:
-            kcl_file = KclFile(raw)
-        # Import the data into Blender objects.
-        self._convert(kcl_file)
+        Profiler.begin(self.operator.profile)
+        try:
+            cache = ParseCache() if self.operator.use_cache else None
+            if os.path.splitext(self.filepath)[1].lower() == ".szs":
+                # Read the KCL files straight out of the archive, only decompressing it up to their end.
+                archive = SarcFile.open(self.filepath)
+                names = [name for name in archive.names if name.lower().endswith(".kcl")]
+                if not names:
+                    raise AssertionError("The archive does not contain a KCL file.")
+                kcl_files = [KclFile(archive.read(name)) for name in names]
+                if cache is not None:
+                    kcl_files = [cache.load(kcl_file) for kcl_file in kcl_files]
+            elif cache is not None:
+                # Map the file and the cached triangles into memory.
+                kcl_files = [cache.open(self.filepath)]
+            else:
+                # Read in the file data.
+                with open(self.filepath, "rb") as raw:
+                    kcl_files = [KclFile(raw)]
+            if cache is not None:
+                Log.write(0, "Cache: {hits} hits, {misses} misses, {evictions} evictions, {entries} entries of {size} "
+                             "bytes.".format(**cache.stats()))
+            # Import the data into Blender objects.
+            for kcl_file in kcl_files:
+                with Profiler.phase("Mesh build"), kcl_file:
+                    self._convert(kcl_file)
+        finally:
+            Profiler.end()
         return {"FINISHED"}
 
     def _convert(self, kcl):
-        # Convert the models.
-        global_bm = None
-        for i in range(0, len(kcl.models)):
-            if self.operator.merge_models:
-                # Write all models into one global bmesh spanning them all.
-                if global_bm is None:
-                    global_bm = self._new_bmesh()
-                self._convert_model(global_bm, kcl, i)
-            else:
-                model_bm = self._new_bmesh()
-                self._convert_model(model_bm, kcl, i)
-                self._create_mesh_object(model_bm, "Model " + str(i).zfill(2))
-        # Create an object for merged models.
-        if self.operator.merge_models:
-            self._create_mesh_object(global_bm, "Model")
-
-    def _new_bmesh(self):
-        bm = bmesh.new()
-        bm.faces.layers.int.new("kcl_model_index")
-        bm.faces.layers.int.new("kcl_face_index")
-        bm.faces.layers.int.new("kcl_flags")
-        return bm
+        # Convert the models, only keeping one copy of triangles stored in several models when merging them.
+        unique = kcl.unique_triangles() if self.operator.merge_models else [None] * len(kcl.models)
+        models = [self._convert_model(kcl, i, unique[i]) for i in range(0, len(kcl.models))]
+        if self.operator.merge_models and models:
+            # Write all models into one global mesh spanning them all.
+            self._create_mesh_object([np.concatenate(arrays) for arrays in zip(*models)], "Model")
+        else:
+            for i, model in enumerate(models):
+                self._create_mesh_object(model, "Model " + str(i).zfill(2))
 
     def _add_to_group(self, ob, group_name):
         # Get or create the required group.
@@ -82,33 +115,52 @@ class Importer:
         if ob.name not in group.objects:
             group.objects.link(ob)
 
-    def _convert_model(self, bm, kcl, model_index):
-        # Get the additional data layers to keep track of the triangles for exporting.
-        model_index_layer = bm.faces.layers.int["kcl_model_index"]
-        face_index_layer = bm.faces.layers.int["kcl_face_index"]
-        flags_layer = bm.faces.layers.int["kcl_flags"]
-        # Add the model to the bmesh.
+    def _convert_model(self, kcl, model_index, unique=None):
+        # Return the corners of the triangles of the model and the additional data to keep track of them for exporting,
+        # skipping the triangles not in the unique mask if given.
         kcl_model = kcl.models[model_index]
-        for i, triangle in enumerate(kcl_model.triangles):
-            vertices = kcl_model.get_triangle_vertices(triangle)
-            vert1 = bm.verts.new(vertices[0])
-            vert2 = bm.verts.new(vertices[1])
-            vert3 = bm.verts.new(vertices[2])
-            face = bm.faces.new((vert1, vert2, vert3))
-            # Remember the model and face indices.
-            face[model_index_layer] = model_index
-            face[face_index_layer] = i
-            face[flags_layer] = triangle.collision_flags
-            # TODO: Assign a material visualizing the flags somehow.
+        vertices, degenerate = kcl_model.all_triangle_vertices()
+        if degenerate.any():
+            Log.write(0, "Skipping {} degenerate triangles in model {}.".format(degenerate.sum(), model_index))
+        face_indices = np.flatnonzero(~degenerate if unique is None else ~degenerate & unique).astype(np.int32)
+        model_indices = np.full(len(face_indices), model_index, np.int32)
+        flags = kcl_model.triangles.collision_flags[face_indices].astype(np.int32)
+        # TODO: Assign a material visualizing the flags somehow.
+        return vertices[face_indices], model_indices, face_indices, flags
 
-    def _create_mesh_object(self, bm, name):
-        # Transform the coordinate system so that Y is up.
-        matrix_y_to_z = Matrix(((1, 0, 0), (0, 0, -1), (0, 1, 0)))
-        bmesh.ops.transform(bm, matrix=matrix_y_to_z, verts=bm.verts)
-        # Create the mesh into which each bmesh will be written.
+    def _create_mesh_object(self, model, name):
+        vertices, model_indices, face_indices, flags = model
+        if self.operator.weld_vertices:
+            with Profiler.phase("Vertex welding"):
+                positions, indices = weld_vertices(vertices, self.operator.weld_distance)
+                # Triangles whose corners were merged into less than 3 vertices cannot be stored in the mesh.
+                valid = (indices[:, 0] != indices[:, 1]) & (indices[:, 1] != indices[:, 2]) \
+                    & (indices[:, 2] != indices[:, 0])
+                if not valid.all():
+                    Log.write(0, "Skipping {} triangles collapsed by welding in {}.".format((~valid).sum(), name))
+                    indices, model_indices, face_indices, flags = \
+                        indices[valid], model_indices[valid], face_indices[valid], flags[valid]
+        else:
+            # Give each triangle 3 separate vertices.
+            positions = vertices.reshape(-1, 3)
+            indices = np.arange(0, len(positions)).reshape(-1, 3)
+        # Transform the coordinate system so that Y is up, swapping the axes directly in the array.
+        co = positions[:, (0, 2, 1)]
+        co[:, 1] *= -1
+        # Create the mesh in bulk.
         mesh = bpy.data.meshes.new(name)
-        bm.to_mesh(mesh)
-        bm.free()
+        mesh.vertices.add(len(co))
+        mesh.vertices.foreach_set("co", co.astype(np.float32).ravel())
+        mesh.loops.add(indices.size)
+        mesh.loops.foreach_set("vertex_index", indices.astype(np.int32).ravel())
+        mesh.polygons.add(len(indices))
+        mesh.polygons.foreach_set("loop_start", np.arange(0, indices.size, 3, dtype=np.int32))
+        mesh.polygons.foreach_set("loop_total", np.full(len(indices), 3, np.int32))
+        # Remember the model and face indices and the flags in face layers, which are accessed through bmesh later on.
+        mesh.polygon_layers_int.new("kcl_model_index").data.foreach_set("value", model_indices)
+        mesh.polygon_layers_int.new("kcl_face_index").data.foreach_set("value", face_indices)
+        mesh.polygon_layers_int.new("kcl_flags").data.foreach_set("value", flags)
+        mesh.update(calc_edges=True)
         # Create, group and link an object representing that mesh.
         ob = bpy.data.objects.new(name, mesh)
         self._add_to_group(ob, "KCL")
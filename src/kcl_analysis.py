@@ -0,0 +1,160 @@
+import numpy as np
+
+# Upper bounds of the leaf list lengths counted together in the histogram.
+LEAF_LENGTH_BINS = (0, 4, 8, 16, 32, 64, 128)
+# Number of leaves referencing a triangle from which on it is reported as referenced by many leaves.
+MANY_REFERENCES = 8
+# Number of the most referenced triangles listed.
+TOP_REFERENCED = 5
+
+def analyze_file(kcl_file):
+    # Walk the octree of each model and return statistics about its shape, the lists of its leaves and the bytes taken
+    # by each section of the file.
+    stats = {
+        "models": len(kcl_file.models),
+        "triangles": 0,
+        "nodes": 0,
+        "leaves": 0,
+        "empty_leaves": 0,
+        "depth_histogram": {},
+        "leaf_length_histogram": {_bin_name(i): 0 for i in range(0, len(LEAF_LENGTH_BINS) + 1)},
+        "stored_lists": 0,
+        "shared_lists": 0,
+        "duplicate_lists": 0,
+        "duplicate_list_bytes": 0,
+        "sections": _get_section_sizes(kcl_file)
+    }
+    leaf_lengths = []
+    references = []
+    most_referenced = []
+    for model_index, kcl_model in enumerate(kcl_file.models):
+        octree = kcl_model.octree
+        stats["triangles"] += len(kcl_model.triangles)
+        stats["nodes"] += len(octree.is_leaf)
+        leaves = np.flatnonzero(octree.is_leaf)
+        stats["leaves"] += len(leaves)
+        counts = octree.count[leaves]
+        stats["empty_leaves"] += int((counts == 0).sum())
+        leaf_lengths.append(counts)
+        # Count the leaves on each level.
+        depths = _get_depths(octree)[leaves]
+        for depth, count in zip(*np.unique(depths, return_counts=True)):
+            stats["depth_histogram"][int(depth)] = stats["depth_histogram"].get(int(depth), 0) + int(count)
+        # Leaves pointing to the same list share it, while equal lists stored separately waste space.
+        stats["stored_lists"] += len(octree.lists)
+        stats["shared_lists"] += len(leaves) - len(octree.lists)
+        contents = {}
+        for start, count in octree.lists.values():
+            key = octree.triangles[start:start + count].tobytes()
+            if key in contents:
+                stats["duplicate_lists"] += 1
+                stats["duplicate_list_bytes"] += 2 * count + 2
+            contents[key] = True
+        # Count the leaves referencing each triangle.
+        model_references = np.bincount(np.concatenate([octree.leaf_triangles(leaf) for leaf in leaves])
+                                       if len(leaves) else np.zeros(0, np.intp), minlength=len(kcl_model.triangles))
+        references.append(model_references)
+        for triangle_index in np.argsort(-model_references, kind="stable")[:TOP_REFERENCED]:
+            most_referenced.append((int(model_references[triangle_index]), model_index, int(triangle_index)))
+    leaf_lengths = np.concatenate(leaf_lengths) if leaf_lengths else np.zeros(0, np.intp)
+    references = np.concatenate(references) if references else np.zeros(0, np.intp)
+    for i, count in enumerate(np.bincount(np.searchsorted(LEAF_LENGTH_BINS, leaf_lengths),
+                                          minlength=len(LEAF_LENGTH_BINS) + 1)):
+        stats["leaf_length_histogram"][_bin_name(i)] = int(count)
+    stats["max_depth"] = max(stats["depth_histogram"], default=0)
+    stats["mean_leaf_length"] = float(leaf_lengths.mean()) if len(leaf_lengths) else 0.0
+    stats["max_leaf_length"] = int(leaf_lengths.max()) if len(leaf_lengths) else 0
+    stats["mean_triangle_references"] = float(references.mean()) if len(references) else 0.0
+    stats["max_triangle_references"] = int(references.max()) if len(references) else 0
+    stats["unreferenced_triangles"] = int((references == 0).sum())
+    stats["many_referenced_triangles"] = int((references >= MANY_REFERENCES).sum())
+    stats["most_referenced"] = [{"model": model_index, "triangle": triangle_index, "leaves": count}
+                                for count, model_index, triangle_index in sorted(most_referenced,
+                                                                                 key=lambda item: -item[0])
+                                [:TOP_REFERENCED]]
+    return stats
+
+def format_report(stats, other=None):
+    # Return the lines of a table of the statistics, with the ones of another file and their difference next to them.
+    rows = []
+
+    def add(name, value, other_value=None):
+        if other is None:
+            rows.append((name, _format(value)))
+            return
+        change = ""
+        if isinstance(value, (int, float)) and isinstance(other_value, (int, float)) and value != other_value:
+            change = ("{:+.2f}" if isinstance(value, float) else "{:+d}").format(other_value - value)
+            if value:
+                change += " ({:+.0%})".format((other_value - value) / value)
+        rows.append((name, _format(value), _format(other_value), change))
+
+    def get(*keys):
+        # Return the value of the other file under the nested keys.
+        if other is None:
+            return None
+        value = other
+        for key in keys:
+            value = value.get(key, 0)
+        return value
+
+    for key in ("models", "triangles", "nodes", "leaves", "empty_leaves", "max_depth", "mean_leaf_length",
+                "max_leaf_length", "stored_lists", "shared_lists", "duplicate_lists", "duplicate_list_bytes",
+                "mean_triangle_references", "max_triangle_references", "unreferenced_triangles",
+                "many_referenced_triangles"):
+        add(key.replace("_", " ").capitalize(), stats[key], get(key))
+    depths = sorted(set(stats["depth_histogram"]) | set(other["depth_histogram"] if other else ()))
+    for depth in depths:
+        add("Leaves at depth {}".format(depth), stats["depth_histogram"].get(depth, 0),
+            get("depth_histogram", depth))
+    for name, count in stats["leaf_length_histogram"].items():
+        add("Leaves with {} triangles".format(name), count, get("leaf_length_histogram", name))
+    for name, size in stats["sections"].items():
+        add("Bytes of {}".format(name), size, get("sections", name))
+    widths = [max(len(row[i]) for row in rows) for i in range(0, len(rows[0]))]
+    lines = ["  ".join(cell.ljust(width) if i == 0 else cell.rjust(width) for i, (cell, width)
+                       in enumerate(zip(row, widths))).rstrip() for row in rows]
+    lines.append("Most referenced triangles (model, triangle: leaves):")
+    for item in stats["most_referenced"]:
+        lines.append("  {}, {}: {}".format(item["model"], item["triangle"], item["leaves"]))
+    return lines
+
+def _get_depths(octree):
+    # Return the level of each node, walking down from the root cubes one level at a time.
+    depths = np.zeros(len(octree.is_leaf), np.intp)
+    nodes = np.arange(0, np.prod(octree.divisions))
+    depth = 0
+    while len(nodes):
+        depths[nodes] = depth
+        branches = nodes[~octree.is_leaf[nodes]]
+        nodes = (octree.first[branches, np.newaxis] + np.arange(0, 8)).reshape(-1)
+        depth += 1
+    return depths
+
+def _get_section_sizes(kcl_file):
+    # Sum up the bytes between the starts of the sections of the file, each ending where the next one starts.
+    starts = [(0, "header"), (kcl_file.header.model_octree_offset, "model octree"),
+              (kcl_file.header.model_offset_array_offset, "model offsets")]
+    for offset, kcl_model in zip(kcl_file.model_offsets, kcl_file.models):
+        header = kcl_model.header
+        starts.extend(((offset, "model headers"), (header.positions_offset, "positions"),
+                       (header.normals_offset, "normals"), (header.triangles_offset, "triangles"),
+                       (header.octree_offset, "octrees")))
+    sizes = dict.fromkeys(("header", "model octree", "model offsets", "model headers", "positions", "normals",
+                           "triangles", "octrees"), 0)
+    starts.sort()
+    for (offset, name), (end, next_name) in zip(starts, starts[1:] + [(len(kcl_file.data), None)]):
+        sizes[name] += end - offset
+    return sizes
+
+def _bin_name(index):
+    if index == 0:
+        return "0"
+    if index == len(LEAF_LENGTH_BINS):
+        return ">{}".format(LEAF_LENGTH_BINS[-1])
+    return "{}-{}".format(LEAF_LENGTH_BINS[index - 1] + 1, LEAF_LENGTH_BINS[index])
+
+def _format(value):
+    if value is None:
+        return ""
+    return "{:.2f}".format(value) if isinstance(value, float) else str(value)
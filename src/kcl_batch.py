@@ -0,0 +1,122 @@
+import contextlib
+import glob
+import io
+import multiprocessing
+import numpy as np
+import os
+import time
+import traceback
+from .kcl_writer import KclWriter
+from .log import Profiler
+from .obj_file import write_obj
+from .szs_file import open_kcl
+
+ACTIONS = ("validate", "to-obj", "rebuild")
+
+def find_files(patterns):
+    # Expand directories to the KCL files and SZS archives in them and patterns to the files they match, keeping the
+    # order stable.
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths.extend(sorted(glob.glob(os.path.join(pattern, "**", "*.kcl"), recursive=True)
+                                + glob.glob(os.path.join(pattern, "**", "*.szs"), recursive=True)))
+        else:
+            paths.extend(sorted(glob.glob(pattern, recursive=True)) or [pattern])
+    return list(dict.fromkeys(paths))
+
+def run_batch(paths, action, output_dir=None, processes=0, writer_args=None):
+    # Process the files in a pool of workers, yielding the result of each file as soon as it is done. Each worker only
+    # holds the file it currently processes, so at most one file per process is in memory at any time.
+    if action not in ACTIONS:
+        raise AssertionError("Unknown batch action '{}'.".format(action))
+    if action == "rebuild" and output_dir is None:
+        raise AssertionError("Rebuilt files require an output directory to not overwrite the files being read.")
+    if processes == 0:
+        processes = os.cpu_count() or 1
+    # Keep the directory structure of the files in the output directory, as game dumps often reuse file names.
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths]) if paths else None
+    tasks = [(path, action, output_dir, root, writer_args or {}) for path in paths]
+    if processes == 1 or len(tasks) <= 1:
+        for result in map(_process_file, tasks):
+            yield _merge_counters(result)
+        return
+    # Start the workers with empty counters, as forked ones inherit the ones of this process.
+    with multiprocessing.Pool(min(processes, len(tasks)), Profiler.begin, (Profiler.enabled,)) as pool:
+        for result in pool.imap_unordered(_process_file, tasks):
+            yield _merge_counters(result)
+
+def _process_file(task):
+    path, action, output_dir, root, writer_args = task
+    result = {"file": path, "action": action}
+    start = time.perf_counter()
+    log = io.StringIO()
+    try:
+        # Capture the log of the writer, as the results are streamed through the same output.
+        with contextlib.redirect_stdout(log), open_kcl(path) as kcl_file:
+            result["models"] = len(kcl_file.models)
+            result["triangles"] = sum(len(kcl_model.triangles) for kcl_model in kcl_file.models)
+            result["degenerate"] = _validate(kcl_file)
+            if action == "to-obj":
+                result["output"] = _output_path(path, output_dir, root, ".obj")
+                with open(result["output"], "w") as file:
+                    write_obj(file, kcl_file)
+            elif action == "rebuild":
+                result["output"] = _output_path(path, output_dir, root, ".kcl")
+                _rebuild(kcl_file, result["output"], writer_args)
+    except Exception as e:
+        result["error"] = "".join(traceback.format_exception_only(type(e), e)).strip()
+    result["seconds"] = time.perf_counter() - start
+    # The counters are sent back with the result, as the ones of worker processes would be lost otherwise.
+    result["counters"] = Profiler.take_counters()
+    if log.getvalue():
+        result["log"] = log.getvalue().splitlines()
+    return result
+
+def _merge_counters(result):
+    # Add the counters recorded while processing the file to the ones of this process.
+    Profiler.add_counters(result.pop("counters"))
+    return result
+
+def _validate(kcl_file):
+    # Check that all indices of the triangles are in range and return the number of degenerate triangles.
+    degenerate_count = 0
+    for i, kcl_model in enumerate(kcl_file.models):
+        triangles = kcl_model.triangles
+        if not len(triangles):
+            continue
+        if triangles.position_index.max() >= len(kcl_model.positions):
+            raise AssertionError("Model {} references positions out of range.".format(i))
+        for field in ("direction_index", "normal_a_index", "normal_b_index", "normal_c_index"):
+            if triangles[field].max() >= len(kcl_model.normals):
+                raise AssertionError("Model {} references normals out of range.".format(i))
+        degenerate_count += int(kcl_model.all_triangle_vertices()[1].sum())
+    return degenerate_count
+
+def _rebuild(kcl_file, filepath, writer_args):
+    # Write the triangles of all models into a new file, rebuilding its models and octrees. Triangles stored in several
+    # models are only kept once.
+    vertices, normals, collision_flags = [], [], []
+    for kcl_model, unique in zip(kcl_file.models, kcl_file.unique_triangles()):
+        model_vertices, degenerate = kcl_model.all_triangle_vertices()
+        keep = ~degenerate & unique
+        triangles = kcl_model.triangles[keep]
+        vertices.append(model_vertices[keep])
+        normals.append(kcl_model.normals[triangles.direction_index].astype(np.float32))
+        collision_flags.append(triangles.collision_flags)
+    writer = KclWriter(**writer_args)
+    writer.write(filepath, np.concatenate(vertices), np.concatenate(normals),
+                 np.concatenate(collision_flags))
+
+def _output_path(path, output_dir, root, extension):
+    name = os.path.splitext(os.path.basename(path))[0] + extension
+    if output_dir is None:
+        return os.path.join(os.path.dirname(path), name)
+    # Files in the root itself would otherwise be written to paths like out/./course.obj.
+    output_dir = os.path.normpath(os.path.join(output_dir, os.path.relpath(os.path.dirname(os.path.abspath(path)),
+                                                                           root)))
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, name)
+    if os.path.abspath(output_path) == os.path.abspath(path):
+        raise AssertionError("The output file would overwrite the file being read.")
+    return output_path
@@ -0,0 +1,140 @@
+import hashlib
+import numpy as np
+import os
+import shutil
+import time
+from .kcl_file import KclFile
+from .log import Profiler
+
+class ParseCache:
+    # On-disk cache of the triangle corners reconstructed from KCL files, keyed by a hash of the file contents. The other
+    # sections are mapped straight from the file anyway, so only the reconstruction is stored, as arrays which are
+    # mapped into memory again on a hit. The least recently used entries are evicted once the size limit is exceeded.
+    # The version is part of the keys, so that entries stored differently by older versions are never used.
+    VERSION = 1
+    # Seconds after which temporary directories of entries still being stored are assumed to be left behind by a
+    # process which crashed, and are removed.
+    STALE_AGE = 3600
+
+    def __init__(self, directory=None, max_size=512 * 2 ** 20):
+        self.directory = directory or self.default_directory()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def default_directory():
+        return os.environ.get("KCL_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "io_scene_kcl")
+
+    def open(self, filepath):
+        # Map the file into memory and give its models the triangle corners from the cache.
+        kcl_file = KclFile.open_mmap(filepath)
+        try:
+            return self.load(kcl_file)
+        except Exception:
+            kcl_file.close()
+            raise
+
+    def load(self, kcl_file):
+        # Give the models of an opened file the triangle corners from the cache, reconstructing and storing them if the
+        # file is not cached yet.
+        with Profiler.phase("Cache lookup"):
+            key = hashlib.sha1("v{}:".format(self.VERSION).encode("ascii"))
+            key.update(kcl_file.data)
+            entry = os.path.join(self.directory, key.hexdigest())
+            vertices = self._load(entry, len(kcl_file.models))
+        if vertices is None:
+            self.misses += 1
+            vertices = [kcl_model.all_triangle_vertices() for kcl_model in kcl_file.models]
+            with Profiler.phase("Cache store"):
+                self._store(entry, vertices)
+        else:
+            self.hits += 1
+        for kcl_model, model_vertices in zip(kcl_file.models, vertices):
+            kcl_model.triangle_vertices = model_vertices
+        return kcl_file
+
+    def stats(self):
+        # Return the hits, misses and evictions of this instance and the entries and bytes stored in the cache.
+        entries = self._get_entries()
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": len(entries),
+                "size": sum(size for path, time, size in entries)}
+
+    def clear(self):
+        for path, time, size in self._get_entries():
+            shutil.rmtree(path, ignore_errors=True)
+
+    def _load(self, entry, model_count):
+        # Map the arrays of an entry, marking it as used, or return None if it is missing or incomplete.
+        if not os.path.isdir(entry):
+            return None
+        try:
+            vertices = [(self._map(os.path.join(entry, "vertices_{}.npy".format(i))),
+                         self._map(os.path.join(entry, "degenerate_{}.npy".format(i)))) for i in range(0, model_count)]
+            os.utime(entry)
+        except (OSError, ValueError):
+            shutil.rmtree(entry, ignore_errors=True)
+            return None
+        return vertices
+
+    @staticmethod
+    def _map(path):
+        try:
+            return np.load(path, mmap_mode="r")
+        except ValueError:
+            # Empty arrays cannot be mapped.
+            return np.load(path)
+
+    def _store(self, entry, vertices):
+        # Write the arrays into a temporary directory first, so that other processes never see a partial entry.
+        os.makedirs(self.directory, exist_ok=True)
+        temporary = "{}.{}.tmp".format(entry, os.getpid())
+        os.makedirs(temporary, exist_ok=True)
+        try:
+            for i, (model_vertices, degenerate) in enumerate(vertices):
+                np.save(os.path.join(temporary, "vertices_{}.npy".format(i)), model_vertices)
+                np.save(os.path.join(temporary, "degenerate_{}.npy".format(i)), degenerate)
+            os.replace(temporary, entry)
+        except OSError:
+            # Another process stored the same file in the meantime.
+            shutil.rmtree(temporary, ignore_errors=True)
+        self._evict()
+
+    def _evict(self):
+        # Remove the least recently used entries until the cache fits into its size limit.
+        self._remove_stale_temporaries()
+        entries = sorted(self._get_entries(), key=lambda entry: entry[1])
+        size = sum(size for path, time, size in entries)
+        for path, time, entry_size in entries:
+            if size <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            size -= entry_size
+            self.evictions += 1
+
+    def _remove_stale_temporaries(self):
+        stale_time = time.time() - self.STALE_AGE
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if name.endswith(".tmp") and os.path.getmtime(path) < stale_time:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass # Stored or removed by another process meanwhile.
+
+    def _get_entries(self):
+        # Return the path, last use and size of each complete entry.
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".tmp") or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path, file)) for file in os.listdir(path))
+                entries.append((path, os.path.getmtime(path), size))
+            except OSError:
+                pass # Removed by another process meanwhile.
+        return entries
@@ -0,0 +1,225 @@
+import numpy as np
+from .log import Profiler
+
+# Offsets of the 8 child cubes in the order they are stored in.
+_OCTANTS = np.array([(x, y, z) for z in range(0, 2) for y in range(0, 2) for x in range(0, 2)], np.intp)
+# Number of queries traversing the octree together, bounding the memory of the query and cube pairs.
+_CHUNK_SIZE = 1024
+
+class CollisionMesh:
+    # Batched ray casts and sphere sweeps against one model. The octree of the model is traversed for all queries at
+    # once level by level, and triangles are tested with their stored plane and edge normals like the game does.
+    def __init__(self, kcl_model, tolerance=1e-3):
+        self.kcl_model = kcl_model
+        self.tolerance = tolerance
+        self.octree = kcl_model.octree
+        triangles = kcl_model.triangles
+        normals = kcl_model.normals.astype(np.float64)
+        self.positions = kcl_model.positions.astype(np.float64)[triangles.position_index]
+        self.directions = normals[triangles.direction_index]
+        self.normals_a = normals[triangles.normal_a_index]
+        self.normals_b = normals[triangles.normal_b_index]
+        self.normals_c = normals[triangles.normal_c_index]
+        self.lengths = triangles.length.astype(np.float64)
+        self.collision_flags = np.array(triangles.collision_flags, np.uint16)
+        vertices, self.degenerate = kcl_model.all_triangle_vertices()
+        self.vertices = vertices.astype(np.float64)
+
+    def cast_rays(self, origins, directions, max_distances=np.inf):
+        # Return the distance to the first triangle hit by each ray, its index and its collision flags, being infinity,
+        # -1 and 0 for rays hitting nothing. Rays hit triangles from both sides.
+        return self._query(origins, directions, 0, max_distances)
+
+    def sweep_spheres(self, origins, directions, radii, max_distances=np.inf):
+        # Return the distance each sphere moves until it touches a triangle, the index of that triangle and its
+        # collision flags, being infinity, -1 and 0 for spheres touching nothing. Spheres already touching a triangle
+        # at their origin report a distance of 0.
+        return self._query(origins, directions, radii, max_distances)
+
+    def _query(self, origins, directions, radii, max_distances):
+        origins = np.asarray(origins, np.float64).reshape(-1, 3)
+        directions = np.asarray(directions, np.float64).reshape(-1, 3)
+        directions = directions / np.linalg.norm(directions, axis=1, keepdims=True)
+        radii = np.broadcast_to(np.asarray(radii, np.float64), len(origins))
+        max_distances = np.broadcast_to(np.asarray(max_distances, np.float64), len(origins))
+        distances = np.full(len(origins), np.inf)
+        indices = np.full(len(origins), -1, np.intp)
+        with Profiler.phase("Collision queries"):
+            for start in range(0, len(origins), _CHUNK_SIZE):
+                chunk = slice(start, start + _CHUNK_SIZE)
+                distances[chunk], indices[chunk] = self._query_chunk(origins[chunk], directions[chunk], radii[chunk],
+                                                                     max_distances[chunk])
+        collision_flags = np.where(indices >= 0, self.collision_flags[indices], 0).astype(np.uint16)
+        return distances, indices, collision_flags
+
+    def _query_chunk(self, origins, directions, radii, max_distances):
+        queries, triangles = self._find_candidates(origins, directions, radii, max_distances)
+        if Profiler.enabled:
+            Profiler.count("Collision triangle tests", len(triangles))
+        o, d, r = origins[queries], directions[queries], radii[queries]
+        t = self._intersect_faces(o, d, r, triangles)
+        if r.any():
+            # Spheres can also touch the edges or corners of a triangle without touching its face.
+            sphere = np.flatnonzero(r > 0)
+            vertices = self.vertices[triangles[sphere]]
+            for i in range(0, 3):
+                t[sphere] = np.fmin(t[sphere], _sweep_point(o[sphere], d[sphere], r[sphere], vertices[:, i]))
+                t[sphere] = np.fmin(t[sphere], _sweep_segment(o[sphere], d[sphere], r[sphere], vertices[:, i],
+                                                              vertices[:, (i + 1) % 3]))
+        hit = np.isfinite(t) & (t <= max_distances[queries]) & ~self.degenerate[triangles]
+        queries, triangles, t = queries[hit], triangles[hit], t[hit]
+        # Keep the closest hit of each query.
+        order = np.lexsort((t, queries))
+        queries, first = np.unique(queries[order], return_index=True)
+        distances = np.full(len(origins), np.inf)
+        indices = np.full(len(origins), -1, np.intp)
+        distances[queries] = t[order][first]
+        indices[queries] = triangles[order][first]
+        return distances, indices
+
+    def _find_candidates(self, origins, directions, radii, max_distances):
+        # Return the pairs of queries and triangles in the leaves the queries pass through, widening the cubes by the
+        # sphere radii. All cubes of one level have the same width, so each level is tested in one go.
+        octree = self.octree
+        with np.errstate(divide="ignore"):
+            inverse = 1 / directions
+        radii = radii[:, np.newaxis]
+
+        def overlap(queries, mins, width):
+            return _overlap_slabs(origins[queries], inverse[queries], mins - radii[queries],
+                                  mins + (width + radii[queries]), max_distances[queries])
+
+        # Find the root cubes through a virtual octree halving their grid on each level, so queries only test the few
+        # root cubes they pass through.
+        divisions = np.array(octree.divisions)
+        levels = int(divisions.max() - 1).bit_length()
+        width = 2.0 ** (octree.cube_exponent + levels)
+        queries = np.arange(len(origins))
+        cells = np.zeros((len(origins), 3), np.intp)
+        for level in range(levels, -1, -1):
+            inside = overlap(queries, octree.base + cells * width, width)
+            queries, cells = queries[inside], cells[inside]
+            if level == 0:
+                break
+            width /= 2
+            queries = np.repeat(queries, 8)
+            cells = (2 * cells[:, np.newaxis] + _OCTANTS).reshape(-1, 3)
+            inside = (cells < np.maximum(divisions >> (level - 1), 1)).all(axis=1)
+            queries, cells = queries[inside], cells[inside]
+        nodes = (cells[:, 2] * divisions[1] + cells[:, 1]) * divisions[0] + cells[:, 0]
+        mins = octree.base + cells * width
+        # Descend the octree of the model from the root cubes.
+        leaf_queries, leaf_nodes = [queries[:0]], [nodes[:0]]
+        while len(nodes):
+            leaf = octree.is_leaf[nodes]
+            leaf_queries.append(queries[leaf])
+            leaf_nodes.append(nodes[leaf])
+            branch = ~leaf
+            width /= 2
+            queries = np.repeat(queries[branch], 8)
+            mins = (mins[branch, np.newaxis] + _OCTANTS * width).reshape(-1, 3)
+            nodes = (octree.first[nodes[branch], np.newaxis] + np.arange(0, 8)).reshape(-1)
+            inside = overlap(queries, mins, width)
+            queries, nodes, mins = queries[inside], nodes[inside], mins[inside]
+        leaf_queries = np.concatenate(leaf_queries)
+        leaf_nodes = np.concatenate(leaf_nodes)
+        # Expand each leaf into the triangles of its list.
+        counts = octree.count[leaf_nodes]
+        ends = np.cumsum(counts)
+        offsets = np.repeat(octree.first[leaf_nodes] - (ends - counts), counts)
+        triangles = octree.triangles[offsets + np.arange(0, ends[-1] if len(ends) else 0)]
+        queries = np.repeat(leaf_queries, counts)
+        # Leaves often share triangles, which only need to be tested once.
+        pairs = np.unique(queries * len(self.positions) + triangles)
+        return pairs // len(self.positions), pairs % len(self.positions)
+
+    def _intersect_faces(self, origins, directions, radii, triangles):
+        # Return the distance at which the spheres touch the planes within the edges of the triangles, or infinity.
+        position = self.positions[triangles]
+        normal = self.directions[triangles]
+        offset = _dot(origins - position, normal)
+        speed = _dot(directions, normal)
+        side = np.where(offset < 0, -1.0, 1.0)
+        # Spheres already overlapping the plane touch it right away.
+        touching = np.abs(offset) <= radii
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = np.where(touching, 0, (np.abs(offset) - radii) / (-speed * side))
+        t[~touching & (-speed * side <= 1e-12)] = np.inf
+        t[t < 0] = np.inf
+        finite = np.isfinite(t)
+        contact = origins + directions * np.where(finite, t, 0)[:, np.newaxis]
+        contact -= normal * np.where(touching, offset, side * radii)[:, np.newaxis]
+        contact -= position
+        tolerance = self.tolerance
+        inside = (_dot(contact, self.normals_a[triangles]) <= tolerance) \
+            & (_dot(contact, self.normals_b[triangles]) <= tolerance) \
+            & (_dot(contact, self.normals_c[triangles]) <= self.lengths[triangles] + tolerance)
+        return np.where(finite & inside, t, np.inf)
+
+class CollisionWorld:
+    # Batched ray casts and sphere sweeps against all models of a file, reporting the closest hit of any model.
+    def __init__(self, kcl_file, tolerance=1e-3):
+        self.meshes = [CollisionMesh(kcl_model, tolerance) for kcl_model in kcl_file.models]
+
+    def cast_rays(self, origins, directions, max_distances=np.inf):
+        # Return the distances, model indices, triangle indices and collision flags of the first hits of the rays.
+        return self._combine([mesh.cast_rays(origins, directions, max_distances) for mesh in self.meshes])
+
+    def sweep_spheres(self, origins, directions, radii, max_distances=np.inf):
+        # Return the distances, model indices, triangle indices and collision flags of the first sphere contacts.
+        return self._combine([mesh.sweep_spheres(origins, directions, radii, max_distances) for mesh in self.meshes])
+
+    @staticmethod
+    def _combine(results):
+        distances = np.stack([result[0] for result in results])
+        model_indices = distances.argmin(axis=0)
+        columns = np.arange(distances.shape[1])
+        hit = np.isfinite(distances[model_indices, columns])
+        indices = np.stack([result[1] for result in results])[model_indices, columns]
+        collision_flags = np.stack([result[2] for result in results])[model_indices, columns]
+        return distances[model_indices, columns], np.where(hit, model_indices, -1), indices, collision_flags
+
+def _dot(a, b):
+    return np.einsum("ij,ij->i", a, b)
+
+def _overlap_slabs(origins, inverse, box_mins, box_maxs, max_distances):
+    # Return a mask of the rays entering their box before their maximum distance.
+    with np.errstate(invalid="ignore"):
+        t1 = (box_mins - origins) * inverse
+        t2 = (box_maxs - origins) * inverse
+    # Axes the ray runs parallel to within a box result in NaN and do not limit the range.
+    enter = np.where(np.isnan(t1), -np.inf, np.fmin(t1, t2)).max(axis=1)
+    leave = np.where(np.isnan(t1), np.inf, np.fmax(t1, t2)).min(axis=1)
+    enter = np.maximum(enter, 0)
+    return (enter <= leave) & (enter <= max_distances)
+
+def _sweep_point(origins, directions, radii, points):
+    # Return the distance at which the spheres touch the points, or infinity.
+    m = origins - points
+    b = _dot(m, directions)
+    c = _dot(m, m) - radii * radii
+    discriminant = b * b - c
+    with np.errstate(invalid="ignore"):
+        t = -b - np.sqrt(discriminant)
+    t = np.where(c <= 0, 0, t)
+    return np.where((discriminant >= 0) & (t >= 0), t, np.inf)
+
+def _sweep_segment(origins, directions, radii, starts, ends):
+    # Return the distance at which the spheres touch the segments between their ends, or infinity. Contacts at the
+    # ends are found by the point sweeps.
+    edge = ends - starts
+    m = origins - starts
+    edge_length = _dot(edge, edge)
+    md = _dot(m, edge)
+    nd = _dot(directions, edge)
+    a = edge_length - nd * nd
+    b = edge_length * _dot(m, directions) - nd * md
+    c = edge_length * (_dot(m, m) - radii * radii) - md * md
+    discriminant = b * b - a * c
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = (-b - np.sqrt(discriminant)) / a
+    # Spheres starting within the infinite cylinder around the segment already touch it.
+    t = np.where(c <= 0, 0, t)
+    s = md + t * nd
+    valid = (a > 1e-12) & (discriminant >= 0) & (t >= 0) & (s >= 0) & (s <= edge_length)
+    return np.where(valid, t, np.inf)
@@ -1,6 +1,10 @@
+import collections.abc
+import heapq
 import io
-from mathutils import Vector
+import mmap
+import numpy as np
 from .binary_io import BinaryReader
+from .log import Profiler
 
 class KclFile:
     class Header:
@@ -15,19 +19,186 @@ class KclFile:
             self.coordinate_shift = reader.read_vector3() # Unsure
             self.unknown0x34 = reader.read_uint32()
 
+    class ModelList(collections.abc.Sequence):
+        # Sequence decoding each model the first time it is accessed.
+        def __init__(self, kcl_file):
+            self.kcl_file = kcl_file
+            self.models = [None] * len(kcl_file.model_offsets)
+
+        def __len__(self):
+            return len(self.models)
+
+        def __getitem__(self, index):
+            if isinstance(index, slice):
+                return [self[i] for i in range(*index.indices(len(self)))]
+            model = self.models[index]
+            if model is None:
+                model = KclModel(self.kcl_file.data, self.kcl_file.model_offsets[index])
+                self.models[index] = model
+            return model
+
+        def clear(self):
+            self.models = [None] * len(self.models)
+
     def __init__(self, raw):
-        # Open a big-endian binary reader on the stream.
-        with BinaryReader(raw) as reader:
-            reader.endianness = ">"
+        # Read a stream into memory, but keep buffers (e.g. memory maps) to map the model sections onto them directly.
+        with Profiler.phase("File read"):
+            self.data = raw.read() if isinstance(raw, io.IOBase) else raw
+        self.mmap = None
+        self._model_octree = None
+        self._triangle_groups = None
+        # Open a big-endian binary reader on the data.
+        with Profiler.phase("Header parse"), BinaryReader(self.data, ">") as reader:
             self.header = self.Header(reader)
             # Load the model offset list.
             reader.seek(self.header.model_offset_array_offset)
             self.model_offsets = reader.read_uint32s(self.header.model_count)
-            # Load the models.
-            self.models = []
-            for i in range(0, len(self.model_offsets)):
-                reader.seek(self.model_offsets[i])
-                self.models.append(KclModel(reader))
+        # The models are only decoded when accessed.
+        self.models = self.ModelList(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @classmethod
+    def open_mmap(cls, filepath, writable=False):
+        # Map the file into memory, so only the pages of accessed sections are read. If writable, changes to the model
+        # arrays are written back into the file.
+        with open(filepath, "r+b" if writable else "rb") as raw:
+            data = mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        kcl_file = cls(data)
+        kcl_file.mmap = data
+        return kcl_file
+
+    @property
+    def model_octree(self):
+        # Decode the octree splitting the world into models when it is used the first time, as nested lists of 8
+        # children with the model indices as leaves.
+        if self._model_octree is None:
+            self._model_octree = self._read_model_octree(self.header.model_octree_offset)
+        return self._model_octree
+
+    def model_at(self, point):
+        # Return the index of the model whose cube contains the point, or None if it lies outside of the world.
+        position = np.asarray(point, np.float64) - np.asarray(self.header.min_model_coordinate, np.float64)
+        size = np.array([2.0 ** shift for shift in self.header.coordinate_shift])
+        if (position < 0).any() or (position >= size).any():
+            return None
+        node = self.model_octree
+        while isinstance(node, list):
+            size /= 2
+            octant = position >= size
+            position -= octant * size
+            node = node[octant[0] + 2 * octant[1] + 4 * octant[2]]
+        return node
+
+    def triangles_at(self, point):
+        # Return the model and triangle indices of the triangles in the octree cube containing the point.
+        model_index = self.model_at(point)
+        if model_index is None:
+            return []
+        return [(model_index, j) for j in self.models[model_index].triangles_at(point).tolist()]
+
+    def triangles_in_box(self, box_min, box_max):
+        # Return the model and triangle indices of the triangles in the octree cubes and bounds overlapping the box.
+        return [(i, j) for i, kcl_model in enumerate(self.models)
+                for j in kcl_model.triangles_in_box(box_min, box_max).tolist()]
+
+    def ray_cast(self, origin, direction, max_distance=np.inf):
+        # Return the model and triangle index of the first triangle hit by the ray and the distance to it, or None.
+        best = None
+        for i, kcl_model in enumerate(self.models):
+            hit = kcl_model.ray_cast(origin, direction, max_distance if best is None else best[2])
+            if hit is not None:
+                best = (i, hit[0], hit[1])
+        return best
+
+    def unique_triangles(self):
+        # Return a mask for each model being False for triangles which are copies of one in an earlier model. Models
+        # split from one mesh all store the triangles spanning several of them.
+        groups = self._get_triangle_groups()
+        first = np.zeros(sum(len(model_groups) for model_groups in groups), bool)
+        first[np.unique(np.concatenate(groups) if groups else np.zeros(0, np.intp), return_index=True)[1]] = True
+        return np.split(first, np.cumsum([len(model_groups) for model_groups in groups])[:-1])
+
+    def update_collision_flags(self, model_indices, triangle_indices, collision_flags):
+        # Change the collision flags of the given triangles of the models which differ from the current ones, together
+        # with the copies of them in other models. Copies still holding the current flags do not undo the changes of
+        # other ones. The flags are written in the order of the triangles to touch each page of a mapped file only
+        # once. Returns the number of changed triangles, including copies.
+        triangle_indices = np.asarray(triangle_indices, np.intp).reshape(-1)
+        model_indices = np.broadcast_to(np.asarray(model_indices, np.intp), triangle_indices.shape)
+        collision_flags = np.broadcast_to(np.asarray(collision_flags, np.uint16), triangle_indices.shape)
+        # Find the groups of copies of the triangles whose flags change.
+        groups = self._get_triangle_groups()
+        requested = np.zeros(len(triangle_indices), np.intp)
+        changed = np.zeros(len(triangle_indices), bool)
+        for model_index in np.unique(model_indices).tolist():
+            in_model = np.flatnonzero(model_indices == model_index)
+            indices = triangle_indices[in_model]
+            requested[in_model] = groups[model_index][indices]
+            changed[in_model] = self.models[model_index].triangles.collision_flags[indices] != collision_flags[in_model]
+        if not changed.any():
+            return 0
+        changed_groups, first = np.unique(requested[changed], return_index=True)
+        group_flags = collision_flags[changed][first]
+        count = 0
+        for model_index, model_groups in enumerate(groups):
+            position = np.minimum(np.searchsorted(changed_groups, model_groups), len(changed_groups) - 1)
+            indices = np.flatnonzero(changed_groups[position] == model_groups)
+            if not len(indices):
+                continue
+            triangles = self.models[model_index].triangles
+            flags = group_flags[position[indices]]
+            differ = triangles.collision_flags[indices] != flags
+            triangles.collision_flags[indices[differ]] = flags[differ]
+            count += int(differ.sum())
+        return count
+
+    def _get_triangle_groups(self):
+        # Return the index of the group of equal triangles for each triangle of each model. Copies of a triangle share
+        # its global index and stored values, while its positions and normals are indexed differently in each model.
+        if self._triangle_groups is None:
+            if len(self.models) == 1:
+                self._triangle_groups = [np.arange(len(self.models[0].triangles))]
+                return self._triangle_groups
+            keys = []
+            for kcl_model in self.models:
+                triangles = kcl_model.triangles
+                normals = kcl_model.normals
+                words = np.concatenate((
+                    triangles.global_index.astype(np.float64)[:, np.newaxis],
+                    triangles.length.astype(np.float64)[:, np.newaxis],
+                    kcl_model.positions[triangles.position_index],
+                    normals[triangles.direction_index], normals[triangles.normal_a_index],
+                    normals[triangles.normal_b_index], normals[triangles.normal_c_index]), axis=1)
+                keys.append(np.ascontiguousarray(words, np.float64))
+            keys = np.concatenate(keys)
+            keys = keys.view(np.dtype((np.void, keys.shape[1] * keys.itemsize))).reshape(-1)
+            groups = np.unique(keys, return_inverse=True)[1].reshape(-1)
+            self._triangle_groups = np.split(groups, np.cumsum([len(kcl_model.triangles)
+                                                                for kcl_model in self.models])[:-1])
+        return self._triangle_groups
+
+    def _read_model_octree(self, address):
+        # Branches store the offset to the block of their children relative to their own block.
+        return [value & 0x7FFFFFFF if value & 0x80000000 else self._read_model_octree(address + value)
+                for value in np.frombuffer(self.data, ">u4", 8, address).tolist()]
+
+    def flush(self):
+        if self.mmap:
+            self.mmap.flush()
+
+    def close(self):
+        if self.mmap:
+            self.models.clear()
+            try:
+                self.mmap.close()
+            except BufferError:
+                pass # Model arrays are still referenced elsewhere and keep the map open until they are released.
+            self.mmap = None
 
 class KclModel:
     class Header:
@@ -44,130 +215,452 @@ class KclModel:
             self.unknown0x38 = reader.read_single()
 
     class Triangle:
-        def __init__(self, reader):
-            self.length = reader.read_single()
-            self.position_index = reader.read_uint16()
-            self.direction_index = reader.read_uint16()
-            self.normal_a_index = reader.read_uint16()
-            self.normal_b_index = reader.read_uint16()
-            self.normal_c_index = reader.read_uint16()
-            self.collision_flags = reader.read_uint16()
-            self.global_index = reader.read_uint32()
-
-        def write(self, writer):
-            writer.write_single(self.length)
-            writer.write_uint16(self.position_index)
-            writer.write_uint16(self.direction_index)
-            writer.write_uint16(self.normal_a_index)
-            writer.write_uint16(self.normal_b_index)
-            writer.write_uint16(self.normal_c_index)
-            writer.write_uint16(self.collision_flags)
-            writer.write_uint32(self.global_index)
+        # Layout of the 20-byte triangle records, which are decoded in bulk into a structured array.
+        dtype = np.dtype([
+            ("length", ">f4"),
+            ("position_index", ">u2"),
+            ("direction_index", ">u2"),
+            ("normal_a_index", ">u2"),
+            ("normal_b_index", ">u2"),
+            ("normal_c_index", ">u2"),
+            ("collision_flags", ">u2"),
+            ("global_index", ">u4")
+        ])
+
+    class OctreeTriangles:
+        # Per-triangle data computed once to test whole batches of triangles against the octree cubes. Vertices and
+        # normals are kept in single precision like the mathutils vectors they are taken from.
+        def __init__(self, vertices, normals):
+            self.vertices = np.asarray(vertices, np.float32)
+            self.normals = np.asarray(normals, np.float32)
+            self.aabb_min = self.vertices.min(axis=1)
+            self.aabb_max = self.vertices.max(axis=1)
+            self.normal_extents = (np.abs(self.normals[:, 0].astype(np.float64)) + np.abs(self.normals[:, 1])) \
+                + np.abs(self.normals[:, 2])
+
+        def __len__(self):
+            return len(self.vertices)
 
     class OctreeNode:
-        def __init__(self, base, width, bm, indices, max_triangles, min_width):
+        def __init__(self, base, width, triangles, indices, max_triangles, min_width):
             self.half_width = width / 2.0
-            self.c = base + Vector((self.half_width, self.half_width, self.half_width))
+            self.c = base + np.float32(self.half_width)
             self.is_leaf = True
-            self.indices = []
-            for i in indices:
-                # TODO: Maybe solving it with a Wiimm KCL_BLOW approach is faster.
-                if self.tricube_overlap(bm.faces[i], self):
-                    self.indices.append(i)
+            indices = np.asarray(indices, np.intp)
+            if Profiler.enabled:
+                Profiler.count("Octree cubes of width {:g}".format(width))
+                Profiler.count("Octree overlap tests of width {:g}".format(width), len(indices))
+            self.indices = indices[self.tricube_overlap(triangles, indices, self.c, self.half_width)]
             # Split this node's cube when it contains too many triangles and the minimum size is not underrun yet.
             if len(self.indices) > max_triangles and self.half_width >= min_width:
                 self.is_leaf = False
-                self.branches = [KclModel.OctreeNode(base + (Vector((x, y, z)) * self.half_width), self.half_width,
-                     bm, self.indices,
+                self.branches = [KclModel.OctreeNode(base + np.array((x, y, z), np.float32) * np.float32(self.half_width),
+                     self.half_width, triangles, self.indices,
                      max_triangles, min_width)
                      for z in range(0, 2) for y in range(0, 2) for x in range(0, 2)]
                 self.indices = []
 
-        def write(self, writer, base_address):
-            pos = writer.tell()
-            writer.seek(0, io.SEEK_END)
-            end_position = writer.tell()
-            if self.is_leaf:
-                # Write the offset back at this nodes address.
-                writer.seek(pos)
-                writer.write_uint32((end_position - base_address - 2) | 0x80000000)
-                writer.seek(end_position + 4)
-                # Write the triangle indices and terminate the list with 0xFFFF.
-                writer.write_uint16s(self.indices)
-                writer.write_uint16(0xFFFF)
-            else:
-                writer.seek(pos)
-                writer.write_uint32(end_position - base_address)
-                writer.seek(end_position + 4)
-                base = writer.tell()
-                writer.write_uint32s([0x00000000] * 8)
-                writer.seek(base)
-                for node in self.branches:
-                    node.write(writer, base)
-            writer.seek(pos + 4)
+        @classmethod
+        def from_data(cls, base, width, indices, branches=None):
+            # Create a node from triangles which have already been sorted into it by another octree builder.
+            node = cls.__new__(cls)
+            node.half_width = width / 2.0
+            node.c = base + np.float32(node.half_width)
+            node.is_leaf = branches is None
+            node.indices = indices if node.is_leaf else []
+            if not node.is_leaf:
+                node.branches = branches
+            return node
 
         @staticmethod
-        def tricube_overlap(bm_face, cube):
-            # Intersection test for triangle and axis-aligned cube.
+        def tricube_overlap(triangles, indices, center, half_width):
+            # Intersection test of the given triangles with axis-aligned cubes, returning a mask of overlapping ones.
+            # The center is either shared by all triangles or given per triangle. Coordinates relative to the cube are
+            # computed in single precision, all other terms in double precision as done by mathutils.
+            h = half_width
+            mask = np.zeros(len(indices), bool)
+            # Reject triangles whose bounding box does not overlap the cube.
+            aabb_min = (triangles.aabb_min[indices] - center).astype(np.float64)
+            aabb_max = (triangles.aabb_max[indices] - center).astype(np.float64)
+            candidates = np.flatnonzero(((aabb_min <= h) & (aabb_max >= -h)).all(axis=1))
+            if not len(candidates):
+                return mask
+            # Reject triangles whose plane does not intersect the cube.
+            tri = indices[candidates]
+            c = center[candidates] if center.ndim == 2 else center
+            v0_32 = triangles.vertices[tri, 0] - c
+            products = triangles.normals[tri] * v0_32
+            d = (products[:, 2].astype(np.float64) + products[:, 1]) + products[:, 0]
+            r = h * triangles.normal_extents[tri]
+            hit = (d <= r) & (d >= -r)
+            candidates, tri, v0_32 = candidates[hit], tri[hit], v0_32[hit]
+            c = c[hit] if center.ndim == 2 else c
+            # Reject triangles separated along one of the 9 axes formed by the cube axes crossed with the triangle edges.
+            v1_32 = triangles.vertices[tri, 1] - c
+            v2_32 = triangles.vertices[tri, 2] - c
+            v0, v1, v2 = v0_32.T.astype(np.float64), v1_32.T.astype(np.float64), v2_32.T.astype(np.float64)
+
             def axis_test(a1, a2, b1, b2, c1, c2):
                 p = a1 * b1 + a2 * b2
                 q = a1 * c1 + a2 * c2
-                r = cube.half_width * (abs(a1) + abs(a2))
-                return min(p, q) > r or max(p, q) < -r
-
-            v0 = bm_face.verts[0].co - cube.c
-            v1 = bm_face.verts[1].co - cube.c
-            v2 = bm_face.verts[2].co - cube.c
-            if min(v0.x, v1.x, v2.x) > cube.half_width or max(v0.x, v1.x, v2.x) < -cube.half_width: return False
-            if min(v0.y, v1.y, v2.y) > cube.half_width or max(v0.y, v1.y, v2.y) < -cube.half_width: return False
-            if min(v0.z, v1.z, v2.z) > cube.half_width or max(v0.z, v1.z, v2.z) < -cube.half_width: return False
-            d = bm_face.normal.dot(v0)
-            r = cube.half_width * (abs(bm_face.normal.x) + abs(bm_face.normal.y) + abs(bm_face.normal.z))
-            if d > r or d < -r: return False
-            e = v1 - v0
-            if axis_test(e.z, -e.y, v0.y, v0.z, v2.y, v2.z): return False
-            if axis_test(-e.z, e.x, v0.x, v0.z, v2.x, v2.z): return False
-            if axis_test(e.y, -e.x, v1.x, v1.y, v2.x, v2.y): return False
-            e = v2 - v1
-            if axis_test(e.z, -e.y, v0.y, v0.z, v2.y, v2.z): return False
-            if axis_test(-e.z, e.x, v0.x, v0.z, v2.x, v2.z): return False
-            if axis_test(e.y, -e.x, v0.x, v0.y, v1.x, v1.y): return False
-            e = v0 - v2
-            if axis_test(e.z, -e.y, v0.y, v0.z, v1.y, v1.z): return False
-            if axis_test(-e.z, e.x, v0.x, v0.z, v1.x, v1.z): return False
-            if axis_test(e.y, -e.x, v1.x, v1.y, v2.x, v2.y): return False
-            return True
-
-    def __init__(self, reader):
-        self.header = self.Header(reader)
-        # Load the positions of the vertices.
-        reader.seek(self.header.positions_offset)
-        self.positions = []
+                r = h * (np.abs(a1) + np.abs(a2))
+                return (np.minimum(p, q) > r) | (np.maximum(p, q) < -r)
+
+            x, y, z = 0, 1, 2
+            e = (v1_32 - v0_32).T.astype(np.float64)
+            separated = axis_test(e[z], -e[y], v0[y], v0[z], v2[y], v2[z])
+            separated |= axis_test(-e[z], e[x], v0[x], v0[z], v2[x], v2[z])
+            separated |= axis_test(e[y], -e[x], v1[x], v1[y], v2[x], v2[y])
+            e = (v2_32 - v1_32).T.astype(np.float64)
+            separated |= axis_test(e[z], -e[y], v0[y], v0[z], v2[y], v2[z])
+            separated |= axis_test(-e[z], e[x], v0[x], v0[z], v2[x], v2[z])
+            separated |= axis_test(e[y], -e[x], v0[x], v0[y], v1[x], v1[y])
+            e = (v0_32 - v2_32).T.astype(np.float64)
+            separated |= axis_test(e[z], -e[y], v0[y], v0[z], v1[y], v1[z])
+            separated |= axis_test(-e[z], e[x], v0[x], v0[z], v1[x], v1[z])
+            separated |= axis_test(e[y], -e[x], v1[x], v1[y], v2[x], v2[y])
+            mask[candidates[~separated]] = True
+            return mask
+
+    class Octree:
+        # The spatial octree of a model, decoded into flat arrays of nodes. The 8 children of a branch follow each other
+        # starting at its first index, and the triangle lists of all leaves are concatenated into one array.
+        def __init__(self, data, header):
+            self.base = np.array(header.first_spatial_position, np.float64)
+            self.cube_exponent = header.shift[0]
+            # The masks have the bits of coordinates outside of the cuboid world set.
+            exponents = [32 - bin(mask).count("1") for mask in header.mask]
+            if min(exponents) < self.cube_exponent:
+                raise AssertionError("The octree masks do not match the size of its cubes.")
+            self.size = np.array([2.0 ** exponent for exponent in exponents])
+            self.divisions = [1 << (exponent - self.cube_exponent) for exponent in exponents]
+            is_leaf, first, count = [], [], []
+            triangles = []
+            triangle_count = 0
+            leaves = {} # Triangle lists already read by their address, as several leaves may share them.
+            blocks = [(header.octree_offset, self.divisions[0] * self.divisions[1] * self.divisions[2])]
+            node_count = blocks[0][1]
+            for address, block_count in blocks:
+                for value in np.frombuffer(data, ">u4", block_count, address).tolist():
+                    if value & 0x80000000:
+                        list_address = address + (value & 0x7FFFFFFF) + 2
+                        leaf = leaves.get(list_address)
+                        if leaf is None:
+                            indices = self._read_list(data, list_address)
+                            leaf = leaves[list_address] = (triangle_count, len(indices))
+                            triangles.append(indices)
+                            triangle_count += len(indices)
+                        is_leaf.append(True)
+                        first.append(leaf[0])
+                        count.append(leaf[1])
+                    else:
+                        blocks.append((address + value, 8))
+                        is_leaf.append(False)
+                        first.append(node_count)
+                        count.append(0)
+                        node_count += 8
+            self.is_leaf = np.array(is_leaf, bool)
+            self.first = np.array(first, np.intp)
+            self.count = np.array(count, np.intp)
+            self.triangles = np.concatenate(triangles).astype(np.intp) if triangles else np.zeros(0, np.intp)
+            # The start and length in the triangles of each list stored in the file, by its address.
+            self.lists = leaves
+
+        def leaf_at(self, point):
+            # Return the index of the leaf containing the point, or -1 if it lies outside of the world.
+            position = np.asarray(point, np.float64) - self.base
+            if (position < 0).any() or (position >= self.size).any():
+                return -1
+            width = 2.0 ** self.cube_exponent
+            cell = np.floor(position / width).astype(np.intp)
+            node = (cell[2] * self.divisions[1] + cell[1]) * self.divisions[0] + cell[0]
+            while not self.is_leaf[node]:
+                width /= 2
+                bits = np.floor(position / width).astype(np.intp) & 1
+                node = self.first[node] + bits[0] + 2 * bits[1] + 4 * bits[2]
+            return node
+
+        def leaves_in_box(self, box_min, box_max):
+            # Return the indices of the leaves overlapping the axis-aligned box.
+            box_min = np.asarray(box_min, np.float64) - self.base
+            box_max = np.asarray(box_max, np.float64) - self.base
+            width = 2.0 ** self.cube_exponent
+            lo = np.clip(np.floor(box_min / width), 0, np.array(self.divisions) - 1).astype(np.intp)
+            hi = np.clip(np.floor(box_max / width), 0, np.array(self.divisions) - 1).astype(np.intp)
+            if (box_max < 0).any() or (box_min >= self.size).any():
+                return []
+            stack = [((z * self.divisions[1] + y) * self.divisions[0] + x, np.array((x, y, z)) * width, width)
+                     for z in range(lo[2], hi[2] + 1) for y in range(lo[1], hi[1] + 1) for x in range(lo[0], hi[0] + 1)]
+            leaves = []
+            while stack:
+                node, cube_min, width = stack.pop()
+                if self.is_leaf[node]:
+                    leaves.append(node)
+                    continue
+                width /= 2
+                for i, octant in enumerate(KclModel.Octree._OCTANTS):
+                    child_min = cube_min + octant * width
+                    if (child_min <= box_max).all() and (child_min + width >= box_min).all():
+                        stack.append((self.first[node] + i, child_min, width))
+            return leaves
+
+        def leaf_triangles(self, node):
+            return self.triangles[self.first[node]:self.first[node] + self.count[node]]
+
+        @staticmethod
+        def _read_list(data, address):
+            # Read the triangle indices up to the terminating 0xFFFF, in growing chunks as the length is unknown.
+            parts = []
+            chunk = 32
+            while True:
+                count = min(chunk, (len(data) - address) // 2)
+                part = np.frombuffer(data, ">u2", count, address)
+                end = np.flatnonzero(part == 0xFFFF)
+                if len(end):
+                    parts.append(part[:end[0]])
+                    return np.concatenate(parts)
+                if count < chunk:
+                    raise AssertionError("Unterminated triangle list in the octree.")
+                parts.append(part)
+                address += 2 * count
+                chunk *= 2
+
+    Octree._OCTANTS = np.array([(x, y, z) for z in range(0, 2) for y in range(0, 2) for x in range(0, 2)], np.float64)
+
+    def __init__(self, data, offset):
+        self.data = data
+        self._octree = None
+        # The corners of all triangles and their degenerate mask, once reconstructed for queries or given by a cache.
+        self.triangle_vertices = None
+        with Profiler.phase("Section decode"):
+            self._map_sections(data, offset)
+
+    @property
+    def octree(self):
+        # Decode the octree when it is used the first time.
+        if self._octree is None:
+            with Profiler.phase("Octree decode"):
+                self._octree = self.Octree(self.data, self.header)
+        return self._octree
+
+    def triangles_at(self, point):
+        # Return the indices of the triangles in the octree cube containing the point.
+        node = self.octree.leaf_at(point)
+        return self.octree.leaf_triangles(node) if node >= 0 else np.zeros(0, np.intp)
+
+    def triangles_in_box(self, box_min, box_max):
+        # Return the indices of the triangles in the octree cubes overlapping the axis-aligned box whose bounds also
+        # overlap it. Triangles only passing by the box with their bounds but not in the cubes are not returned.
+        octree = self.octree
+        leaves = octree.leaves_in_box(box_min, box_max)
+        if not leaves:
+            return np.zeros(0, np.intp)
+        indices = np.unique(np.concatenate([octree.leaf_triangles(node) for node in leaves]))
+        vertices, degenerate = self._get_vertices()
+        corners = vertices[indices]
+        inside = ((corners.min(axis=1) <= box_max) & (corners.max(axis=1) >= box_min)).all(axis=1)
+        return indices[inside & ~degenerate[indices]]
+
+    def ray_cast(self, origin, direction, max_distance=np.inf):
+        # Return the index of the first triangle hit by the ray and the distance to it, or None if nothing is hit. Cubes
+        # are visited in the order the ray enters them, stopping once a hit lies before the next cube.
+        origin = np.asarray(origin, np.float64)
+        direction = np.asarray(direction, np.float64)
+        direction = direction / np.linalg.norm(direction)
+        octree = self.octree
+        vertices, degenerate = self._get_vertices()
+        best = (None, max_distance)
+        width = 2.0 ** octree.cube_exponent
+        cells = np.array([(x, y, z) for z in range(0, octree.divisions[2]) for y in range(0, octree.divisions[1])
+                          for x in range(0, octree.divisions[0])], np.float64)
+        queue = []
+        self._push_cubes(queue, origin, direction, np.arange(0, len(cells)), octree.base + cells * width, width, best[1])
+        while queue:
+            enter, node, cube_min, width = heapq.heappop(queue)
+            if enter > best[1]:
+                break
+            if octree.is_leaf[node]:
+                indices = octree.leaf_triangles(node)
+                indices = indices[~degenerate[indices]]
+                distances = self._intersect_ray(origin, direction, vertices[indices])
+                if len(distances) and distances.min() < best[1]:
+                    best = (int(indices[distances.argmin()]), float(distances.min()))
+            else:
+                width /= 2
+                self._push_cubes(queue, origin, direction, octree.first[node] + np.arange(0, 8),
+                                 cube_min + self.Octree._OCTANTS * width, width, best[1])
+        return best if best[0] is not None else None
+
+    def _get_vertices(self):
+        if self.triangle_vertices is None:
+            self.triangle_vertices = self.all_triangle_vertices()
+        return self.triangle_vertices
+
+    @staticmethod
+    def _push_cubes(queue, origin, direction, nodes, cube_mins, width, max_distance):
+        # Queue the cubes the ray enters before the given distance by the distance at which it enters them.
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t1 = (cube_mins - origin) / direction
+            t2 = (cube_mins + width - origin) / direction
+        # Axes the ray runs parallel to within a cube result in NaN and do not limit the range.
+        enter = np.where(np.isnan(t1), -np.inf, np.fmin(t1, t2)).max(axis=1)
+        leave = np.where(np.isnan(t1), np.inf, np.fmax(t1, t2)).min(axis=1)
+        enter = np.maximum(enter, 0)
+        for i in np.flatnonzero((enter <= leave) & (enter <= max_distance)):
+            heapq.heappush(queue, (float(enter[i]), int(nodes[i]), cube_mins[i], width))
+
+    @staticmethod
+    def _intersect_ray(origin, direction, vertices, epsilon=1e-9):
+        # Return the distances at which the ray hits the given triangles, or infinity for the ones it misses.
+        v0 = vertices[:, 0].astype(np.float64)
+        edge1 = vertices[:, 1] - v0
+        edge2 = vertices[:, 2] - v0
+        p = np.cross(direction, edge2)
+        det = np.einsum("ij,ij->i", edge1, p)
+        valid = np.abs(det) > epsilon
+        det[~valid] = 1
+        s = origin - v0
+        u = np.einsum("ij,ij->i", s, p) / det
+        q = np.cross(s, edge1)
+        v = np.dot(q, direction) / det
+        t = np.einsum("ij,ij->i", edge2, q) / det
+        hit = valid & (u >= 0) & (v >= 0) & (u + v <= 1) & (t >= 0)
+        return np.where(hit, t, np.inf)
+
+    def _map_sections(self, data, offset):
+        with BinaryReader(data, ">") as reader:
+            reader.seek(offset)
+            self.header = self.Header(reader)
+        # Map the positions of the vertices as big-endian float triples.
         position_count = (self.header.normals_offset - self.header.positions_offset) // 12
-        for i in range(0, position_count):
-            self.positions.append(reader.read_vector_3d())
-        # Load the normals.
-        self.normals = []
-        reader.seek(self.header.normals_offset)
-        normal_count = (self.header.triangles_offset - self.header.normals_offset + 0x10) // 12
-        for i in range(0, normal_count):
-            self.normals.append(reader.read_vector_3d())
-        # Read the triangles.
-        self.triangles = []
-        reader.seek(self.header.triangles_offset)
+        self.positions = np.frombuffer(data, ">f4", position_count * 3, self.header.positions_offset) \
+            .reshape(position_count, 3)
+        # Map the triangles, viewed as a record array to access their fields as attributes.
         triangle_count = (self.header.octree_offset - self.header.triangles_offset) // 20
-        for i in range(0, triangle_count):
-            self.triangles.append(self.Triangle(reader))
+        self.triangles = np.frombuffer(data, self.Triangle.dtype, triangle_count, self.header.triangles_offset) \
+            .view(np.recarray)
+        # Map the normals up to the last one referenced by the triangles, as the size of the section may include
+        # padding. It is still limited to the 0x10 bytes past the triangle offset which were always read as normals.
+        normal_count = (self.header.triangles_offset - self.header.normals_offset + 0x10) // 12
+        if triangle_count:
+            normal_count = min(normal_count, 1 + max(int(self.triangles[field].max()) for field in (
+                "direction_index", "normal_a_index", "normal_b_index", "normal_c_index")))
+        self.normals = np.frombuffer(data, ">f4", normal_count * 3, self.header.normals_offset) \
+            .reshape(normal_count, 3)
 
     def get_triangle_vertices(self, triangle):
-        position = self.positions[triangle.position_index]
+        # Reconstruct the corners of one triangle as single precision arrays, like a row of all_triangle_vertices.
+        position = self.positions[triangle.position_index].astype(np.float32)
         direction = self.normals[triangle.direction_index]
         normal_a = self.normals[triangle.normal_a_index]
         normal_b = self.normals[triangle.normal_b_index]
         normal_c = self.normals[triangle.normal_c_index]
-        cross_a = normal_a.cross(direction)
-        cross_b = normal_b.cross(direction)
+        cross_a = np.cross(normal_a, direction)
+        cross_b = np.cross(normal_b, direction)
         vertex1 = position.copy()
         vertex2 = position + cross_b * (triangle.length / cross_b.dot(normal_c))
         vertex3 = position + cross_a * (triangle.length / cross_a.dot(normal_c))
         return vertex1, vertex2, vertex3
+
+    def all_triangle_vertices(self, epsilon=1e-6):
+        # Reconstruct the corners of all triangles at once. Triangles whose corners cannot be resolved since their
+        # edge normals are (nearly) parallel to the third one are reported as degenerate and collapse to their position.
+        # Corners reconstructed before with the default epsilon are returned as they are.
+        if self.triangle_vertices is not None and epsilon == 1e-6:
+            return self.triangle_vertices
+        with Profiler.phase("Vertex reconstruction"):
+            triangles = self.triangles
+            normals = self.normals.astype(np.float32)
+            position = self.positions.astype(np.float32)[triangles.position_index]
+            direction = normals[triangles.direction_index]
+            normal_c = normals[triangles.normal_c_index]
+            cross_a = np.cross(normals[triangles.normal_a_index], direction)
+            cross_b = np.cross(normals[triangles.normal_b_index], direction)
+            dot_a = np.einsum("ij,ij->i", cross_a, normal_c)
+            dot_b = np.einsum("ij,ij->i", cross_b, normal_c)
+            degenerate = (np.abs(dot_a) < epsilon) | (np.abs(dot_b) < epsilon)
+            length = np.where(degenerate, 0, triangles.length).astype(np.float32)
+            dot_a[degenerate] = 1
+            dot_b[degenerate] = 1
+            vertices = np.empty((len(triangles), 3, 3), np.float32)
+            vertices[:, 0] = position
+            vertices[:, 1] = position + cross_b * (length / dot_b)[:, np.newaxis]
+            vertices[:, 2] = position + cross_a * (length / dot_a)[:, np.newaxis]
+            return vertices, degenerate
+
+def weld_vertices(vertices, distance):
+    # Merge the corners of the given triangles which are closer to each other than the given distance, also chaining
+    # corners through the ones between them, returning the positions of the merged vertices in the order they first
+    # appear and the vertex indices of each triangle. The positions of the first corners of each vertex are kept.
+    corners = vertices.reshape(-1, 3)
+    positions, position_indices = np.unique(corners, return_inverse=True, axis=0)
+    position_indices = position_indices.reshape(-1)
+    labels = np.arange(0, len(positions))
+    if distance > 0 and len(positions) > 1:
+        first, second = _find_close_pairs(positions.astype(np.float64), distance)
+        # Join the groups of each pair like a union-find, linking the roots to the smaller one of them, until all
+        # connected positions point to the smallest index among them.
+        while True:
+            while (labels[labels] != labels).any():
+                labels = labels[labels]
+            roots_first, roots_second = labels[first], labels[second]
+            linked = roots_first != roots_second
+            if not linked.any():
+                break
+            first, second = first[linked], second[linked]
+            merged = np.minimum(roots_first[linked], roots_second[linked])
+            np.minimum.at(labels, roots_first[linked], merged)
+            np.minimum.at(labels, roots_second[linked], merged)
+    _, first, inverse = np.unique(labels[position_indices], return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty(len(order), np.intp)
+    rank[order] = np.arange(0, len(order))
+    return corners[first[order]], rank[inverse.reshape(-1)].reshape(-1, 3)
+
+def _find_close_pairs(positions, distance):
+    # Return the indices of the pairs of positions closer than the distance. Such pairs lie in the same or neighboring
+    # cells of a grid with the distance as spacing, so only those cells are compared, each pair of them once.
+    keys, strides = _get_cell_keys(positions, distance)
+    cells, cell_indices = np.unique(keys, return_inverse=True)
+    cell_indices = cell_indices.reshape(-1)
+    order = np.argsort(cell_indices, kind="stable")
+    counts = np.bincount(cell_indices, minlength=len(cells))
+    starts = np.cumsum(counts) - counts
+    offsets = [(x, y, z) for x in (-1, 0, 1) for y in (-1, 0, 1) for z in (-1, 0, 1) if (x, y, z) >= (0, 0, 0)]
+    pairs_first, pairs_second = [], []
+    for offset in offsets:
+        # Find the neighboring cell of each cell by looking up the shifted keys among the existing ones.
+        shifted = cells + int(np.dot(offset, strides))
+        neighbors = np.minimum(np.searchsorted(cells, shifted), len(cells) - 1)
+        neighbors[cells[neighbors] != shifted] = -1
+        # Pair each position with every position in the neighboring cell of its own.
+        neighbor = neighbors[cell_indices[order]]
+        lengths = np.where(neighbor >= 0, counts[neighbor], 0)
+        first = np.repeat(order, lengths)
+        within = np.arange(0, lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        second = order[np.repeat(starts[neighbor], lengths) + within]
+        if offset == (0, 0, 0):
+            keep = first < second
+            first, second = first[keep], second[keep]
+        close = ((positions[first] - positions[second]) ** 2).sum(axis=1) <= distance * distance
+        pairs_first.append(first[close])
+        pairs_second.append(second[close])
+    return np.concatenate(pairs_first), np.concatenate(pairs_second)
+
+def _get_cell_keys(positions, spacing):
+    # Return a key for the grid cell of each position and the key differences between neighboring cells. The cell
+    # coordinates are ranked per axis among themselves and their neighbors to keep the keys small, and the cells are
+    # enlarged if the keys do not fit into 64 bits, which still keeps close positions in neighboring cells.
+    while True:
+        cells = np.floor(positions / spacing).astype(np.int64)
+        ranks = []
+        sizes = []
+        for axis in range(0, 3):
+            values = np.unique(np.concatenate((cells[:, axis] - 1, cells[:, axis], cells[:, axis] + 1)))
+            ranks.append(np.searchsorted(values, cells[:, axis]))
+            sizes.append(len(values))
+        if sizes[0] * sizes[1] * sizes[2] < 2 ** 63:
+            break
+        spacing *= 2
+    strides = (sizes[1] * sizes[2], sizes[2], 1)
+    return ranks[0] * strides[0] + ranks[1] * strides[1] + ranks[2], strides
@@ -0,0 +1,494 @@
+import hashlib
+import multiprocessing
+import numpy as np
+import os
+from .binary_io import replace_file
+from .kcl_file import KclModel
+from .log import Log, Profiler
+
+# Fraction of a cube's half width around cube borders within which triangles are checked with exact overlap tests.
+_BIN_MARGIN = 1e-4
+# Number of straddling triangles checked with one vectorized overlap test, bounding the memory of its temporaries.
+_OVERLAP_CHUNK = 8192
+# Offsets of the 8 child cubes in the order they are stored in.
+_OCTANTS = np.array([(x, y, z) for z in range(0, 2) for y in range(0, 2) for x in range(0, 2)], np.float32)
+
+# Parameters compared when tuning the octree: the maximum triangles in a cube before it is split and the minimum cube
+# size into which triangles are sorted.
+TUNE_MAX_TRIANGLES = (8, 16, 32, 64, 128)
+TUNE_MIN_WIDTHS = (64, 128, 256, 512, 1024)
+# Cost of descending one octree level in a lookup, relative to testing one triangle.
+_DESCENT_COST = 1.0
+
+# Version of the layout of octree cache files, which are discarded when written with another one.
+_CACHE_VERSION = 2
+
+# Triangles attached from shared memory in a worker process.
+_worker_memory = None
+_worker_triangles = None
+
+def build_octree(triangles, base, cube_size, divisions, max_triangles, min_width, processes=1, engine="recursive"):
+    # Create the first level of sub cubes, each being the root of a subtree only depending on the triangle data.
+    bases = _get_root_bases(base, cube_size, divisions)
+    if engine == "binned":
+        return _build_binned(triangles, base, bases, cube_size, divisions, max_triangles, min_width)
+    if engine != "recursive":
+        raise AssertionError("Unknown octree engine '{}'.".format(engine))
+    if processes == 0:
+        processes = os.cpu_count() or 1
+    # Shared memory requires Python 3.8, so older versions (like the ones of Blender 2.7x) build the octree serially.
+    if processes == 1 or len(bases) == 1 or _get_shared_memory() is None:
+        indices = np.arange(len(triangles))
+        return [KclModel.OctreeNode(node_base, cube_size, triangles, indices, max_triangles, min_width)
+                for node_base in bases]
+    # Share the triangle data with the worker processes instead of pickling it for each of them.
+    vertices_memory = _share_array(triangles.vertices)
+    normals_memory = _share_array(triangles.normals)
+    try:
+        initargs = (vertices_memory.name, normals_memory.name, len(triangles), Profiler.enabled)
+        with multiprocessing.Pool(processes, _init_worker, initargs) as pool:
+            # The results are returned in the order of the cubes, keeping the octree deterministic.
+            tasks = [(node_base, cube_size, max_triangles, min_width) for node_base in bases]
+            results = pool.map(_build_subtree, tasks, chunksize=max(1, len(tasks) // (processes * 4)))
+        for node, counters in results:
+            Profiler.add_counters(counters)
+        return [node for node, counters in results]
+    finally:
+        for memory in (vertices_memory, normals_memory):
+            memory.close()
+            memory.unlink()
+
+def tune_octree(triangles, base, cube_size, divisions, size_budget, max_triangles=TUNE_MAX_TRIANGLES,
+                min_widths=TUNE_MIN_WIDTHS):
+    # Estimate the octree of each pair of parameters and return the metrics of the one with the cheapest lookups fitting
+    # into the size budget in bytes (or the smallest one if none fits), together with the metrics of all pairs. The
+    # octree is only binned once with the finest parameters, as it contains all cubes of the coarser ones.
+    bases = _get_root_bases(base, cube_size, divisions)
+    levels = _bin_levels(triangles, base, bases, cube_size, divisions, min(max_triangles), min(min_widths))
+    results = [_estimate_octree(levels, count, width) for count in max_triangles for width in min_widths]
+    fitting = [result for result in results if result["size"] <= size_budget]
+    if fitting:
+        return min(fitting, key=lambda result: (result["lookup_cost"], result["size"])), results
+    return min(results, key=lambda result: result["size"]), results
+
+def split_models(triangles, base, size, fits, min_size):
+    # Split the world into octants until the triangles overlapping each of them fit into one model, returning the model
+    # octree with the model index for each leaf cube, and the indices of the triangles of each model. Triangles spanning
+    # several cubes are stored in each of their models, as a leaf only references one model.
+    indices = np.arange(len(triangles))
+    if fits(indices):
+        return [0] * 8, [indices]
+    models = []
+
+    def split(indices, base, size):
+        # Only split the axes along which the cube is not smaller than the minimum size, e.g. not the height of flat
+        # courses. The octants only differing along other axes keep the whole extent and share their node.
+        axes = size >= min_size
+        if not axes.any():
+            raise AssertionError("There are too many triangles in a small area to split them into models.")
+        child_size = np.where(axes, size / 2, size)
+        nodes = []
+        children = {}
+        for octant in _OCTANTS * axes:
+            key = tuple(octant.tolist())
+            if key not in children:
+                child_base = base + octant * child_size
+                inside = ((triangles.aabb_min[indices] <= child_base + child_size)
+                          & (triangles.aabb_max[indices] >= child_base)).all(axis=1)
+                child = indices[inside]
+                if not len(child):
+                    # Empty cubes reference the first model, which has no triangles in them like the others.
+                    children[key] = 0
+                elif fits(child):
+                    children[key] = len(models)
+                    models.append(child)
+                else:
+                    children[key] = split(child, child_base, child_size)
+            nodes.append(children[key])
+        return nodes
+
+    return split(indices, np.asarray(base, np.float64), np.asarray(size, np.float64)), models
+
+def write_model_octree(model_octree, endianness=">"):
+    # Lay out the model octree in one buffer: Leaves store the index of the model with the highest bit set, branches
+    # the offset to the block of their children relative to the block they are stored in.
+    values = []
+
+    def layout(nodes, base):
+        position = len(values)
+        values.extend([0] * 8)
+        for i, node in enumerate(nodes):
+            if isinstance(node, list):
+                values[position + i] = 4 * len(values) - base
+                layout(node, 4 * len(values))
+            else:
+                values[position + i] = node | 0x80000000
+
+    layout(model_octree, 0)
+    return bytearray(np.array(values, endianness + "u4").tobytes())
+
+def write_octree(octree, endianness=">"):
+    # Lay out the octree in one buffer: The node blocks come first in the order they are visited, followed by each
+    # distinct leaf triangle list, which all leaves with the same triangles point to. Branches store the offset to the
+    # block of their children, leaves the offset to their list minus 2, both relative to the block they are stored in.
+    positions, bases, targets, lists = [], [], [], []
+    list_addresses = {}
+    end = 4 * len(octree)
+
+    def layout(nodes, base):
+        nonlocal end
+        for i, node in enumerate(nodes):
+            positions.append(base + 4 * i)
+            bases.append(base)
+            if node.is_leaf:
+                # Remember the list to look up its address once all blocks have been laid out.
+                indices = np.append(np.asarray(node.indices, np.intp), 0xFFFF).astype(endianness + "u2").tobytes()
+                targets.append(None)
+                lists.append((len(targets) - 1, indices))
+            else:
+                targets.append(end)
+                end += 32
+                layout(node.branches, end - 32)
+
+    layout(octree, 0)
+    nodes_size = end
+    for node, indices in lists:
+        address = list_addresses.get(indices)
+        if address is None:
+            address = list_addresses[indices] = end
+            end += len(indices)
+        targets[node] = address - 2
+    # Leaves have the highest bit set.
+    values = np.array(targets, np.int64) - bases
+    values[[node for node, indices in lists]] |= 0x80000000
+    buffer = bytearray(end)
+    np.frombuffer(buffer, endianness + "u4", nodes_size // 4)[np.array(positions, np.intp) // 4] = values
+    for indices, address in list_addresses.items():
+        buffer[address:address + len(indices)] = indices
+    return buffer
+
+class OctreeCache:
+    # The subtrees of the root cubes of each model of the last export, stored with the hashes of the triangles in them.
+    # As subtrees only depend on the triangles overlapping their root cube, the ones of unchanged cubes are reused, as
+    # long as the bounds of the model and the octree parameters are the same.
+    EXTENSION = ".octree" # Appended to the path of the KCL file to get the path of its cache.
+
+    def __init__(self):
+        self.models = {} # The set hash and subtree record of each root cube, by the geometry and parameters of a model.
+        self.new_models = {}
+        self.reused_cubes = 0
+        self.root_cubes = 0
+
+    @classmethod
+    def load(cls, filepath):
+        # Read the cache of the last export, starting with an empty one if it does not exist or cannot be used.
+        cache = cls()
+        try:
+            with open(filepath, "rb") as file, np.load(file) as data:
+                if int(data["version"]) != _CACHE_VERSION:
+                    return cache
+                root_ends = np.cumsum(data["root_counts"])
+                node_ends = np.cumsum(data["node_counts"])
+                leaf_ends = np.cumsum(data["leaf_counts"])
+                list_ends = np.cumsum(data["list_counts"])
+                leaf_flags = np.split(data["leaf_flags"], node_ends[:-1])
+                list_counts = np.split(data["list_counts"], leaf_ends[:-1])
+                list_hashes = np.split(data["list_hashes"], list_ends[leaf_ends[:-1] - 1] if len(list_ends) else [])
+                roots = [(bytes(set_hash), (flags, counts, hashes)) for set_hash, flags, counts, hashes
+                         in zip(data["set_hashes"], leaf_flags, list_counts, list_hashes)]
+                for key, start, end in zip(data["keys"].tolist(), root_ends - data["root_counts"], root_ends):
+                    cache.models[tuple(key)] = roots[start:end]
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            # Corrupt or truncated caches only cost a full rebuild.
+            Log.write(0, "Ignoring the unreadable octree cache '{}': {}".format(filepath, e))
+            cache.models = {}
+        return cache
+
+    def save(self, filepath):
+        # Write the subtrees of the models built since loading, replacing the previous cache only once it is complete.
+        keys = list(self.new_models)
+        roots = [root for key in keys for root in self.new_models[key]]
+        records = [record for set_hash, record in roots]
+        arrays = {
+            "version": np.array(_CACHE_VERSION),
+            "keys": np.array(keys, np.float64).reshape(-1, 9),
+            "root_counts": np.array([len(self.new_models[key]) for key in keys], np.intp),
+            "set_hashes": np.array([np.frombuffer(set_hash, np.uint8) for set_hash, record in roots],
+                                   np.uint8).reshape(-1, 16),
+            "node_counts": np.array([len(flags) for flags, counts, hashes in records], np.intp),
+            "leaf_counts": np.array([len(counts) for flags, counts, hashes in records], np.intp),
+            "leaf_flags": np.concatenate([flags for flags, counts, hashes in records] or [np.zeros(0, bool)]),
+            "list_counts": np.concatenate([counts for flags, counts, hashes in records] or [np.zeros(0, np.intp)]),
+            "list_hashes": np.concatenate([hashes for flags, counts, hashes in records] or [np.zeros(0, np.uint64)])
+        }
+        with replace_file(filepath) as file:
+            np.savez(file, **arrays)
+
+    def build_octree(self, triangles, base, cube_size, divisions, max_triangles, min_width, processes=1,
+                     engine="recursive"):
+        # Build the octree like build_octree, only rebuilding the subtrees of root cubes whose triangles changed.
+        key = tuple(np.asarray(base, np.float32).tolist()) + (float(cube_size),) + tuple(map(float, divisions)) \
+            + (float(max_triangles), float(min_width))
+        hashes = _hash_triangles(triangles)
+        order = np.argsort(hashes, kind="stable")
+        sorted_hashes = hashes[order]
+        # Sort the triangles into the root cubes without splitting them, and hash the triangles of each cube.
+        bases = _get_root_bases(base, cube_size, divisions)
+        root_bases, width, starts, counts, split, tris = _bin_levels(triangles, base, bases, cube_size, divisions,
+                                                                     len(triangles), min_width)[0]
+        root_indices = [tris[start:start + count] for start, count in zip(starts, counts)]
+        set_hashes = [hashlib.md5(np.sort(hashes[indices]).tobytes()).digest()
+                      for indices in root_indices]
+        cached = self.models.get(key)
+        unchanged = [cached is not None and cached[i][0] == set_hash for i, set_hash in enumerate(set_hashes)]
+        # Rebuild everything like without a cache when most of the cubes changed.
+        if sum(unchanged) * 2 < len(unchanged):
+            octree = build_octree(triangles, base, cube_size, divisions, max_triangles, min_width, processes, engine)
+            unchanged = [False] * len(unchanged)
+        else:
+            reused = [i for i in range(0, len(unchanged)) if unchanged[i]]
+            subtrees = dict(zip(reused, _create_subtrees([cached[i][1] for i in reused], root_bases[reused],
+                                                         cube_size, order, sorted_hashes)))
+            octree = [subtrees[i] if unchanged[i] else KclModel.OctreeNode(root_bases[i], cube_size, triangles,
+                                                                           root_indices[i], max_triangles, min_width)
+                      for i in range(0, len(unchanged))]
+        self.new_models[key] = [(set_hash, cached[i][1] if unchanged[i] else _create_record(octree[i], hashes))
+                                for i, set_hash in enumerate(set_hashes)]
+        self.reused_cubes += sum(unchanged)
+        self.root_cubes += len(unchanged)
+        return octree
+
+def _build_binned(triangles, base, bases, cube_size, divisions, max_triangles, min_width):
+    # Build the octree one level at a time in the spirit of Wiimm's KCL_BLOW: Triangles are binned into the cubes of a
+    # level by their bounding boxes, and only the ones lying on cube borders are checked with the exact overlap test.
+    # This yields the same octree as the recursive builder without testing every triangle of a node against each child.
+    levels = _bin_levels(triangles, base, bases, cube_size, divisions, max_triangles, min_width)
+    # Create the nodes bottom-up, passing the children to their parents.
+    children = None
+    for node_bases, width, starts, counts, split, tris in reversed(levels):
+        nodes = []
+        first_child = 0
+        for i in range(0, len(node_bases)):
+            if split[i]:
+                nodes.append(KclModel.OctreeNode.from_data(node_bases[i], width, None,
+                                                           children[first_child:first_child + 8]))
+                first_child += 8
+            else:
+                nodes.append(KclModel.OctreeNode.from_data(node_bases[i], width, tris[starts[i]:starts[i] + counts[i]]))
+        children = nodes
+    return children
+
+def _bin_levels(triangles, base, bases, cube_size, divisions, max_triangles, min_width):
+    # Return the cube bases, width, triangle list starts and counts, split mask and sorted leaf triangles of each level.
+    # The children of the split cubes of a level follow each other in the next level in the order of their parents.
+    divisions = np.array(divisions)
+    node_bases = np.array(bases, np.float32).reshape(-1, 3)
+    # Bin the triangles into the first level of cubes.
+    relative_min = (triangles.aabb_min - np.asarray(base, np.float32)).astype(np.float64) / cube_size
+    relative_max = (triangles.aabb_max - np.asarray(base, np.float32)).astype(np.float64) / cube_size
+    lo = np.clip(np.floor(relative_min - _BIN_MARGIN), 0, divisions - 1).astype(np.intp)
+    hi = np.clip(np.floor(relative_max + _BIN_MARGIN), 0, divisions - 1).astype(np.intp)
+    contained = (lo == hi).all(axis=1)
+    rows, cells = _expand_ranges(lo[~contained], hi[~contained])
+    straddling = np.flatnonzero(~contained)[rows]
+    straddling_nodes = (cells[:, 2] * divisions[1] + cells[:, 1]) * divisions[0] + cells[:, 0]
+    nodes, tris = _merge_binned(triangles, node_bases, cube_size / 2.0,
+                                (lo[contained, 2] * divisions[1] + lo[contained, 1]) * divisions[0] + lo[contained, 0],
+                                np.flatnonzero(contained), straddling_nodes, straddling)
+    # Sort the triangles into the cubes of the following levels as long as cubes have to be split.
+    levels = []
+    width = cube_size
+    while True:
+        half_width = width / 2.0
+        order = np.lexsort((tris, nodes))
+        nodes, tris = nodes[order], tris[order]
+        counts = np.bincount(nodes, minlength=len(node_bases))
+        split = counts > max_triangles
+        if half_width < min_width:
+            split[:] = False
+        # Only keep the triangles of the leaves, as the ones of split cubes are passed on to the next level.
+        leaf_counts = np.where(split, 0, counts)
+        levels.append((node_bases, width, np.cumsum(leaf_counts) - leaf_counts, counts, split, tris[~split[nodes]]))
+        Profiler.count("Octree cubes of width {:g}".format(width), len(node_bases))
+        if not split.any():
+            break
+        parents = np.flatnonzero(split)
+        first_child = np.full(len(node_bases), -1, np.intp)
+        first_child[parents] = np.arange(0, len(parents)) * 8
+        child_bases = (node_bases[parents][:, np.newaxis] + _OCTANTS * np.float32(half_width)).reshape(-1, 3)
+        # Find the children each triangle lies in, relative to the center of the parent in units of half its width.
+        in_split = split[nodes]
+        nodes, tris = nodes[in_split], tris[in_split]
+        # Each relative bound is reduced to masks right away, so that only one of them is held at a time.
+        center = node_bases[nodes] + np.float32(half_width)
+        relative = (triangles.aabb_min[tris] - center).astype(np.float64) / half_width
+        lo = relative > _BIN_MARGIN
+        contained = (relative >= _BIN_MARGIN - 1).all(axis=1)
+        relative = (triangles.aabb_max[tris] - center).astype(np.float64) / half_width
+        hi = relative >= -_BIN_MARGIN
+        contained &= (relative <= 1 - _BIN_MARGIN).all(axis=1) & (lo == hi).all(axis=1)
+        del center, relative
+        rows, cells = _expand_ranges(lo[~contained].astype(np.intp), hi[~contained].astype(np.intp))
+        straddling = np.flatnonzero(~contained)[rows]
+        nodes, tris = _merge_binned(triangles, child_bases, half_width / 2.0,
+                                    first_child[nodes[contained]] + np.dot(lo[contained], (1, 2, 4)), tris[contained],
+                                    first_child[nodes[straddling]] + np.dot(cells, (1, 2, 4)), tris[straddling])
+        node_bases = child_bases
+        width = half_width
+    return levels
+
+def _estimate_octree(levels, max_triangles, min_width):
+    # Find the cubes of the binned levels which exist with the given parameters to estimate the size of the octree and
+    # the cost of a lookup, being the triangles and levels visited to reach a random point of the world.
+    size = 2 # All empty leaves share one terminated list.
+    depth = 0
+    leaf_counts = []
+    cost = 0.0
+    volume = 0.0
+    exists = None
+    for level, (node_bases, width, starts, counts, split, tris) in enumerate(levels):
+        if exists is None:
+            exists = np.ones(len(counts), bool)
+        else:
+            exists = parent_split[np.flatnonzero(parent_finest_split).repeat(8)]
+        if not exists.any():
+            break
+        depth = level
+        parent_split = exists & (counts > max_triangles) & (width / 2.0 >= min_width)
+        parent_finest_split = split
+        leaf = exists & ~parent_split
+        leaf_count = counts[leaf]
+        size += 4 * int(exists.sum()) + int((2 * leaf_count[leaf_count > 0] + 2).sum())
+        leaf_counts.append(leaf_count)
+        # Each cube of a level covers an eighth of the volume of its parent.
+        cost += (leaf_count.sum() + _DESCENT_COST * level * len(leaf_count)) / 8.0 ** level
+        volume += len(leaf_count) / 8.0 ** level
+    leaf_counts = np.concatenate(leaf_counts)
+    return {
+        "max_triangles": max_triangles,
+        "min_width": min_width,
+        "size": size,
+        "depth": depth,
+        "mean_leaf_triangles": float(leaf_counts.mean()),
+        "max_leaf_triangles": int(leaf_counts.max()),
+        "lookup_cost": cost / volume
+    }
+
+def _get_root_bases(base, cube_size, divisions):
+    return [np.asarray(base, np.float32) + np.array((x, y, z), np.float32) * cube_size
+            for z in range(0, divisions[2]) for y in range(0, divisions[1]) for x in range(0, divisions[0])]
+
+def _hash_triangles(triangles):
+    # Return a 64-bit hash of the corners and normal of each triangle, being all that decides the cubes it lies in.
+    words = np.ascontiguousarray(np.concatenate((triangles.vertices.reshape(-1, 9), triangles.normals), axis=1),
+                                 np.float32).view(np.uint32).astype(np.uint64)
+    hashes = np.full(len(words), 0xCBF29CE484222325, np.uint64)
+    for i in range(0, words.shape[1]):
+        hashes ^= words[:, i]
+        hashes *= np.uint64(0x100000001B3)
+    # Mix the bits of the last words into all others.
+    hashes ^= hashes >> np.uint64(33)
+    hashes *= np.uint64(0xFF51AFD7ED558CCD)
+    hashes ^= hashes >> np.uint64(33)
+    return hashes
+
+def _create_record(node, hashes):
+    # Return the leaf flags of the subtree in depth-first order and the distinct triangle hashes of each leaf.
+    flags, counts, lists = [], [], []
+
+    def visit(node):
+        flags.append(node.is_leaf)
+        if node.is_leaf:
+            leaf_hashes = np.unique(hashes[np.asarray(node.indices, np.intp)])
+            counts.append(len(leaf_hashes))
+            lists.append(leaf_hashes)
+        else:
+            for branch in node.branches:
+                visit(branch)
+
+    visit(node)
+    return np.array(flags, bool), np.array(counts, np.intp), np.concatenate(lists).astype(np.uint64)
+
+def _create_subtrees(records, bases, width, order, sorted_hashes):
+    # Recreate the subtrees of the given records, looking up the current indices of the triangles with the stored
+    # hashes of all of them at once. Equal triangles share their hash, and each of them lies in the same cubes.
+    flags = np.concatenate([record[0] for record in records]).tolist()
+    counts = np.concatenate([record[1] for record in records])
+    lists = np.concatenate([record[2] for record in records])
+    lo = np.searchsorted(sorted_hashes, lists, "left")
+    sizes = np.searchsorted(sorted_hashes, lists, "right") - lo
+    indices = order[np.repeat(lo - (np.cumsum(sizes) - sizes), sizes) + np.arange(0, sizes.sum())]
+    # Sort the indices within each leaf like the builders do.
+    size_ends = np.concatenate(([0], np.cumsum(sizes)))
+    leaf_sizes = size_ends[np.cumsum(counts)] - size_ends[np.cumsum(counts) - counts]
+    indices = indices[np.lexsort((indices, np.repeat(np.arange(0, len(counts)), leaf_sizes)))]
+    leaf_ends = np.cumsum(leaf_sizes).tolist()
+    leaf_sizes = leaf_sizes.tolist()
+    position = {"node": 0, "leaf": 0}
+    child_offsets = {} # The offsets of the children of cubes of each width.
+
+    def create(base, width):
+        node = position["node"]
+        position["node"] += 1
+        if flags[node]:
+            leaf = position["leaf"]
+            position["leaf"] += 1
+            return KclModel.OctreeNode.from_data(base, width, indices[leaf_ends[leaf] - leaf_sizes[leaf]:leaf_ends[leaf]])
+        offsets = child_offsets.get(width)
+        if offsets is None:
+            offsets = child_offsets[width] = list(_OCTANTS * np.float32(width / 2.0))
+        children = base + offsets
+        return KclModel.OctreeNode.from_data(base, width, None, [create(child, width / 2.0) for child in children])
+
+    return [create(base, width) for base in bases]
+
+def _expand_ranges(lo, hi):
+    # Enumerate the cells in the given inclusive ranges, returning the row each cell belongs to and its coordinates.
+    sizes = hi - lo + 1
+    counts = sizes.prod(axis=1)
+    rows = np.repeat(np.arange(0, len(lo)), counts)
+    k = np.arange(0, counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    size_x, size_y = sizes[rows, 0], sizes[rows, 1]
+    return rows, lo[rows] + np.stack((k % size_x, k // size_x % size_y, k // (size_x * size_y)), axis=1)
+
+def _merge_binned(triangles, node_bases, half_width, nodes, tris, straddling_nodes, straddling_tris):
+    # Keep the triangles binned into a single cube and those of the straddling ones really overlapping their cube.
+    Profiler.count("Octree overlap tests of width {:g}".format(half_width * 2), len(straddling_tris))
+    overlap = np.zeros(len(straddling_tris), bool)
+    for start in range(0, len(straddling_tris), _OVERLAP_CHUNK):
+        chunk = slice(start, start + _OVERLAP_CHUNK)
+        center = node_bases[straddling_nodes[chunk]] + np.float32(half_width)
+        overlap[chunk] = KclModel.OctreeNode.tricube_overlap(triangles, straddling_tris[chunk], center, half_width)
+    return np.concatenate((nodes, straddling_nodes[overlap])), np.concatenate((tris, straddling_tris[overlap]))
+
+def _get_shared_memory():
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        return None
+    return shared_memory
+
+def _share_array(array):
+    memory = _get_shared_memory().SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, array.dtype, memory.buf)[...] = array
+    return memory
+
+def _init_worker(vertices_name, normals_name, count, profile):
+    global _worker_memory
+    global _worker_triangles
+    # Start with empty counters, as forked workers inherit the ones of the parent process.
+    Profiler.begin(profile)
+    shared_memory = _get_shared_memory()
+    _worker_memory = [shared_memory.SharedMemory(vertices_name), shared_memory.SharedMemory(normals_name)]
+    vertices = np.ndarray((count, 3, 3), np.float32, _worker_memory[0].buf)
+    normals = np.ndarray((count, 3), np.float32, _worker_memory[1].buf)
+    _worker_triangles = KclModel.OctreeTriangles(vertices, normals)
+
+def _build_subtree(task):
+    # Return the subtree together with the counters recorded while building it, which are summed up by the parent.
+    base, cube_size, max_triangles, min_width = task
+    node = KclModel.OctreeNode(base, cube_size, _worker_triangles, np.arange(len(_worker_triangles)),
+                               max_triangles, min_width)
+    return node, Profiler.take_counters()
@@ -0,0 +1,210 @@
+import math
+import numpy as np
+from .binary_io import BinaryWriter
+from .kcl_file import KclModel
+from .kcl_octree import build_octree, split_models, tune_octree, write_model_octree, write_octree
+from .log import Log, Profiler
+
+class KclWriter:
+    def __init__(self, max_octree_cube_triangles=32, min_octree_cube_size=256, octree_processes=1,
+                 octree_engine="recursive", auto_tune_octree=False, octree_budget=8.0, octree_cache=None,
+                 pool_tolerance=0.0):
+        self.max_octree_cube_triangles = max_octree_cube_triangles
+        self.min_octree_cube_size = min_octree_cube_size
+        self.octree_processes = octree_processes
+        self.octree_engine = octree_engine
+        # When auto tuning, the octree parameters are chosen per model to get the cheapest lookups with an octree of at
+        # most the budget in bytes per triangle.
+        self.auto_tune_octree = auto_tune_octree
+        self.octree_budget = octree_budget
+        # An OctreeCache of the last export to only rebuild the parts of the octrees whose triangles changed.
+        self.octree_cache = octree_cache
+        # Positions and normals whose coordinates round to the same multiples of this tolerance are stored only once,
+        # moving them by up to half of it. With 0, only equal single precision values are shared.
+        self.pool_tolerance = pool_tolerance
+
+    def write(self, raw, vertices, normals, collision_flags):
+        # Write a new KCL file with the given triangle corners and face normals in a Y-up coordinate system into a
+        # stream, or atomically replace the file at the given path.
+        triangles = KclModel.OctreeTriangles(vertices, normals)
+        collision_flags = np.asarray(collision_flags, np.uint16)
+        # Find the minimum and maximum point of the world and the exponents with which its size is calculated.
+        with Profiler.phase("Bounding box computation"):
+            bb_min, bb_max, exponents = self._get_bounds(triangles.vertices)
+        # Split the triangles into models small enough to index all their triangles, positions and normals.
+        with Profiler.phase("Model split"):
+            normals = self._get_normals(triangles)
+            model_octree, models = split_models(triangles, bb_min, [2 ** exponent for exponent in exponents],
+                lambda indices: self._fits_model(triangles, normals, indices), self.min_octree_cube_size)
+        if len(models) > 1:
+            Log.write(0, "Splitting {} triangles into {} models.".format(len(triangles), len(models)))
+        # Write the KCL file.
+        with BinaryWriter(raw, ">") as writer:
+            # Write the header.
+            writer.write_uint32(0x02020000) # Header bytes
+            model_octree_offset = writer.reserve_offset()
+            model_offset_array_offset = writer.reserve_offset()
+            writer.write_uint32(len(models)) # Model count
+            writer.write_singles(bb_min)
+            writer.write_singles(bb_max)
+            writer.write_uint32(exponents[0]) # Coordinate shift X
+            writer.write_uint32(exponents[1]) # Coordinate shift Y
+            writer.write_uint32(exponents[2]) # Coordinate shift Z
+            writer.write_uint32(0) # unknown0x34, seems to be stable with 0.
+            # Write the model octree.
+            writer.satisfy_offset(model_octree_offset, writer.tell())
+            writer.write_bytes(write_model_octree(model_octree, writer.endianness))
+            # Write the model offset array.
+            writer.satisfy_offset(model_offset_array_offset, writer.tell())
+            mesh_offsets = []
+            for i in range(0, len(models)):
+                mesh_offsets.append(writer.reserve_offset())
+            # Write the model section (which has offsets relative to itself, as it's just modified MKWii KCL data).
+            for i, indices in enumerate(models):
+                model_address = writer.tell()
+                writer.satisfy_offset(mesh_offsets[i], model_address)
+                self._write_model(writer, model_address, KclModel.OctreeTriangles(triangles.vertices[indices],
+                    triangles.normals[indices]), normals[indices], collision_flags[indices], indices)
+        if self.octree_cache is not None:
+            Log.write(0, "Reused {} of {} octree cubes from the cache.".format(self.octree_cache.reused_cubes,
+                                                                              self.octree_cache.root_cubes))
+
+    def _write_model(self, writer, model_address, triangles, normals, collision_flags, global_indices):
+        with Profiler.phase("Bounding box computation"):
+            bb_min, bb_max, exponents = self._get_bounds(triangles.vertices)
+        # Find the size of the sub cubes which must be powers of 2 (unlike the cuboid world holding them).
+        sub_cube_exponent = min(exponents) - 1
+        divs_x = 2 ** (exponents[0] - sub_cube_exponent)
+        divs_y = 2 ** (exponents[1] - sub_cube_exponent)
+        divs_z = 2 ** (exponents[2] - sub_cube_exponent)
+        cube_size = 2 ** sub_cube_exponent
+        max_triangles = self.max_octree_cube_triangles
+        min_width = self.min_octree_cube_size
+        if self.auto_tune_octree:
+            with Profiler.phase("Octree tuning"):
+                metrics, results = tune_octree(triangles, bb_min, cube_size, (divs_x, divs_y, divs_z),
+                                               self.octree_budget * len(triangles))
+            max_triangles = metrics["max_triangles"]
+            min_width = metrics["min_width"]
+            Log.write(0, "Tuned octree of {} triangles to {} max. cube triangles and {} min. cube size.".format(
+                len(triangles), max_triangles, min_width))
+            Log.write(1, "Size: {} bytes, depth: {}, leaf triangles: {:.1f} mean, {} max, lookup cost: {:.2f}".format(
+                metrics["size"], metrics["depth"], metrics["mean_leaf_triangles"], metrics["max_leaf_triangles"],
+                metrics["lookup_cost"]))
+            if metrics["size"] > self.octree_budget * len(triangles):
+                Log.write(1, "No octree fits into the budget, so the smallest one is used.")
+        # Build the octree, creating the first level of sub cubes.
+        with Profiler.phase("Octree build"):
+            build = build_octree if self.octree_cache is None else self.octree_cache.build_octree
+            octree = build(triangles, bb_min, cube_size, (divs_x, divs_y, divs_z), max_triangles, min_width,
+                self.octree_processes, self.octree_engine)
+        # Compute the triangle data, sharing equal positions and normals between the triangles.
+        with Profiler.phase("Section serialization"):
+            positions, normals, kcl_triangles = self._create_triangles(triangles, normals, collision_flags,
+                                                                       global_indices)
+        # Write the model header.
+        positions_offset = writer.reserve_offset()
+        normals_offset = writer.reserve_offset()
+        triangles_offset = writer.reserve_offset()
+        octree_offset = writer.reserve_offset()
+        writer.write_single(30) # unknown0x10
+        writer.write_singles(bb_min)
+        writer.write_uint32((0xFFFFFFFF << exponents[0]) & 0xFFFFFFFF) # Mask X
+        writer.write_uint32((0xFFFFFFFF << exponents[1]) & 0xFFFFFFFF) # Mask Y
+        writer.write_uint32((0xFFFFFFFF << exponents[2]) & 0xFFFFFFFF) # Mask Z
+        writer.write_uint32(sub_cube_exponent) # Coordinate Shift X
+        writer.write_uint32(exponents[0] - sub_cube_exponent) # Coordinate Shift Y
+        writer.write_uint32(exponents[0] - sub_cube_exponent + exponents[1] - sub_cube_exponent) # Coordinate Shift Z
+        writer.write_single(0) # unknown0x38
+        # Write the positions section.
+        writer.satisfy_offset(positions_offset, writer.tell() - model_address)
+        writer.write_array(positions, "f4")
+        # Write the normals section.
+        writer.satisfy_offset(normals_offset, writer.tell() - model_address)
+        writer.write_array(normals, "f4")
+        # Write the triangles section.
+        writer.satisfy_offset(triangles_offset, writer.tell() - model_address)
+        writer.write_bytes(kcl_triangles)
+        # Write the octree section.
+        octree_address = writer.tell()
+        writer.satisfy_offset(octree_offset, octree_address - model_address)
+        with Profiler.phase("Octree serialization"):
+            writer.write_bytes(write_octree(octree, writer.endianness))
+
+    @staticmethod
+    def _get_bounds(vertices):
+        # Return the minimum and maximum point of the vertices and the exponents of the cuboid size including them.
+        bb_min = vertices.reshape(-1, 3).min(axis=0).tolist()
+        bb_max = vertices.reshape(-1, 3).max(axis=0).tolist()
+        exponents = (KclWriter._next_power_of_2(bb_max[0] - bb_min[0]),
+                     KclWriter._next_power_of_2(bb_max[1] - bb_min[1]),
+                     KclWriter._next_power_of_2(bb_max[2] - bb_min[2]))
+        return bb_min, bb_max, exponents
+
+    @staticmethod
+    def _get_normals(triangles):
+        # Compute the direction and the three edge normals of each triangle, from which its corners are reconstructed.
+        u, v, w = (triangles.vertices[:, i].astype(np.float64) for i in range(0, 3))
+        direction = triangles.normals.astype(np.float64)
+
+        def normalized(vectors):
+            lengths = np.linalg.norm(vectors, axis=1, keepdims=True)
+            return vectors / np.where(lengths == 0, 1, lengths)
+
+        normal_a = -normalized(np.cross(w - u, direction))
+        normal_b = normalized(np.cross(v - u, direction))
+        normal_c = normalized(np.cross(w - v, direction))
+        return np.stack((direction, normal_a, normal_b, normal_c), axis=1)
+
+    def _fits_model(self, triangles, normals, indices):
+        # Triangles are referenced by 16-bit indices with 0xFFFF terminating the octree lists, positions and normals by
+        # 16-bit indices as well.
+        if len(indices) > 0xFFFF:
+            return False
+        if 4 * len(indices) <= 0x10000:
+            return True
+        return len(self._pool(triangles.vertices[indices, 0], self.pool_tolerance)[0]) <= 0x10000 \
+            and len(self._pool(normals[indices], self.pool_tolerance)[0]) <= 0x10000
+
+    def _create_triangles(self, triangles, normals, collision_flags, global_indices):
+        # Store equal positions and normals only once as they are quantized to single precision in the file.
+        positions, position_indices = self._pool(triangles.vertices[:, 0], self.pool_tolerance)
+        normal_pool, normal_indices = self._pool(normals, self.pool_tolerance)
+        normal_indices = normal_indices.reshape(-1, 4)
+        if len(positions) > 0x10000 or len(normal_pool) > 0x10000:
+            raise AssertionError("The model has more distinct positions or normals than can be indexed.")
+        kcl_triangles = np.zeros(len(triangles), KclModel.Triangle.dtype)
+        # Measure from the shared position, which a tolerance may have moved away from the first corner.
+        u, w = positions[position_indices].astype(np.float64), triangles.vertices[:, 2].astype(np.float64)
+        kcl_triangles["length"] = np.einsum("ij,ij->i", w - u, normals[:, 3])
+        kcl_triangles["position_index"] = position_indices
+        kcl_triangles["direction_index"] = normal_indices[:, 0]
+        kcl_triangles["normal_a_index"] = normal_indices[:, 1]
+        kcl_triangles["normal_b_index"] = normal_indices[:, 2]
+        kcl_triangles["normal_c_index"] = normal_indices[:, 3]
+        kcl_triangles["collision_flags"] = collision_flags
+        kcl_triangles["global_index"] = global_indices
+        shared_positions = len(triangles) - len(positions)
+        shared_normals = 4 * len(triangles) - len(normal_pool)
+        Log.write(0, "Shared {} positions and {} normals between {} triangles, saving {} bytes.".format(
+            shared_positions, shared_normals, len(triangles), (shared_positions + shared_normals) * 12))
+        return positions, normal_pool, kcl_triangles
+
+    @staticmethod
+    def _pool(vectors, tolerance=0.0):
+        # Return the distinct single precision vectors in the order they first appear, and the index of each vector.
+        # With a tolerance, vectors rounding to the same multiples of it are merged into the first one of them.
+        vectors = vectors.reshape(-1, 3).astype(np.float32) + np.float32(0) # Adding 0 turns -0 into 0.
+        keys = np.round(vectors / np.float64(tolerance)) + 0.0 if tolerance > 0 else vectors
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True, axis=0)
+        order = np.argsort(first)
+        rank = np.empty(len(order), np.intp)
+        rank[order] = np.arange(0, len(order))
+        return vectors[first[order]], rank[inverse.reshape(-1)]
+
+    @staticmethod
+    def _next_power_of_2(value):
+        # Return the next power of 2 bigger than the value.
+        if value <= 1:
+            return 0
+        return int(math.ceil(math.log(value, 2)))
@@ -1,5 +1,96 @@
+import contextlib
+import json
+import os
+import time
+
 class Log:
     @staticmethod
     def write(indent, text):
         indent = " " * 2 * indent
         print("KCL: " + indent + text)
+
+def _is_enabled(value):
+    # Parse a switch given by an environment variable, being off unless it is set to one of the values turning it on.
+    return (value or "").strip().lower() in ("1", "true", "yes", "on")
+
+class _NoPhase:
+    # Context doing nothing, reused for all phases while the profiler is disabled.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+class Profiler:
+    # Times pipeline phases and sums counters while enabled by an operator option or the KCL_PROFILE environment
+    # variable. The results are logged, and written as a Chrome trace if a file is given, e.g. by KCL_PROFILE_TRACE.
+    enabled = _is_enabled(os.environ.get("KCL_PROFILE"))
+    trace_path = os.environ.get("KCL_PROFILE_TRACE")
+    events = []
+    counters = {}
+    _depth = 0
+    _start = 0
+    _disabled_phase = _NoPhase()
+
+    @staticmethod
+    def begin(enabled=False, trace_path=None):
+        Profiler.enabled = enabled or _is_enabled(os.environ.get("KCL_PROFILE"))
+        Profiler.trace_path = trace_path or os.environ.get("KCL_PROFILE_TRACE")
+        Profiler.events = []
+        Profiler.counters = {}
+        Profiler._depth = 0
+        Profiler._start = time.perf_counter()
+
+    @staticmethod
+    def end():
+        if not Profiler.enabled:
+            return
+        Profiler.enabled = False
+        # Log the phases in the order they started, indented by their nesting.
+        for name, depth, start, duration in sorted(Profiler.events, key=lambda event: event[2]):
+            Log.write(depth, "{}: {:.3f} ms".format(name, duration * 1000))
+        for name, value in sorted(Profiler.counters.items()):
+            Log.write(0, "{}: {}".format(name, value))
+        if Profiler.trace_path:
+            events = [{"name": name, "ph": "X", "ts": start * 1e6, "dur": duration * 1e6, "pid": os.getpid(), "tid": 0}
+                      for name, depth, start, duration in Profiler.events]
+            with open(Profiler.trace_path, "w") as file:
+                json.dump({"traceEvents": events, "otherData": {"counters": Profiler.counters}}, file)
+
+    @staticmethod
+    def phase(name):
+        # Return a context measuring the time spent in it, which does nothing while disabled.
+        if not Profiler.enabled:
+            return Profiler._disabled_phase
+        return Profiler._phase(name)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _phase(name):
+        depth = Profiler._depth
+        Profiler._depth += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            Profiler._depth = depth
+            Profiler.events.append((name, depth, start - Profiler._start, end - start))
+
+    @staticmethod
+    def count(name, value=1):
+        if Profiler.enabled:
+            Profiler.counters[name] = Profiler.counters.get(name, 0) + int(value)
+
+    @staticmethod
+    def take_counters():
+        # Return the counters summed up so far and start new ones, e.g. to send the ones of a worker process back.
+        counters = Profiler.counters
+        Profiler.counters = {}
+        return counters
+
+    @staticmethod
+    def add_counters(counters):
+        # Add the counters of a worker process to the ones of this process.
+        for name, value in counters.items():
+            Profiler.counters[name] = Profiler.counters.get(name, 0) + value
@@ -0,0 +1,62 @@
+import numpy as np
+
+# Material name prefix storing the collision flags of the faces following it.
+_FLAGS_MATERIAL = "kcl_flags_"
+
+def write_obj(file, kcl_file):
+    # Write the triangles of each model as a separate object, grouping them by their collision flags into materials.
+    # Triangles stored in several models are only written into the first one.
+    vertex_offset = 1
+    for model_index, (kcl_model, unique) in enumerate(zip(kcl_file.models, kcl_file.unique_triangles())):
+        vertices, degenerate = kcl_model.all_triangle_vertices()
+        indices = np.flatnonzero(~degenerate & unique)
+        flags = kcl_model.triangles.collision_flags[indices]
+        file.write("o Model {}\n".format(str(model_index).zfill(2)))
+        np.savetxt(file, vertices[indices].reshape(-1, 3), "v %.9g %.9g %.9g")
+        # Write the faces of each flag value together to only switch the material once per value.
+        order = np.argsort(flags, kind="stable")
+        for value in np.unique(flags):
+            file.write("usemtl {}{}\n".format(_FLAGS_MATERIAL, value))
+            faces = order[flags[order] == value]
+            np.savetxt(file, vertex_offset + 3 * faces[:, np.newaxis] + np.arange(0, 3), "f %d %d %d")
+        vertex_offset += 3 * len(indices)
+
+def read_obj(file):
+    # Read the faces of all objects, splitting polygons into triangle fans, and return their corners, normals and the
+    # collision flags stored in the name of their material.
+    positions = []
+    triangles = []
+    collision_flags = []
+    flags = 0
+    for line_number, line in enumerate(file, 1):
+        parts = line.split()
+        if not parts:
+            continue
+        if parts[0] == "v":
+            positions.append([float(value) for value in parts[1:4]])
+        elif parts[0] == "f":
+            # Only the position indices are required, which can also be relative to the end of the list.
+            corners = [int(part.split("/")[0]) for part in parts[1:]]
+            corners = [i - 1 if i > 0 else len(positions) + i for i in corners]
+            for i in range(1, len(corners) - 1):
+                triangles.append((corners[0], corners[i], corners[i + 1]))
+                collision_flags.append(flags)
+        elif parts[0] == "usemtl":
+            name = parts[1] if len(parts) > 1 else ""
+            flags = _parse_flags(name, line_number) if name.startswith(_FLAGS_MATERIAL) else 0
+    vertices = np.array(positions, np.float32).reshape(-1, 3)[np.array(triangles, np.intp).reshape(-1, 3)]
+    normals = np.cross(vertices[:, 1] - vertices[:, 0], vertices[:, 2] - vertices[:, 0])
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    normals = (normals / np.where(lengths == 0, 1, lengths)).astype(np.float32)
+    return vertices, normals, np.array(collision_flags, np.uint16)
+
+def _parse_flags(name, line_number):
+    # Return the collision flags stored in the name of a material like "kcl_flags_0x1234".
+    try:
+        flags = int(name[len(_FLAGS_MATERIAL):], 0)
+    except ValueError:
+        flags = -1
+    if not 0 <= flags <= 0xFFFF:
+        raise AssertionError("The material '{}' in line {} does not name 16-bit collision flags.".format(
+            name, line_number))
+    return flags
@@ -0,0 +1,373 @@
+import io
+import numpy as np
+import re
+import struct
+from .binary_io import BinaryReader, BinaryWriter
+from .kcl_file import KclFile
+from .log import Profiler
+
+# The chunks described by each Yaz0 code byte, being the lengths of runs of literal bytes or 0 for a back reference.
+_YAZ0_RUNS = [tuple(len(chunk) if chunk[0] == "1" else 0 for chunk in re.findall("1+|0", "{:08b}".format(code)))
+              for code in range(0, 0x100)]
+# Number of groups of literal bytes only which are checked for at once when decompressing.
+_YAZ0_LITERAL_GROUPS = 512
+# Farthest distance and longest length of a back reference in Yaz0 data.
+_YAZ0_MAX_DISTANCE = 0x1000
+_YAZ0_MAX_LENGTH = 0x111
+# Paths of KCL files in archives, like "course.szs" or "course.szs:course.kcl".
+_ARCHIVE_PATH = re.compile(r"^(.*\.(?:szs|sarc))(?::(.+))?$", re.IGNORECASE)
+
+class Yaz0Decoder:
+    # Decompresses Yaz0 data into a buffer allocated once, only as far as it was requested so far. Views on the buffer
+    # stay valid while more data is decompressed behind them.
+    def __init__(self, data):
+        self.data = memoryview(data)
+        if bytes(self.data[:4]) != b"Yaz0":
+            raise AssertionError("Invalid Yaz0 header.")
+        self.output = bytearray(struct.unpack_from(">I", self.data, 4)[0])
+        self.size = 0
+        self._source = 16
+
+    def decompress(self, end):
+        # Decompress the data until at least the given number of bytes is available and return a view on them.
+        end = min(end, len(self.output))
+        if self.size >= end:
+            return memoryview(self.output)[:end]
+        data, output = self.data, self.output
+        # Copies between memory views are about twice as fast as assigning views to slices of the bytearray.
+        view = memoryview(output)
+        source, position, size, data_size = self._source, self.size, len(output), len(data)
+        with Profiler.phase("Yaz0 decompression"):
+            try:
+                while position < end:
+                    code = data[source]
+                    if code == 0xFF and position + 8 <= size and source + 9 <= data_size:
+                        # Groups of literal bytes only are common in data compressing badly, so the ones following each
+                        # other are copied at once, dropping the code byte in front of each group of 8 bytes.
+                        count = min((size - position) // 8, (data_size - source) // 9, _YAZ0_LITERAL_GROUPS)
+                        if count > 1 and data[source + 9] == 0xFF:
+                            count -= len(bytes(data[source:source + 9 * count:9]).lstrip(b"\xFF"))
+                            view[position:position + 8 * count] = np.frombuffer(data, np.uint8, 9 * count, source) \
+                                .reshape(count, 9)[:, 1:].tobytes()
+                            source += 9 * count
+                            position += 8 * count
+                        else:
+                            view[position:position + 8] = data[source + 1:source + 9]
+                            source += 9
+                            position += 8
+                        continue
+                    source += 1
+                    for run in _YAZ0_RUNS[code]:
+                        if position >= size:
+                            break
+                        if run:
+                            # Copy a run of literal bytes.
+                            if position + run > size:
+                                run = size - position
+                            if source + run > data_size:
+                                raise IndexError()
+                            view[position:position + run] = data[source:source + run]
+                            source += run
+                            position += run
+                            continue
+                        # Copy previously decompressed bytes, repeating them if the copy overlaps itself.
+                        pair = data[source] << 8 | data[source + 1]
+                        source += 2
+                        start = position - (pair & 0xFFF) - 1
+                        length = pair >> 12
+                        if length:
+                            length += 2
+                        else:
+                            length = data[source] + 0x12
+                            source += 1
+                        if start < 0:
+                            raise AssertionError("Invalid Yaz0 data referencing bytes before its start.")
+                        if position + length > size:
+                            length = size - position
+                        if start + length <= position:
+                            view[position:position + length] = view[start:start + length]
+                        else:
+                            pattern = output[start:position]
+                            view[position:position + length] = (pattern * (length // len(pattern) + 1))[:length]
+                        position += length
+            except IndexError:
+                raise AssertionError("The Yaz0 data ends before all bytes were decompressed.")
+        self._source, self.size = source, position
+        return view[:end]
+
+def yaz0_decompress(data):
+    # Return all decompressed bytes of Yaz0 data.
+    decoder = Yaz0Decoder(data)
+    return decoder.decompress(len(decoder.output))
+
+def yaz0_compress(data, level=6):
+    # Return the data compressed with Yaz0. Level 0 only stores the bytes, which is fastest but does not shrink them,
+    # while each further level up to 9 searches twice as many earlier positions for the longest back reference.
+    if not 0 <= level <= 9:
+        raise AssertionError("The Yaz0 compression level must be between 0 and 9.")
+    data = bytes(data)
+    size = len(data)
+    output = bytearray(b"Yaz0" + struct.pack(">III", size, 0, 0))
+    with Profiler.phase("Yaz0 compression"):
+        if level == 0:
+            for i in range(0, size, 8):
+                group = data[i:i + 8]
+                output.append(0xFF << (8 - len(group)) & 0xFF)
+                output += group
+            return bytes(output)
+        values = np.frombuffer(data, np.uint8)
+        lengths, distances = _find_yaz0_matches(values, 1 << (level - 1))
+        output += _encode_yaz0(values, lengths, distances)
+    return bytes(output)
+
+def _find_yaz0_matches(data, attempts):
+    # Return the length and distance of the longest back reference at each position, or a distance of 0 if there is
+    # none of at least 3 bytes. Of equally long ones, the closest one is used. The given number of the closest earlier
+    # positions starting with the same 3 bytes are compared at once for all positions.
+    size = len(data)
+    lengths = np.full(size, 2, np.int32)
+    distances = np.zeros(size, np.int32)
+    if size < 4:
+        return lengths, distances
+    keys = data[:-2].astype(np.int32) << 16 | data[1:-1].astype(np.int32) << 8 | data[2:]
+    # Sorting the positions by their first bytes puts the earlier ones with the same bytes right before them.
+    order = np.argsort(keys, kind="stable").astype(np.int32)
+    sorted_keys = keys[order]
+    max_lengths = np.minimum(_YAZ0_MAX_LENGTH, size - np.arange(0, size, dtype=np.int32))
+    # Compare 8 bytes at once with the words starting at each position.
+    padded = np.concatenate((data, np.zeros(8, np.uint8)))
+    words = np.zeros(size, np.uint64)
+    for i in range(0, 8):
+        words |= padded[i:i + size].astype(np.uint64) << np.uint64(8 * i)
+    searched = np.arange(0, len(order), dtype=np.int32)
+    for attempt in range(1, attempts + 1):
+        searched = searched[searched >= attempt]
+        searched = searched[sorted_keys[searched - attempt] == sorted_keys[searched]]
+        positions = order[searched]
+        candidates = order[searched - attempt]
+        # Earlier candidates are only farther away.
+        near = positions - candidates <= _YAZ0_MAX_DISTANCE
+        searched, positions, candidates = searched[near], positions[near], candidates[near]
+        if not len(searched):
+            break
+        length = _get_yaz0_match_lengths(data, words, positions, candidates, max_lengths[positions])
+        better = length > lengths[positions]
+        lengths[positions[better]] = length[better]
+        distances[positions[better]] = (positions - candidates)[better]
+    return lengths, distances
+
+def _get_yaz0_match_lengths(data, words, positions, candidates, max_lengths):
+    # Return how many bytes at the positions equal the ones at the candidates, knowing that the first 3 bytes do.
+    lengths = np.full(len(positions), 3, np.int32)
+    active = np.arange(0, len(positions))
+    for step, values in ((8, words), (1, data)):
+        while len(active):
+            active = active[lengths[active] + step <= max_lengths[active]]
+            ends = lengths[active]
+            active = active[values[positions[active] + ends] == values[candidates[active] + ends]]
+            lengths[active] += step
+        active = np.arange(0, len(positions))
+    return lengths
+
+def _encode_yaz0(data, lengths, distances):
+    # Return the chunks of the longest back references found at each position greedily, or the bytes at positions
+    # without any, each group of 8 chunks being preceded by a code byte with the bits of the literal bytes set.
+    size = len(data)
+    match_positions = np.flatnonzero(distances)
+    match_lengths = lengths[match_positions].tolist()
+    chosen = []
+    position = 0
+    for i, match_position in enumerate(match_positions.tolist()):
+        if match_position >= position:
+            chosen.append(i)
+            position = match_position + match_lengths[i]
+    starts = match_positions[chosen]
+    ends = starts + lengths[starts]
+    # Chunks start at the chosen back references and the bytes not covered by any of them.
+    covered = np.zeros(size + 1, np.int32)
+    np.add.at(covered, starts, 1)
+    np.add.at(covered, ends, -1)
+    is_match = np.zeros(size, bool)
+    is_match[starts] = True
+    chunks = np.flatnonzero((np.cumsum(covered[:size]) == 0) | is_match)
+    is_match = is_match[chunks]
+    chunk_lengths = lengths[chunks]
+    chunk_sizes = np.where(is_match, np.where(chunk_lengths < 0x12, 2, 3), 1)
+    groups = np.arange(0, len(chunks)) // 8
+    offsets = np.cumsum(chunk_sizes) - chunk_sizes + groups + 1
+    output = np.zeros(int(chunk_sizes.sum()) + (len(chunks) + 7) // 8, np.uint8)
+    bits = np.where(is_match, 0, 0x80 >> (np.arange(0, len(chunks)) % 8))
+    output[offsets[::8] - 1] = np.bincount(groups, bits).astype(np.uint8)
+    literals = chunks[~is_match]
+    output[offsets[~is_match]] = data[literals]
+    matches = chunks[is_match]
+    match_offsets = offsets[is_match]
+    match_lengths = lengths[matches]
+    match_distances = distances[matches] - 1
+    short = match_lengths < 0x12
+    output[match_offsets] = np.where(short, (match_lengths - 2) << 4, 0) | match_distances >> 8
+    output[match_offsets + 1] = match_distances & 0xFF
+    output[match_offsets[~short] + 2] = match_lengths[~short] - 0x12
+    return output.tobytes()
+
+class SarcFile:
+    class Node:
+        def __init__(self, name, name_hash, start, end):
+            self.name = name
+            self.name_hash = name_hash
+            self.start = start
+            self.end = end
+
+    def __init__(self, data):
+        # Read the directory of a SARC archive, decompressing Yaz0 data only up to the end of the directory. The files
+        # are decompressed when they are read.
+        if bytes(memoryview(data)[:4]) == b"Yaz0":
+            self._get_data = Yaz0Decoder(data).decompress
+        else:
+            view = memoryview(data)
+            self._get_data = lambda end: view[:end]
+        with BinaryReader(self._get_data(0x14)) as reader:
+            if reader.read_raw_string(4) != "SARC":
+                raise AssertionError("Invalid SARC header.")
+            reader.seek(6)
+            reader.endianness = ">" if bytes(reader.read_bytes(2)) == b"\xFE\xFF" else "<"
+            reader.seek(4)
+            header_size, _, _, self.data_offset, _ = reader.read("HHIIH")
+            self.endianness = reader.endianness
+        with BinaryReader(self._get_data(self.data_offset), self.endianness) as reader:
+            # Read the file nodes, whose names are stored after them.
+            reader.seek(header_size)
+            magic, _, node_count, self.hash_key = reader.read("4sHHI")
+            if magic != b"SFAT":
+                raise AssertionError("Invalid SARC file allocation table.")
+            nodes = reader.read_records("IIII", node_count)
+            names_offset = reader.tell() + 0x8
+            self.nodes = []
+            for name_hash, attributes, start, end in nodes:
+                if attributes >> 24:
+                    reader.seek(names_offset + (attributes & 0xFFFFFF) * 4)
+                    name = reader.read_0_string("utf-8")
+                else:
+                    name = "0x{:08X}".format(name_hash) # Files without names are only known by their hash.
+                self.nodes.append(self.Node(name, name_hash, start, end))
+        self._nodes = {node.name: node for node in self.nodes}
+
+    @classmethod
+    def open(cls, filepath):
+        with open(filepath, "rb") as raw:
+            return cls(raw.read())
+
+    @property
+    def names(self):
+        return [node.name for node in self.nodes]
+
+    def __contains__(self, name):
+        return name in self._nodes
+
+    def read(self, name):
+        # Return a view on the bytes of the file with the given name, decompressing the archive up to its end.
+        node = self._nodes.get(name)
+        if node is None:
+            raise AssertionError("The archive does not contain a file named '{}'.".format(name))
+        return self._get_data(self.data_offset + node.end)[self.data_offset + node.start:self.data_offset + node.end]
+
+    def read_all(self):
+        # Return the names and contents of all files, e.g. to write them into a new archive.
+        return {node.name: self.read(node.name) for node in self.nodes}
+
+class SarcWriter:
+    def __init__(self, endianness=">", alignment=0x100, compression_level=6):
+        self.endianness = endianness
+        # The byte multiple at which the files start, as the game reads some of them in place.
+        self.alignment = alignment
+        # The Yaz0 compression level from 0 to 9, or None to write an uncompressed archive.
+        self.compression_level = compression_level
+        self.hash_key = 0x65
+
+    def write(self, raw, files):
+        # Write a SARC archive with the given names and contents of the files into a stream, or atomically replace the
+        # file at the given path.
+        nodes = sorted(files, key=self._hash_name)
+        hashes = [self._hash_name(name) for name in nodes]
+        if len(set(hashes)) != len(hashes):
+            raise AssertionError("The archive cannot store files whose names have the same hash.")
+        # The names are aligned to 4 bytes, as the nodes reference them in multiples of 4.
+        name_offsets = []
+        name_offset = 0
+        for name in nodes:
+            name_offsets.append(name_offset // 4)
+            name_offset += len(name.encode("utf-8")) + 1
+            name_offset += -name_offset % 4
+        buffer = io.BytesIO()
+        with BinaryWriter(buffer, self.endianness) as writer:
+            # Write the header.
+            writer.write_raw_string("SARC")
+            writer.write_uint16(0x14) # Header size
+            writer.write_uint16(0xFEFF) # Byte order mark
+            file_size = writer.reserve_offset()
+            data_offset = writer.reserve_offset()
+            writer.write_uint16(0x0100) # Version
+            writer.write_uint16(0)
+            # Write the file nodes.
+            writer.write_raw_string("SFAT")
+            writer.write_uint16(0xC) # Header size
+            writer.write_uint16(len(nodes))
+            writer.write_uint32(self.hash_key)
+            ranges = []
+            for name_hash, name_offset in zip(hashes, name_offsets):
+                writer.write_uint32(name_hash)
+                writer.write_uint32(0x01000000 | name_offset)
+                ranges.append((writer.reserve_offset(), writer.reserve_offset()))
+            # Write the file names.
+            writer.write_raw_string("SFNT")
+            writer.write_uint16(0x8) # Header size
+            writer.write_uint16(0)
+            for name in nodes:
+                writer.write_0_string(name, "utf-8")
+                writer.align(4)
+            # Write the file data, whose offsets are relative to its start.
+            writer.align(self.alignment)
+            data_start = writer.tell()
+            writer.satisfy_offset(data_offset, data_start)
+            for name, (start, end) in zip(nodes, ranges):
+                writer.align(self.alignment)
+                writer.satisfy_offset(start, writer.tell() - data_start)
+                writer.write_bytes(files[name])
+                writer.satisfy_offset(end, writer.tell() - data_start)
+            writer.satisfy_offset(file_size, writer.tell())
+        data = buffer.getvalue()
+        if self.compression_level is not None:
+            data = yaz0_compress(data, self.compression_level)
+        with BinaryWriter(raw) as writer:
+            writer.write_bytes(data)
+
+    def _hash_name(self, name):
+        # Hash the bytes of the name as signed characters like the game does.
+        name_hash = 0
+        for byte in name.encode("utf-8"):
+            name_hash = (name_hash * self.hash_key + (byte - 256 if byte >= 0x80 else byte)) & 0xFFFFFFFF
+        return name_hash
+
+def split_archive_path(path):
+    # Return the archive and file name of a path like "course.szs:course.kcl", with no file name if only the archive is
+    # given, or no archive for paths of plain files.
+    match = _ARCHIVE_PATH.match(path)
+    if match is None:
+        return None, None
+    return match.group(1), match.group(2)
+
+def find_kcl(archive):
+    # Return the name of the KCL file in the archive, like "course.kcl" in course archives.
+    names = [name for name in archive.names if name.lower().endswith(".kcl")]
+    if not names:
+        raise AssertionError("The archive does not contain a KCL file.")
+    return names[0]
+
+def open_kcl(path):
+    # Open a KCL file, mapping plain files into memory and reading files in archives out of the decompressed archive
+    # without copying them, like "course.szs" for its only KCL file or "course.szs:course.kcl".
+    archive_path, name = split_archive_path(path)
+    if archive_path is None:
+        return KclFile.open_mmap(path)
+    archive = SarcFile.open(archive_path)
+    return KclFile(archive.read(name or find_kcl(archive)))
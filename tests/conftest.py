@@ -0,0 +1,22 @@
+import importlib.util
+import os
+import pytest
+import sys
+
+# Load the add-on folder as the io_scene_kcl package, which runs without Blender.
+_SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src")
+if "io_scene_kcl" not in sys.modules:
+    _spec = importlib.util.spec_from_file_location("io_scene_kcl", os.path.join(_SOURCE_DIR, "__init__.py"),
+                                                   submodule_search_locations=[_SOURCE_DIR])
+    _module = importlib.util.module_from_spec(_spec)
+    sys.modules["io_scene_kcl"] = _module
+    _spec.loader.exec_module(_module)
+
+# The benchmarks create the same synthetic meshes as the tests.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "benchmarks"))
+from terrain import create_terrain as _create_terrain
+
+@pytest.fixture
+def create_terrain():
+    # Return the function creating the corners and normals of a height field with the given number of triangles.
+    return _create_terrain
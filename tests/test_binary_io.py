@@ -0,0 +1,61 @@
+import os
+import pytest
+import struct
+from io_scene_kcl.binary_io import BinaryReader, BinaryWriter, replace_file
+
+def test_replace_file(tmp_path):
+    path = str(tmp_path / "course.kcl")
+    with BinaryWriter(path, ">") as writer:
+        writer.write_uint32(1)
+    with open(path, "rb") as file:
+        assert file.read() == b"\x00\x00\x00\x01"
+    assert os.listdir(str(tmp_path)) == ["course.kcl"]
+
+def test_replace_file_keeps_permissions(tmp_path):
+    path = str(tmp_path / "course.kcl")
+    with replace_file(path) as file:
+        file.write(b"a")
+    os.chmod(path, 0o640)
+    with replace_file(path) as file:
+        file.write(b"b")
+    assert os.stat(path).st_mode & 0o777 == 0o640
+
+def test_replace_file_removes_temporary_file_on_error(tmp_path):
+    path = str(tmp_path / "course.kcl")
+    with replace_file(path) as file:
+        file.write(b"a")
+    with pytest.raises(ValueError):
+        with BinaryWriter(path) as writer:
+            writer.write_uint32(2)
+            raise ValueError()
+    with pytest.raises(ValueError):
+        with replace_file(path) as file:
+            file.write(b"b")
+            raise ValueError()
+    with open(path, "rb") as file:
+        assert file.read() == b"a"
+    assert os.listdir(str(tmp_path)) == ["course.kcl"]
+
+@pytest.mark.parametrize("endianness", ["<", ">"])
+def test_read_records(endianness):
+    data = struct.pack(endianness + "4x" + "Hf" * 3, 1, 0.5, 2, 1.5, 3, -2.0)
+    reader = BinaryReader(data, endianness)
+    reader.seek(4)
+    assert reader.read_records("Hf", 2) == [(1, 0.5), (2, 1.5)]
+    assert reader.tell() == 16
+    # Structs are used as they are, and their records are only unpacked when they are consumed.
+    records = reader.iter_records(struct.Struct(endianness + "Hf"), 1)
+    assert reader.tell() == len(data)
+    assert list(records) == [(3, -2.0)]
+    assert reader.read_records("Hf", 0) == []
+
+def test_read_records_past_end():
+    reader = BinaryReader(bytes(10), ">")
+    reader.seek(4)
+    with pytest.raises(struct.error):
+        reader.read_records("H", 4)
+    with pytest.raises(struct.error):
+        reader.iter_records("I", 2)
+    # Failed reads do not move the cursor.
+    assert reader.tell() == 4
+    assert reader.read_records("H", 3) == [(0,), (0,), (0,)]
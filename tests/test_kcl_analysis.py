@@ -0,0 +1,42 @@
+import io
+import numpy as np
+from io_scene_kcl.kcl_analysis import analyze_file, format_report
+from io_scene_kcl.kcl_file import KclFile
+from io_scene_kcl.kcl_writer import KclWriter
+
+def _read(vertices, normals, **writer_args):
+    raw = io.BytesIO()
+    KclWriter(**writer_args).write(raw, vertices, normals, np.zeros(len(vertices)))
+    return KclFile(raw.getvalue())
+
+def test_analyze_file(create_terrain):
+    vertices, normals = create_terrain(2000)
+    kcl_file = _read(vertices, normals)
+    stats = analyze_file(kcl_file)
+    octree = kcl_file.models[0].octree
+    leaves = np.flatnonzero(octree.is_leaf)
+    assert stats["models"] == 1
+    assert stats["triangles"] == len(vertices)
+    assert stats["nodes"] == len(octree.is_leaf)
+    assert stats["leaves"] == len(leaves)
+    assert stats["empty_leaves"] == int((octree.count[leaves] == 0).sum())
+    assert stats["max_leaf_length"] == int(octree.count[leaves].max())
+    assert sum(stats["depth_histogram"].values()) == stats["leaves"]
+    assert sum(stats["leaf_length_histogram"].values()) == stats["leaves"]
+    assert stats["stored_lists"] + stats["shared_lists"] == stats["leaves"]
+    assert sum(stats["sections"].values()) == len(kcl_file.data)
+    # Every triangle lies in the leaf containing its center.
+    assert stats["unreferenced_triangles"] == 0
+    assert stats["max_triangle_references"] == stats["most_referenced"][0]["leaves"] >= 1
+
+def test_format_report_compares_files(create_terrain):
+    vertices, normals = create_terrain(2000)
+    stats = analyze_file(_read(vertices, normals))
+    other = analyze_file(_read(vertices, normals, max_octree_cube_triangles=8, min_octree_cube_size=64))
+    assert other["leaves"] > stats["leaves"]
+    lines = format_report(stats, other)
+    row = next(line for line in lines if line.startswith("Leaves "))
+    change = "+{}".format(other["leaves"] - stats["leaves"])
+    assert row.split()[1:4] == [str(stats["leaves"]), str(other["leaves"]), change]
+    row = next(line for line in format_report(stats) if line.startswith("Leaves "))
+    assert row.split()[1:] == [str(stats["leaves"])]
@@ -0,0 +1,45 @@
+import io
+import json
+import numpy as np
+import os
+import pytest
+from io_scene_kcl.__main__ import main
+from io_scene_kcl.kcl_batch import run_batch
+from io_scene_kcl.kcl_writer import KclWriter
+
+def _write_files(create_terrain, tmp_path):
+    vertices, normals = create_terrain(500)
+    raw = io.BytesIO()
+    KclWriter().write(raw, vertices, normals, np.zeros(len(vertices)))
+    (tmp_path / "courses" / "sub").mkdir(parents=True)
+    paths = [str(tmp_path / "courses" / "a.kcl"), str(tmp_path / "courses" / "sub" / "b.kcl")]
+    for path in paths:
+        with open(path, "wb") as file:
+            file.write(raw.getvalue())
+    return paths
+
+def test_output_paths_keep_directories(create_terrain, tmp_path):
+    paths = _write_files(create_terrain, tmp_path)
+    output_dir = os.path.join(str(tmp_path), "out")
+    results = list(run_batch(paths, "to-obj", output_dir, 1))
+    assert [result["output"] for result in results] == [os.path.join(output_dir, "a.obj"),
+                                                        os.path.join(output_dir, "sub", "b.obj")]
+    assert all(os.path.isfile(result["output"]) for result in results)
+
+def test_failed_file_does_not_stop_batch(create_terrain, tmp_path, capsys):
+    paths = _write_files(create_terrain, tmp_path)
+    bad = str(tmp_path / "courses" / "bad.kcl")
+    with open(bad, "wb") as file:
+        file.write(b"not a KCL file")
+    capsys.readouterr()
+    with pytest.raises(SystemExit) as error:
+        main(["batch", "validate", str(tmp_path / "courses"), "--processes", "1"])
+    assert error.value.code == 1
+    output = capsys.readouterr()
+    results = {result["file"]: result for result in map(json.loads, output.out.splitlines())}
+    assert sorted(results) == sorted(paths + [bad])
+    assert "error" in results[bad]
+    for path in paths:
+        assert "error" not in results[path]
+        assert results[path]["triangles"] == 500
+    assert "1 of 3 files failed" in output.err
@@ -0,0 +1,70 @@
+import io
+import numpy as np
+import os
+import time
+from io_scene_kcl.kcl_cache import ParseCache
+from io_scene_kcl.kcl_file import KclFile
+from io_scene_kcl.kcl_writer import KclWriter
+
+def _write(create_terrain, seed=0):
+    vertices, normals = create_terrain(500, seed)
+    raw = io.BytesIO()
+    KclWriter().write(raw, vertices, normals, np.zeros(len(vertices)))
+    return raw.getvalue()
+
+def test_hit_returns_stored_vertices(create_terrain, tmp_path):
+    data = _write(create_terrain)
+    cache = ParseCache(str(tmp_path))
+    expected = KclFile(data).models[0].all_triangle_vertices()
+    for hits in (0, 1):
+        kcl_file = cache.load(KclFile(data))
+        assert cache.hits == hits
+        vertices, degenerate = kcl_file.models[0].triangle_vertices
+        np.testing.assert_array_equal(vertices, expected[0])
+        np.testing.assert_array_equal(degenerate, expected[1])
+    assert cache.misses == 1
+    assert cache.stats()["entries"] == 1
+
+def test_changes_invalidate_entries(create_terrain, tmp_path, monkeypatch):
+    cache = ParseCache(str(tmp_path))
+    cache.load(KclFile(_write(create_terrain)))
+    # Other contents and another version of the stored arrays are cached separately.
+    cache.load(KclFile(_write(create_terrain, 1)))
+    monkeypatch.setattr(ParseCache, "VERSION", ParseCache.VERSION + 1)
+    cache.load(KclFile(_write(create_terrain)))
+    assert (cache.hits, cache.misses) == (0, 3)
+    # Incomplete entries are stored again.
+    entry = max(os.listdir(str(tmp_path)), key=lambda name: os.path.getmtime(str(tmp_path / name)))
+    os.remove(str(tmp_path / entry / "vertices_0.npy"))
+    cache.load(KclFile(_write(create_terrain)))
+    assert (cache.hits, cache.misses) == (0, 4)
+    cache.load(KclFile(_write(create_terrain)))
+    assert cache.hits == 1
+
+def test_least_recently_used_entries_are_evicted(create_terrain, tmp_path):
+    files = [_write(create_terrain, seed) for seed in range(0, 3)]
+    cache = ParseCache(str(tmp_path))
+    cache.load(KclFile(files[0]))
+    entry_size = cache.stats()["size"]
+    cache.max_size = 2 * entry_size
+    cache.load(KclFile(files[1]))
+    # Using the first entry again makes the second one the least recently used.
+    time.sleep(0.05)
+    cache.load(KclFile(files[0]))
+    time.sleep(0.05)
+    cache.load(KclFile(files[2]))
+    assert cache.evictions == 1
+    assert cache.stats()["entries"] == 2
+    cache.load(KclFile(files[0]))
+    cache.load(KclFile(files[1]))
+    assert (cache.hits, cache.misses) == (2, 4)
+
+def test_stale_temporary_directories_are_removed(create_terrain, tmp_path):
+    stale, fresh = tmp_path / "stale.1.tmp", tmp_path / "fresh.2.tmp"
+    stale.mkdir()
+    fresh.mkdir()
+    old = time.time() - ParseCache.STALE_AGE - 1
+    os.utime(str(stale), (old, old))
+    ParseCache(str(tmp_path)).load(KclFile(_write(create_terrain)))
+    assert not stale.exists()
+    assert fresh.exists()
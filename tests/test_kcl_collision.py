@@ -0,0 +1,89 @@
+import io
+import numpy as np
+import pytest
+from io_scene_kcl.kcl_collision import CollisionMesh, CollisionWorld
+from io_scene_kcl.kcl_file import KclFile, KclModel
+from io_scene_kcl.kcl_writer import KclWriter
+
+@pytest.fixture(params=["single", "split"])
+def kcl_file(request, create_terrain, monkeypatch):
+    # Return the terrain read back from a file, either as one model or forced into several ones.
+    if request.param == "split":
+        monkeypatch.setattr(KclWriter, "_fits_model", lambda self, triangles, normals, indices: len(indices) <= 600)
+    vertices, normals = create_terrain(2000)
+    raw = io.BytesIO()
+    KclWriter().write(raw, vertices, normals, np.arange(len(vertices)) % 7)
+    return KclFile(raw.getvalue())
+
+def _create_queries(kcl_file, count):
+    rng = np.random.default_rng(0)
+    vertices = np.concatenate([kcl_model.all_triangle_vertices()[0] for kcl_model in kcl_file.models])
+    world_min, world_max = vertices.reshape(-1, 3).min(axis=0), vertices.reshape(-1, 3).max(axis=0)
+    origins = rng.uniform(world_min, world_max + (0, 300, 0), (count, 3))
+    directions = rng.normal(0, 0.5, (count, 3)) + (0, -1, 0)
+    directions[-5:] = (0, 1, 0)
+    return origins, directions / np.linalg.norm(directions, axis=1, keepdims=True)
+
+def _get_vertices(kcl_file):
+    # Return the corners of the non-degenerate triangles of all models.
+    vertices = [kcl_model.all_triangle_vertices() for kcl_model in kcl_file.models]
+    return np.concatenate([model_vertices[~degenerate] for model_vertices, degenerate in vertices]).astype(np.float64)
+
+def _point_distances(point, vertices):
+    # Return the distance of the point to each triangle, being the one to its plane if it projects into the triangle,
+    # and else the one to the closest edge.
+    v = [vertices[:, i] for i in range(0, 3)]
+    normal = np.cross(v[1] - v[0], v[2] - v[0])
+    normal /= np.linalg.norm(normal, axis=1, keepdims=True)
+    offset = np.einsum("ij,ij->i", point - v[0], normal)
+    projected = point - normal * offset[:, np.newaxis]
+    sides = [np.einsum("ij,ij->i", np.cross(v[(i + 1) % 3] - v[i], projected - v[i]), normal) for i in range(0, 3)]
+    inside = (np.stack(sides) >= 0).all(axis=0) | (np.stack(sides) <= 0).all(axis=0)
+    distances = np.where(inside, np.abs(offset), np.inf)
+    for i in range(0, 3):
+        edge = v[(i + 1) % 3] - v[i]
+        t = np.clip(np.einsum("ij,ij->i", point - v[i], edge) / np.einsum("ij,ij->i", edge, edge), 0, 1)
+        distances = np.minimum(distances, np.linalg.norm(point - (v[i] + edge * t[:, np.newaxis]), axis=1))
+    return distances
+
+def test_cast_rays(kcl_file):
+    origins, directions = _create_queries(kcl_file, 200)
+    distances, model_indices, indices, collision_flags = CollisionWorld(kcl_file).cast_rays(origins, directions)
+    vertices = _get_vertices(kcl_file)
+    assert np.isfinite(distances).sum() > 100
+    for origin, direction, distance in zip(origins, directions, distances):
+        expected = KclModel._intersect_ray(origin, direction, vertices).min()
+        assert distance == pytest.approx(expected, rel=1e-4, abs=1e-2)
+    hit = np.isfinite(distances)
+    assert (model_indices[~hit] == -1).all() and (indices[~hit] == -1).all() and (collision_flags[~hit] == 0).all()
+    for model_index, index, flags in zip(model_indices[hit], indices[hit], collision_flags[hit]):
+        assert flags == kcl_file.models[model_index].triangles.collision_flags[index]
+    # The maximum distances limit the hits.
+    limited = CollisionWorld(kcl_file).cast_rays(origins, directions, distances / 2)[0]
+    assert not np.isfinite(limited[distances > 0]).any()
+
+def test_mesh_cast_rays_match_model_ray_casts(kcl_file):
+    origins, directions = _create_queries(kcl_file, 50)
+    for kcl_model in kcl_file.models:
+        distances, indices, collision_flags = CollisionMesh(kcl_model).cast_rays(origins, directions)
+        for origin, direction, distance in zip(origins, directions, distances):
+            hit = kcl_model.ray_cast(origin, direction)
+            assert distance == pytest.approx(np.inf if hit is None else hit[1], rel=1e-4, abs=1e-2)
+
+def test_sweep_spheres(kcl_file):
+    origins, directions = _create_queries(kcl_file, 30)
+    radii = np.linspace(5, 60, len(origins))
+    max_distances = np.full(len(origins), 400.0)
+    distances, model_indices, indices, collision_flags = CollisionWorld(kcl_file).sweep_spheres(
+        origins, directions, radii, max_distances)
+    vertices = _get_vertices(kcl_file)
+    assert np.isfinite(distances).sum() > 5
+    for origin, direction, radius, distance in zip(origins, directions, radii, distances):
+        # The sphere touches a triangle at the distance it stops at, and none along its path before. Spheres already
+        # overlapping a triangle at their origin stop right away.
+        if distance == 0:
+            assert _point_distances(origin, vertices).min() <= radius + 0.05
+        elif np.isfinite(distance):
+            assert _point_distances(origin + direction * distance, vertices).min() == pytest.approx(radius, abs=0.05)
+        for step in np.linspace(0, min(distance, 400.0), 100)[:-1] if distance > 0 else []:
+            assert _point_distances(origin + direction * step, vertices).min() > radius - 0.05
@@ -0,0 +1,87 @@
+import io
+import numpy as np
+import pytest
+from io_scene_kcl.kcl_file import KclFile, KclModel
+from io_scene_kcl.kcl_writer import KclWriter
+
+@pytest.fixture(params=["single", "split"])
+def course(request, create_terrain, monkeypatch):
+    # Return the written and read back terrain, either as one model or forced into several ones.
+    if request.param == "split":
+        monkeypatch.setattr(KclWriter, "_fits_model", lambda self, triangles, normals, indices: len(indices) <= 600)
+    vertices, normals = create_terrain(2000)
+    raw = io.BytesIO()
+    KclWriter().write(raw, vertices, normals, np.zeros(len(vertices)))
+    kcl_file = KclFile(raw.getvalue())
+    assert (len(kcl_file.models) > 1) == (request.param == "split")
+    return vertices, normals, kcl_file
+
+def test_sections_are_mapped(course):
+    vertices, normals, kcl_file = course
+    for kcl_model in kcl_file.models:
+        # Only the normals written into the section are mapped, each of them referenced by a triangle.
+        header = kcl_model.header
+        assert len(kcl_model.normals) == (header.triangles_offset - header.normals_offset) // 12
+        triangles = kcl_model.triangles
+        referenced = np.concatenate([triangles[field] for field in ("direction_index", "normal_a_index",
+                                                                    "normal_b_index", "normal_c_index")])
+        assert len(np.unique(referenced)) == len(kcl_model.normals)
+        # Single triangles are reconstructed like all of them at once.
+        all_vertices = kcl_model.all_triangle_vertices()[0]
+        for i in range(0, len(triangles), 37):
+            np.testing.assert_allclose(kcl_model.get_triangle_vertices(triangles[i]), all_vertices[i], atol=1e-3)
+
+def _global_indices(kcl_file, hits):
+    return {int(kcl_file.models[i].triangles.global_index[j]) for i, j in hits}
+
+def test_triangles_at(course):
+    vertices, normals, kcl_file = course
+    # Each triangle is in the cube containing its center.
+    centers = vertices.mean(axis=1)
+    for global_index in range(0, len(vertices), 7):
+        assert global_index in _global_indices(kcl_file, kcl_file.triangles_at(centers[global_index]))
+    assert kcl_file.triangles_at(vertices.reshape(-1, 3).min(axis=0) - 1000) == []
+
+def test_triangles_in_box(course):
+    vertices, normals, kcl_file = course
+    triangles = KclModel.OctreeTriangles(vertices, normals)
+    all_indices = np.arange(len(vertices))
+    rng = np.random.default_rng(0)
+    for center in rng.uniform(vertices.reshape(-1, 3).min(axis=0), vertices.reshape(-1, 3).max(axis=0), (20, 3)):
+        half_width = rng.uniform(10, 200)
+        found = _global_indices(kcl_file, kcl_file.triangles_in_box(center - half_width, center + half_width))
+        # All triangles really overlapping the box are found, and only ones whose bounds overlap it, allowing for the
+        # precision of the reconstructed corners.
+        overlapping = KclModel.OctreeNode.tricube_overlap(triangles, all_indices, center.astype(np.float32),
+                                                          half_width - 0.1)
+        near = ((vertices.min(axis=1) <= center + half_width + 0.1)
+                & (vertices.max(axis=1) >= center - half_width - 0.1)).all(axis=1)
+        assert set(np.flatnonzero(overlapping).tolist()) <= found <= set(np.flatnonzero(near).tolist())
+
+def test_ray_cast(course):
+    vertices, normals, kcl_file = course
+    # Intersect each ray with every triangle of every model.
+    read_vertices = [kcl_model.all_triangle_vertices() for kcl_model in kcl_file.models]
+    rng = np.random.default_rng(0)
+    world_min, world_max = vertices.reshape(-1, 3).min(axis=0), vertices.reshape(-1, 3).max(axis=0)
+    origins = rng.uniform(world_min, world_max + (0, 500, 0), (50, 3))
+    directions = rng.normal(0, 0.5, (50, 3)) + (0, -1, 0)
+    directions[-5:] = (0, 1, 0)
+    for origin, direction in zip(origins, directions):
+        expected = None
+        for model_index, (model_vertices, degenerate) in enumerate(read_vertices):
+            distances = KclModel._intersect_ray(origin, direction / np.linalg.norm(direction), model_vertices)
+            distances[degenerate] = np.inf
+            if distances.min() < np.inf and (expected is None or distances.min() < expected[2]):
+                expected = (model_index, int(distances.argmin()), float(distances.min()))
+        hit = kcl_file.ray_cast(origin, direction)
+        if expected is None:
+            assert hit is None
+        else:
+            assert hit is not None
+            assert hit[2] == pytest.approx(expected[2])
+            assert _global_indices(kcl_file, [hit[:2]]) == _global_indices(kcl_file, [expected[:2]])
+    # The maximum distance limits the hits.
+    hit = kcl_file.ray_cast(world_max + (0, 500, 0), (0, -1, 0))
+    assert hit is not None
+    assert kcl_file.ray_cast(world_max + (0, 500, 0), (0, -1, 0), hit[2] / 2) is None
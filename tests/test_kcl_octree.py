@@ -0,0 +1,70 @@
+import io
+import multiprocessing
+import numpy as np
+import pytest
+from io_scene_kcl import kcl_octree
+from io_scene_kcl.kcl_file import KclFile, KclModel
+from io_scene_kcl.kcl_octree import OctreeCache, build_octree, tune_octree, write_octree
+from io_scene_kcl.kcl_writer import KclWriter
+
+def _octree_args(vertices, normals):
+    triangles = KclModel.OctreeTriangles(vertices, normals)
+    base = vertices.reshape(-1, 3).min(axis=0)
+    size = (vertices.reshape(-1, 3).max(axis=0) - base).max()
+    cube_size = 2 ** (int(np.ceil(np.log2(size))) - 2)
+    return triangles, base, cube_size, (4, 4, 4), 16, 64
+
+def test_engines_build_equal_octrees(create_terrain, monkeypatch):
+    # Check the straddling triangles in several chunks, as the ones of a small terrain otherwise fit into one.
+    monkeypatch.setattr(kcl_octree, "_OVERLAP_CHUNK", 100)
+    args = _octree_args(*create_terrain(3000))
+    recursive = write_octree(build_octree(*args, engine="recursive"))
+    assert write_octree(build_octree(*args, engine="binned")) == recursive
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != "fork",
+                    reason="Worker processes cannot import the package loaded from the add-on folder.")
+def test_parallel_build_equals_serial_build(create_terrain):
+    args = _octree_args(*create_terrain(3000))
+    assert write_octree(build_octree(*args, processes=2)) == write_octree(build_octree(*args, processes=1))
+
+def test_incremental_build_equals_full_build(create_terrain, tmp_path):
+    vertices, normals = create_terrain(3000)
+    args = _octree_args(vertices, normals)
+    path = str(tmp_path / "course.kcl") + OctreeCache.EXTENSION
+    cache = OctreeCache.load(path)
+    assert write_octree(cache.build_octree(*args)) == write_octree(build_octree(*args))
+    assert cache.reused_cubes == 0
+    cache.save(path)
+    # Raise a few triangles in one corner of the terrain, which only changes some of the root cubes.
+    vertices = vertices.copy()
+    vertices[:20, :, 1] += 5
+    args = _octree_args(vertices, normals)
+    cache = OctreeCache.load(path)
+    incremental = write_octree(cache.build_octree(*args))
+    assert incremental == write_octree(build_octree(*args))
+    assert 0 < cache.reused_cubes < cache.root_cubes
+
+def test_unreadable_cache_is_ignored(tmp_path):
+    path = tmp_path / "course.kcl.octree"
+    path.write_bytes(b"PK\x03\x04 truncated")
+    assert OctreeCache.load(str(path)).models == {}
+
+def test_tuned_octree_is_no_larger_than_default(create_terrain):
+    triangles, base, cube_size, divisions = _octree_args(*create_terrain(20000))[:4]
+    default = write_octree(build_octree(triangles, base, cube_size, divisions, 32, 256))
+    metrics, results = tune_octree(triangles, base, cube_size, divisions, len(default))
+    default_metrics = next(result for result in results if (result["max_triangles"], result["min_width"]) == (32, 256))
+    assert metrics["lookup_cost"] <= default_metrics["lookup_cost"]
+    # The estimated size is an upper bound, as leaves with equal triangles share their list.
+    tuned = write_octree(build_octree(triangles, base, cube_size, divisions, metrics["max_triangles"],
+                                      metrics["min_width"]))
+    assert len(tuned) <= metrics["size"] <= len(default)
+
+def test_tuned_octree_finds_triangles(create_terrain):
+    vertices, normals = create_terrain(3000)
+    raw = io.BytesIO()
+    KclWriter(auto_tune_octree=True).write(raw, vertices, normals, np.zeros(len(vertices)))
+    kcl_file = KclFile(raw.getvalue())
+    centers = vertices.mean(axis=1)
+    for global_index in range(0, len(vertices), 7):
+        assert (0, global_index) in kcl_file.triangles_at(centers[global_index])
@@ -0,0 +1,60 @@
+import io
+import numpy as np
+from io_scene_kcl.kcl_file import KclFile
+from io_scene_kcl.kcl_writer import KclWriter
+
+def _write(vertices, normals, collision_flags, **writer_args):
+    raw = io.BytesIO()
+    KclWriter(**writer_args).write(raw, vertices, normals, collision_flags)
+    return raw.getvalue()
+
+def test_write_read_round_trip(create_terrain):
+    vertices, normals = create_terrain(2000)
+    collision_flags = np.arange(len(vertices)) % 7
+    kcl_file = KclFile(_write(vertices, normals, collision_flags))
+    assert len(kcl_file.models) == 1
+    kcl_model = kcl_file.models[0]
+    assert len(kcl_model.triangles) == len(vertices)
+    assert kcl_model.triangles.collision_flags.tolist() == collision_flags.tolist()
+    assert kcl_model.triangles.global_index.tolist() == list(range(len(vertices)))
+    read_vertices, degenerate = kcl_model.all_triangle_vertices()
+    assert not degenerate.any()
+    np.testing.assert_allclose(read_vertices, vertices, atol=0.05)
+
+def test_split_models_share_copies(create_terrain, monkeypatch, tmp_path):
+    # Force splitting the triangles into several models, which store the triangles spanning them in each of them.
+    monkeypatch.setattr(KclWriter, "_fits_model", lambda self, triangles, normals, indices: len(indices) <= 600)
+    vertices, normals = create_terrain(2000)
+    path = str(tmp_path / "course.kcl")
+    KclWriter().write(path, vertices, normals, np.zeros(len(vertices)))
+    with KclFile.open_mmap(path, writable=True) as kcl_file:
+        assert len(kcl_file.models) > 1
+        unique = kcl_file.unique_triangles()
+        global_indices = np.concatenate([kcl_model.triangles.global_index[mask]
+                                         for kcl_model, mask in zip(kcl_file.models, unique)])
+        assert sorted(global_indices.tolist()) == list(range(len(vertices)))
+        # Changing a copy changes all of them.
+        total = sum(len(kcl_model.triangles) for kcl_model in kcl_file.models)
+        assert total > len(vertices)
+        model_index = next(i for i, mask in enumerate(unique) if not mask.all())
+        triangle_index = int(np.flatnonzero(~unique[model_index])[0])
+        global_index = kcl_file.models[model_index].triangles.global_index[triangle_index]
+        copies = sum(int((kcl_model.triangles.global_index == global_index).sum()) for kcl_model in kcl_file.models)
+        assert kcl_file.update_collision_flags(model_index, [triangle_index], 0x20) == copies
+        for kcl_model in kcl_file.models:
+            flags = kcl_model.triangles.collision_flags
+            assert (flags[kcl_model.triangles.global_index == global_index] == 0x20).all()
+            assert (flags[kcl_model.triangles.global_index != global_index] == 0).all()
+        kcl_file.flush()
+
+def test_split_flat_course(create_terrain):
+    # Flat courses are lower than the minimum cube size, so they are only split horizontally. Each triangle must be in
+    # the model found at its center.
+    vertices, normals = create_terrain(100000, relief=0.1)
+    assert np.ptp(vertices[:, :, 1]) < 256
+    kcl_file = KclFile(_write(vertices, normals, np.zeros(len(vertices)), octree_engine="binned"))
+    assert len(kcl_file.models) > 1
+    centers = vertices.mean(axis=1)
+    for global_index in range(0, len(vertices), 101):
+        kcl_model = kcl_file.models[kcl_file.model_at(centers[global_index])]
+        assert global_index in kcl_model.triangles.global_index
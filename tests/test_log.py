@@ -0,0 +1,33 @@
+import multiprocessing
+import pytest
+from io_scene_kcl.kcl_octree import build_octree
+from io_scene_kcl.log import Profiler
+from test_kcl_octree import _octree_args
+
+@pytest.mark.parametrize("value, enabled", [(None, False), ("", False), ("0", False), ("false", False),
+                                            ("off", False), ("1", True), ("true", True), (" Yes ", True)])
+def test_profile_environment_variable(monkeypatch, value, enabled):
+    if value is None:
+        monkeypatch.delenv("KCL_PROFILE", raising=False)
+    else:
+        monkeypatch.setenv("KCL_PROFILE", value)
+    Profiler.begin()
+    try:
+        assert Profiler.enabled == enabled
+    finally:
+        Profiler.end()
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != "fork",
+                    reason="Worker processes cannot import the package loaded from the add-on folder.")
+def test_counters_of_workers_are_merged(create_terrain, capsys):
+    args = _octree_args(*create_terrain(3000))
+    counters = []
+    for processes in (1, 2):
+        Profiler.begin(True)
+        Profiler.count("Before build")
+        build_octree(*args, processes=processes)
+        counters.append(dict(Profiler.counters))
+        Profiler.end()
+    assert counters[0]["Before build"] == 1
+    assert any(name.startswith("Octree overlap tests") for name in counters[0])
+    assert counters[1] == counters[0]
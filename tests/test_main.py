@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from io_scene_kcl.__main__ import main
+from io_scene_kcl.kcl_writer import KclWriter
+from io_scene_kcl.obj_file import read_obj
+
+def _read_triangles(path):
+    # Return the corners rounded to the precision of the file and the flags of each triangle, in a canonical order.
+    with open(path) as file:
+        vertices, normals, collision_flags = read_obj(file)
+    corners = np.round(vertices, 1).reshape(len(vertices), -1).tolist()
+    return sorted(tuple(triangle) + (int(flags),) for triangle, flags in zip(corners, collision_flags))
+
+def test_obj_round_trip(tmp_path):
+    # Quads are split into triangles, and faces of materials not naming flags have none.
+    obj = tmp_path / "course.obj"
+    obj.write_text("\n".join((
+        "v 0 0 0", "v 100 0 0", "v 100 0 100", "v 0 0 100", "v 0 50 200", "v 100 50 200",
+        "usemtl kcl_flags_0x1234",
+        "f 1 2 3",
+        "usemtl kcl_flags_7",
+        "f 1/1 3/1 4/1",
+        "usemtl grass",
+        "f -5 -1 -4",
+        "usemtl kcl_flags_0xFFFF",
+        "f 4 3 6 5")) + "\n")
+    main(["from-obj", str(obj), str(tmp_path / "course.kcl")])
+    main(["to-obj", str(tmp_path / "course.kcl"), str(tmp_path / "round_trip.obj")])
+    expected = sorted([
+        (0, 0, 0, 100, 0, 0, 100, 0, 100, 0x1234),
+        (0, 0, 0, 100, 0, 100, 0, 0, 100, 7),
+        (100, 0, 0, 100, 50, 200, 100, 0, 100, 0),
+        (0, 0, 100, 100, 0, 100, 100, 50, 200, 0xFFFF),
+        (0, 0, 100, 100, 50, 200, 0, 50, 200, 0xFFFF)])
+    assert _read_triangles(str(tmp_path / "round_trip.obj")) == expected
+    # Converting the result again does not change it.
+    main(["from-obj", str(tmp_path / "round_trip.obj"), str(tmp_path / "course.kcl")])
+    main(["to-obj", str(tmp_path / "course.kcl"), str(tmp_path / "round_trip.obj")])
+    assert _read_triangles(str(tmp_path / "round_trip.obj")) == expected
+
+def test_obj_round_trip_of_split_models(create_terrain, monkeypatch, tmp_path):
+    # Triangles stored in several models are only written once.
+    monkeypatch.setattr(KclWriter, "_fits_model", lambda self, triangles, normals, indices: len(indices) <= 600)
+    vertices, normals = create_terrain(2000)
+    obj = tmp_path / "course.obj"
+    with open(str(obj), "w") as file:
+        np.savetxt(file, vertices.reshape(-1, 3), "v %.9g %.9g %.9g")
+        for flags in range(0, 4):
+            file.write("usemtl kcl_flags_{}\n".format(flags))
+            faces = np.arange(flags, len(vertices), 4)
+            np.savetxt(file, 1 + 3 * faces[:, np.newaxis] + np.arange(0, 3), "f %d %d %d")
+    main(["from-obj", str(obj), str(tmp_path / "course.kcl")])
+    main(["to-obj", str(tmp_path / "course.kcl"), str(tmp_path / "round_trip.obj")])
+    assert _read_triangles(str(tmp_path / "round_trip.obj")) == _read_triangles(str(obj))
+
+@pytest.mark.parametrize("material", ["kcl_flags_0x10000", "kcl_flags_-1", "kcl_flags_grass"])
+def test_invalid_flags_material(tmp_path, capsys, material):
+    obj = tmp_path / "course.obj"
+    obj.write_text("v 0 0 0\nv 1 0 0\nv 0 0 1\nusemtl {}\nf 1 2 3\n".format(material))
+    with pytest.raises(SystemExit) as error:
+        main(["from-obj", str(obj), str(tmp_path / "course.kcl")])
+    assert error.value.code == 1
+    assert "'{}' in line 4".format(material) in capsys.readouterr().err
+    assert not (tmp_path / "course.kcl").exists()
@@ -0,0 +1,77 @@
+import io
+import numpy as np
+import pytest
+from io_scene_kcl.szs_file import SarcFile, SarcWriter, Yaz0Decoder, split_archive_path, yaz0_compress, \
+    yaz0_decompress
+
+def _samples():
+    rng = np.random.default_rng(0)
+    return [
+        b"",
+        b"ab",
+        b"a" * 1000,
+        b"hello world " * 300,
+        bytes(rng.integers(0, 4, 5000, dtype=np.uint8)),
+        bytes(rng.integers(0, 256, 3001, dtype=np.uint8))]
+
+@pytest.mark.parametrize("level", [0, 1, 3, 6, 9])
+def test_yaz0_round_trip(level):
+    for data in _samples():
+        compressed = yaz0_compress(data, level)
+        assert compressed[:4] == b"Yaz0"
+        assert bytes(yaz0_decompress(compressed)) == data
+
+def test_yaz0_compresses_repetitions():
+    data = b"hello world " * 300
+    assert len(yaz0_compress(data, 1)) < len(data) // 10
+    assert len(yaz0_compress(data, 9)) <= len(yaz0_compress(data, 1))
+
+def test_yaz0_decompresses_lazily():
+    data = _samples()[4]
+    decoder = Yaz0Decoder(yaz0_compress(data, 3))
+    assert bytes(decoder.decompress(100)) == data[:100]
+    assert decoder.size < len(data)
+    assert bytes(decoder.decompress(len(data))) == data
+
+@pytest.mark.parametrize("level", [0, 6])
+def test_yaz0_decompresses_in_steps(level):
+    # Groups of literal bytes only are copied together, also past the requested end.
+    for data in _samples():
+        decoder = Yaz0Decoder(yaz0_compress(data, level))
+        for end in range(0, len(data) + 100, 97):
+            assert bytes(decoder.decompress(end)) == data[:end]
+
+def test_yaz0_rejects_invalid_data():
+    with pytest.raises(AssertionError):
+        yaz0_compress(b"", 10)
+    with pytest.raises(AssertionError):
+        yaz0_decompress(b"Yaz1" + bytes(12))
+    compressed = yaz0_compress(_samples()[5], 6)
+    with pytest.raises(AssertionError):
+        yaz0_decompress(compressed[:-10])
+
+@pytest.mark.parametrize("compression_level", [None, 0, 6])
+def test_sarc_round_trip(compression_level):
+    files = {"course.kcl": bytes(range(256)) * 10, "other/a.bin": b"abc", "empty.txt": b""}
+    raw = io.BytesIO()
+    SarcWriter(compression_level=compression_level).write(raw, files)
+    data = raw.getvalue()
+    assert data[:4] == (b"SARC" if compression_level is None else b"Yaz0")
+    archive = SarcFile(data)
+    assert sorted(archive.names) == sorted(files)
+    assert "course.kcl" in archive
+    assert {name: bytes(contents) for name, contents in archive.read_all().items()} == files
+    for node in archive.nodes:
+        assert (archive.data_offset + node.start) % 0x100 == 0
+
+def test_sarc_round_trip_through_file(tmp_path):
+    path = str(tmp_path / "course.szs")
+    SarcWriter().write(path, {"course.kcl": b"kcl"})
+    assert bytes(SarcFile.open(path).read("course.kcl")) == b"kcl"
+    with pytest.raises(AssertionError):
+        SarcFile.open(path).read("missing.kcl")
+
+def test_split_archive_path():
+    assert split_archive_path("course.szs:course.kcl") == ("course.szs", "course.kcl")
+    assert split_archive_path("course.SZS") == ("course.SZS", None)
+    assert split_archive_path("course.kcl") == (None, None)
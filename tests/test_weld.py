@@ -0,0 +1,52 @@
+import numpy as np
+from io_scene_kcl.kcl_file import weld_vertices
+
+def _square(corner):
+    # Two triangles of a unit square whose shared corner at the origin is stored slightly differently in each.
+    return np.array([
+        [corner[0], [1, 0, 0], [1, 1, 0]],
+        [corner[1], [1, 1, 0], [0, 1, 0]]], np.float32)
+
+def test_weld_merges_close_corners():
+    positions, indices = weld_vertices(_square([[0.001, 0, 0], [0.002, 0, 0]]), 0.01)
+    assert len(positions) == 4
+    assert indices[0, 0] == indices[1, 0]
+
+def test_weld_merges_corners_straddling_a_cell_boundary():
+    positions, indices = weld_vertices(_square([[0.00499, 0, 0], [0.00501, 0, 0]]), 0.01)
+    assert len(positions) == 4
+    assert indices[0, 0] == indices[1, 0]
+    np.testing.assert_allclose(positions[indices[0, 0]], [0.00499, 0, 0])
+
+def test_weld_keeps_distant_corners():
+    positions, indices = weld_vertices(_square([[0, 0, 0], [0.02, 0, 0]]), 0.01)
+    assert len(positions) == 5
+    assert indices[0, 0] != indices[1, 0]
+
+def test_weld_chains_corners():
+    # The corners are merged through the one between them even though the outer ones are too far apart.
+    vertices = np.array([[[0, 0, 0], [0.008, 0, 0], [0.016, 0, 0]]], np.float32)
+    positions, indices = weld_vertices(vertices, 0.01)
+    assert len(positions) == 1
+    assert indices.tolist() == [[0, 0, 0]]
+
+def test_weld_matches_brute_force():
+    rng = np.random.default_rng(0)
+    vertices = rng.random((200, 3, 3))
+    distance = 0.05
+    positions, indices = weld_vertices(vertices, distance)
+    corners = vertices.reshape(-1, 3)
+    # Label the connected corners with a plain union-find over all pairs.
+    parents = list(range(len(corners)))
+    def find(i):
+        while parents[i] != i:
+            i = parents[i]
+        return i
+    for i in range(len(corners)):
+        close = np.flatnonzero(((corners[i + 1:] - corners[i]) ** 2).sum(axis=1) <= distance * distance)
+        for j in (close + i + 1).tolist():
+            parents[find(i)] = find(j)
+    groups = np.array([find(i) for i in range(len(corners))])
+    assert len(positions) == len(np.unique(groups))
+    flat = indices.reshape(-1)
+    assert ((groups[:, np.newaxis] == groups) == (flat[:, np.newaxis] == flat)).all()